@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#License GPL v3
+#Author Horst Knorr <gpgmailencrypt@gmx.de>
+"""
+End-to-end throughput and latency benchmark for gpgmailencrypt.
+
+A synthetic, reproducible mail corpus is sent through gme.send_mails (or
+gme._encrypt_single_mail) to one recipient per encryption method. Every
+method runs in a fresh process, so the reported peak RSS belongs to that
+method alone. Keys are generated into a throwaway GPG/OpenSSL key home.
+"""
+from email.mime.application	import MIMEApplication
+from email.mime.multipart	import MIMEMultipart
+from email.mime.text		import MIMEText
+import base64
+import email
+import getopt
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BASEDIR=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1,BASEDIR)
+import gpgmailencrypt
+from gmeutils.version	import VERSION
+
+BENCHDOMAIN="bench.gpgmailencry.pt"
+FROMADDR="sender@%s"%BENCHDOMAIN
+METHODS=["NONE","PGPINLINE","PGPMIME","SMIME","PDF"]
+KINDS=["plain","html","attachments","encrypted"]
+ENTRIES=["send_mails","encrypt_single_mail"]
+ATTACHMENTSIZES=[4*1024,64*1024,512*1024]
+
+############
+#print_usage
+############
+
+def print_usage():
+	"shows the command line options to stdout"
+	print ("gmebenchmark.py [options]")
+	print ("\nOptions:\n")
+	print ("-c f --compare f:   compare the results with the JSON file 'f'")
+	print ("-e e --entry e:     'send_mails' (default) or "
+			"'encrypt_single_mail'")
+	print ("-h --help:          print this help")
+	print ("-i n --iterations n:")
+	print ("                    send every corpus mail n times (default 5)")
+	print ("-j f --json f:      write the results as JSON to file 'f'")
+	print ("-m l --methods l:   comma separated list of methods, default is")
+	print ("                    %s"%",".join(METHODS))
+	print ("-s n --seed n:      seed of the synthetic corpus (default 1)")
+	print ("-w n --warmup n:    unmeasured runs per method (default 2)")
+
+##########
+#_randtext
+##########
+
+def _randtext(rnd,size):
+	"returns 'size' bytes of reproducible pseudo text"
+	words=["lorem","ipsum","dolor","sit","amet","gpg","mail","encrypt",
+			"relay","domain","message","attachment","key","server"]
+	result=[]
+	length=0
+
+	while length<size:
+		w=rnd.choice(words)
+		result.append(w)
+		length+=len(w)+1
+
+	lines=[]
+
+	for i in range(0,len(result),12):
+		lines.append(" ".join(result[i:i+12]))
+
+	return "\n".join(lines)[:size]
+
+#############
+#_mailheaders
+#############
+
+def _mailheaders(msg,kind,counter):
+	msg["Message-ID"]="<bench%i.%s@%s>"%(counter,kind,BENCHDOMAIN)
+	msg["Date"]="Fri, 21 Aug 2015 17:51:15 +0200"
+	msg["From"]=FROMADDR
+	msg["To"]="recipient@%s"%BENCHDOMAIN
+	msg["Subject"]="benchmark %s %i"%(kind,counter)
+	return msg
+
+#############
+#build_corpus
+#############
+
+def build_corpus(seed,smimecert=None):
+	"""returns a reproducible list of (kind,mailtext) tuples.
+	If 'smimecert' is set, an S/MIME mail encrypted for this certificate
+	is part of the already encrypted mails"""
+	rnd=random.Random(seed)
+	corpus=[]
+	counter=0
+
+	for size in (512,8*1024,64*1024):
+		counter+=1
+		msg=MIMEText(_randtext(rnd,size),"plain","utf-8")
+		corpus.append(("plain",_mailheaders(msg,"plain",counter).as_string()))
+
+	for size in (2*1024,32*1024):
+		counter+=1
+		msg=MIMEMultipart("alternative")
+		txt=_randtext(rnd,size)
+		msg.attach(MIMEText(txt,"plain","utf-8"))
+		html="<html><body><p>%s</p></body></html>"%txt.replace("\n",
+																"</p><p>")
+		msg.attach(MIMEText(html,"html","utf-8"))
+		corpus.append(("html",_mailheaders(msg,"html",counter).as_string()))
+
+	for size in ATTACHMENTSIZES:
+		counter+=1
+		msg=MIMEMultipart()
+		msg.attach(MIMEText(_randtext(rnd,1024),"plain","utf-8"))
+		data=bytes(rnd.getrandbits(8) for i in range(size//2))
+		data+=_randtext(rnd,size-len(data)).encode("utf-8")
+		att=MIMEApplication(data,"octet-stream")
+		att.add_header("Content-Disposition",
+						"attachment",
+						filename="attachment%i.bin"%size)
+		msg.attach(att)
+		txtatt=MIMEText(_randtext(rnd,size),"plain","utf-8")
+		txtatt.add_header("Content-Disposition",
+						"attachment",
+						filename="attachment%i.txt"%size)
+		msg.attach(txtatt)
+		corpus.append(("attachments",
+						_mailheaders(msg,"attachments",counter).as_string()))
+
+	counter+=1
+	armor=base64.encodebytes(bytes(rnd.getrandbits(8)
+									for i in range(4096))).decode("ascii")
+	msg=MIMEText("-----BEGIN PGP MESSAGE-----\n\n%s"
+				"-----END PGP MESSAGE-----\n"%armor,"plain","utf-8")
+	corpus.append(("encrypted",
+					_mailheaders(msg,"encrypted",counter).as_string()))
+
+	if smimecert!=None:
+		counter+=1
+		msg=_smime_encrypt(_randtext(rnd,4096),smimecert)
+		corpus.append(("encrypted",
+						_mailheaders(msg,"encrypted",counter).as_string()))
+
+	return corpus
+
+###############
+#_smime_encrypt
+###############
+
+def _smime_encrypt(text,certfile):
+	"returns 'text' as S/MIME mail encrypted for the certificate 'certfile'"
+	p=subprocess.run([	shutil.which("openssl"),
+						"smime",
+						"-encrypt",
+						"-aes256",
+						certfile],
+						input=text.encode("utf-8"),
+						stdout=subprocess.PIPE,
+						stderr=subprocess.DEVNULL,
+						check=True)
+	msg=email.message_from_bytes(p.stdout)
+	#openssl writes the old 'x-pkcs7-mime' type, mail clients the RFC 5751 one
+	msg.replace_header("Content-Type",
+					msg["Content-Type"].replace("x-pkcs7-mime","pkcs7-mime"))
+	return msg
+
+############
+#create_home
+############
+
+def create_home(directory):
+	"""creates throwaway GPG and S/MIME keys and a config file in 'directory',
+	returns the config file name"""
+	gpghome=os.path.join(directory,"gpg")
+	smimehome=os.path.join(directory,"smime")
+	os.makedirs(gpghome,mode=0o700)
+	os.makedirs(smimehome,mode=0o700)
+	gpgcmd=shutil.which("gpg2") or shutil.which("gpg")
+	opensslcmd=shutil.which("openssl")
+
+	for method in ("pgpinline","pgpmime"):
+		subprocess.check_call([	gpgcmd,
+								"--homedir",gpghome,
+								"--batch",
+								"--pinentry-mode","loopback",
+								"--passphrase","",
+								"--quick-gen-key",
+								"Benchmark <%s@%s>"%(method,BENCHDOMAIN),
+								"rsa2048",
+								"default",
+								"never"],
+								stdout=subprocess.DEVNULL,
+								stderr=subprocess.DEVNULL)
+
+	subprocess.check_call([	opensslcmd,
+							"req","-x509",
+							"-newkey","rsa:2048",
+							"-nodes",
+							"-days","2",
+							"-subj","/CN=smime@%s/emailAddress=smime@%s"%(
+												BENCHDOMAIN,BENCHDOMAIN),
+							"-keyout",os.path.join(smimehome,"bench.key"),
+							"-out",os.path.join(smimehome,"bench.crt")],
+							stdout=subprocess.DEVNULL,
+							stderr=subprocess.DEVNULL)
+	cfgname=os.path.join(directory,"benchmark.conf")
+
+	with open(cfgname,"w") as f:
+		f.write("[default]\n"
+				"preferred_encryption=pgpinline\n"
+				"add_header=yes\n"
+				"domains=\n"
+				"storagebackend=TEXT\n"
+				"mailtemplatedir=%s\n"
+				"homedomains=%s\n\n"%(os.path.join(BASEDIR,"mailtemplates"),
+									BENCHDOMAIN))
+		f.write("[logging]\nlog=none\n\n")
+		f.write("[gpg]\nkeyhome=%s\ngpgcommand=%s\n\n"%(gpghome,gpgcmd))
+		f.write("[smime]\nkeyhome=%s\nopensslcommand=%s\n"
+				"defaultcipher=AES256\nextractkey=no\n\n"%(smimehome,
+															opensslcmd))
+		f.write("[smimeuser]\nsmime@%s=bench.crt\n\n"%BENCHDOMAIN)
+		f.write("[pdf]\nuseenryptpdf=True\npdfpasswords=%s\n\n"%(
+									os.path.join(directory,"pdfpasswords.pw")))
+		f.write("[encryptionmap]\n")
+
+		for method in METHODS:
+			f.write("%s@%s=%s\n"%(method.lower(),BENCHDOMAIN,method.lower()))
+
+	return cfgname
+
+############
+#_percentile
+############
+
+def _percentile(values,p):
+	if not values:
+		return 0.0
+
+	values=sorted(values)
+	k=(len(values)-1)*p/100.0
+	f=int(k)
+	c=min(f+1,len(values)-1)
+	return values[f]+(values[c]-values[f])*(k-f)
+
+###########
+#run_method
+###########
+
+def run_method(cfgname,method,entry,corpus,iterations,warmup,outdir):
+	"runs the corpus for one method, meant to be called in a fresh process"
+	to_addr="%s@%s"%(method.lower(),BENCHDOMAIN)
+	latencies={}
+
+	with gpgmailencrypt.gme() as gme:
+		gme.set_configfile(cfgname)
+		gme.set_output2file(os.path.join(outdir,"result.eml"))
+
+		if method=="PDF" and not gme.pdf_factory().is_available():
+			return {"skipped":"pdf tools are not available"}
+
+		def _send(mailtext):
+
+			if entry=="send_mails":
+				gme.send_mails(mailtext,to_addr)
+			else:
+				gme._encrypt_single_mail(	-1,
+											email.message_from_string(mailtext),
+											FROMADDR,
+											to_addr)
+
+			gme._mailcount=0
+
+		for kind,mailtext in corpus[:warmup]:
+			_send(mailtext)
+
+		start=time.perf_counter()
+
+		for i in range(iterations):
+
+			for kind,mailtext in corpus:
+				t=time.perf_counter()
+				_send(mailtext)
+				latencies.setdefault(kind,[]).append(time.perf_counter()-t)
+
+		duration=time.perf_counter()-start
+
+	alllatencies=[l for kind in latencies for l in latencies[kind]]
+	result={"messages":len(alllatencies),
+			"seconds":round(duration,4),
+			"msgs_per_s":round(len(alllatencies)/duration,2) if duration else 0,
+			"p50_ms":round(_percentile(alllatencies,50)*1000,3),
+			"p99_ms":round(_percentile(alllatencies,99)*1000,3),
+			"peak_rss_kb":resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+			"peak_rss_children_kb":resource.getrusage(
+									resource.RUSAGE_CHILDREN).ru_maxrss,
+			"kinds":{}}
+
+	for kind in latencies:
+		result["kinds"][kind]={
+			"messages":len(latencies[kind]),
+			"p50_ms":round(_percentile(latencies[kind],50)*1000,3),
+			"p99_ms":round(_percentile(latencies[kind],99)*1000,3)}
+
+	return result
+
+#######
+#_child
+#######
+
+def _child(conn,*args):
+
+	try:
+		conn.send(run_method(*args))
+	except Exception as e:
+		conn.send({"error":repr(e)})
+
+	conn.close()
+
+################
+#compare_results
+################
+
+def compare_results(old,new):
+	"prints the relative change of throughput and latency per method"
+	print ("\nComparison with gpgmailencrypt %s"%old["meta"].get("version"))
+
+	for method in new["results"]:
+		o=old["results"].get(method,{})
+		n=new["results"][method]
+
+		if "msgs_per_s" not in o or "msgs_per_s" not in n:
+			continue
+
+		line="%s"%method.ljust(12)
+
+		for k in ("msgs_per_s","p50_ms","p99_ms","peak_rss_kb"):
+
+			if o[k]:
+				line+="%s %+7.1f%%  "%(k,(n[k]-o[k])*100.0/o[k])
+
+		print (line)
+
+#####
+#main
+#####
+
+def main():
+	iterations=5
+	warmup=2
+	seed=1
+	entry="send_mails"
+	methods=METHODS
+	jsonfile=None
+	comparefile=None
+
+	try:
+		opts,remainder=getopt.gnu_getopt(sys.argv[1:],
+								'c:e:hi:j:m:s:w:',
+								[	'compare=',
+									'entry=',
+									'help',
+									'iterations=',
+									'json=',
+									'methods=',
+									'seed=',
+									'warmup='])
+	except getopt.GetoptError as e:
+		print (e)
+		print_usage()
+		exit(2)
+
+	for opt,arg in opts:
+
+		if opt in ('-h','--help'):
+			print_usage()
+			exit(0)
+		elif opt in ('-c','--compare'):
+			comparefile=arg
+		elif opt in ('-e','--entry'):
+
+			if arg not in ENTRIES:
+				print_usage()
+				exit(2)
+
+			entry=arg
+		elif opt in ('-i','--iterations'):
+			iterations=int(arg)
+		elif opt in ('-j','--json'):
+			jsonfile=arg
+		elif opt in ('-m','--methods'):
+			methods=[m.strip().upper() for m in arg.split(",")]
+		elif opt in ('-s','--seed'):
+			seed=int(arg)
+		elif opt in ('-w','--warmup'):
+			warmup=int(arg)
+
+	ctx=multiprocessing.get_context("spawn")
+	results={"meta":{	"version":VERSION,
+						"python":platform.python_version(),
+						"platform":platform.platform(),
+						"entry":entry,
+						"seed":seed,
+						"iterations":iterations},
+			"results":{}}
+
+	with tempfile.TemporaryDirectory(prefix="gmebench-") as directory:
+		cfgname=create_home(directory)
+		corpus=build_corpus(seed,os.path.join(directory,"smime","bench.crt"))
+		results["meta"]["corpus"]=[kind for kind,m in corpus]
+
+		for method in methods:
+			outdir=tempfile.mkdtemp(dir=directory)
+			parent_conn,child_conn=ctx.Pipe()
+			p=ctx.Process(target=_child,
+						args=(	child_conn,
+								cfgname,
+								method,
+								entry,
+								corpus,
+								iterations,
+								warmup,
+								outdir))
+			p.start()
+			results["results"][method]=parent_conn.recv()
+			p.join()
+			r=results["results"][method]
+
+			if "msgs_per_s" in r:
+				print ("%s %8.2f msgs/s  p50 %9.3f ms  p99 %9.3f ms  "
+						"peak RSS %i kB"%(	method.ljust(12),
+											r["msgs_per_s"],
+											r["p50_ms"],
+											r["p99_ms"],
+											r["peak_rss_kb"]))
+			else:
+				print ("%s %s"%(method.ljust(12),
+								r.get("skipped",r.get("error"))))
+
+	if jsonfile:
+
+		with open(jsonfile,"w") as f:
+			json.dump(results,f,indent=2,sort_keys=True)
+
+	if comparefile:
+
+		with open(comparefile) as f:
+			compare_results(json.load(f),results)
+
+if __name__ == "__main__":
+	main()
@@ -167,8 +167,19 @@ def start_adminconsole(host,port):
 			print("deluser".ljust(space)+"deletes a user")
 			print("".ljust(space)+"example: 'deluser john'")
 			print("help".ljust(space)+"this help")
+			print("limits".ljust(space)+
+					"print the admission limits, the current values and")
+			print("".ljust(space)+"how often they were exceeded")
 			print("messages".ljust(space)+
 					"shows all systemwarnings and -errors")
+			print("metrics".ljust(space)+
+					"print the duration of the pipeline stages")
+			print("".ljust(space)+"metrics prometheus : prints the metrics")
+			print("".ljust(space)+"     in the Prometheus text format")
+			print("policy".ljust(space)+
+					"explains if and how mails to a recipient are encrypted")
+			print("".ljust(space)+"example: 'policy john@example.com "
+					"[sender@example.com]'")
 			print("quit".ljust(space)+"leave the console")
 			print("quarantine".ljust(space)+
 			"handles the quarantine queue")
@@ -0,0 +1,242 @@
+#License GPL v3
+#Author Horst Knorr <gpgmailencrypt@gmx.de>
+from	.child			import _gmechild
+from	._dbg			import _dbg
+from	.version		import *
+from	collections		import deque
+import	time
+
+#rate limits count the events of the last RATEWINDOW seconds
+RATEWINDOW=60
+#number of clients/senders, after that old entries are removed
+_MAXRATEENTRIES=10000
+
+###########
+#_ADMISSION
+###########
+
+class _ADMISSION(_gmechild):
+	"""
+	admission control of the smtp server. Limits the number of sessions,
+	the messages that are received or processed right now, the bytes of
+	these messages and the connection resp. message rate per client IP
+	and sender.
+	The limits are read from the parent on every check, so that RELOAD
+	changes them. A limit of 0 means unlimited.
+	All methods are called from the asyncore loop.
+	"""
+
+	def __init__(self,parent):
+		_gmechild.__init__(self,parent=parent,filename=__file__)
+		self.sessions=0
+		self.inflight=0
+		self.queuedbytes=0
+		self.rejected={	"sessions":0,
+						"iprate":0,
+						"senderrate":0,
+						"inflight":0,
+						"queuedbytes":0}
+		self._iprates={}
+		self._senderrates={}
+
+	###########
+	#_ratelimit
+	###########
+
+	def _ratelimit(self,table,key,limit):
+		"returns True if 'key' may do another event"
+
+		if limit<=0:
+			return True
+
+		now=time.monotonic()
+
+		if len(table)>_MAXRATEENTRIES:
+
+			for k in list(table.keys()):
+
+				if table[k][-1]<=now-RATEWINDOW:
+					del table[k]
+
+		events=table.setdefault(key,deque())
+
+		while events and events[0]<=now-RATEWINDOW:
+			events.popleft()
+
+		if len(events)>=limit:
+			return False
+
+		events.append(now)
+		return True
+
+	#######
+	#_limit
+	#######
+
+	def _limit(self,value,limit):
+		return limit>0 and value>=limit
+
+	#############
+	#open_session
+	#############
+
+	@_dbg
+	def open_session(self,ip):
+		"""returns None if a new session from 'ip' is allowed,
+		else the smtp reply"""
+
+		if self._limit(self.sessions,self.parent._SMTPD_MAXSESSIONS):
+			self.rejected["sessions"]+=1
+			self.debug("too many sessions, reject '%s'"%ip)
+			return "421 4.3.2 Too many connections, try again later"
+
+		if not self._ratelimit(	self._iprates,
+								ip,
+								self.parent._SMTPD_IPRATELIMIT):
+			self.rejected["iprate"]+=1
+			self.debug("connection rate of '%s' exceeded"%ip)
+			return "421 4.7.0 Connection rate limit exceeded, try again later"
+
+		self.sessions+=1
+		return None
+
+	##############
+	#close_session
+	##############
+
+	@_dbg
+	def close_session(self):
+		self.sessions=max(0,self.sessions-1)
+
+	###########
+	#check_mail
+	###########
+
+	@_dbg
+	def check_mail(self,sender):
+		"""returns None if a new message from 'sender' is allowed,
+		else the smtp reply"""
+		reply=self._check_load()
+
+		if reply!=None:
+			return reply
+
+		if not self._ratelimit(	self._senderrates,
+								sender.lower(),
+								self.parent._SMTPD_SENDERRATELIMIT):
+			self.rejected["senderrate"]+=1
+			self.debug("message rate of '%s' exceeded"%sender)
+			return "451 4.7.1 Message rate limit exceeded, try again later"
+
+		return None
+
+	############
+	#_check_load
+	############
+
+	def _check_load(self):
+
+		if self._limit(self.inflight,self.parent._SMTPD_MAXINFLIGHT):
+			self.rejected["inflight"]+=1
+			self.debug("too many messages in process")
+			return "451 4.3.2 Too many messages in process, try again later"
+
+		if self._limit(self.queuedbytes,self.parent._SMTPD_MAXQUEUEDBYTES):
+			self.rejected["queuedbytes"]+=1
+			self.debug("too many queued bytes")
+			return "451 4.3.1 Insufficient system resources, try again later"
+
+		return None
+
+	##############
+	#start_message
+	##############
+
+	@_dbg
+	def start_message(self):
+		"""returns None if the DATA of a message may be received,
+		else the smtp reply"""
+		reply=self._check_load()
+
+		if reply==None:
+			self.inflight+=1
+
+		return reply
+
+	##########
+	#add_bytes
+	##########
+
+	def add_bytes(self,count):
+		"""adds received bytes of a message.
+		returns False if the limit of queued bytes is exceeded"""
+		self.queuedbytes+=count
+
+		if (self.parent._SMTPD_MAXQUEUEDBYTES>0
+		and self.queuedbytes>self.parent._SMTPD_MAXQUEUEDBYTES):
+			self.rejected["queuedbytes"]+=1
+			return False
+
+		return True
+
+	############
+	#end_message
+	############
+
+	@_dbg
+	def end_message(self,count):
+		"the message with 'count' received bytes is processed"
+		self.inflight=max(0,self.inflight-1)
+		self.release_bytes(count)
+
+	##############
+	#release_bytes
+	##############
+
+	def release_bytes(self,count):
+		"received bytes, that are not in memory anymore"
+		self.queuedbytes=max(0,self.queuedbytes-count)
+
+	#########
+	#_maxrate
+	#########
+
+	def _maxrate(self,table):
+		"returns the number of events of the busiest key"
+		since=time.monotonic()-RATEWINDOW
+		m=0
+
+		for events in table.values():
+			m=max(m,len([e for e in events if e>since]))
+
+		return m
+
+	###########
+	#get_values
+	###########
+
+	def get_values(self):
+		"returns a list of (name,current value,limit,rejected)"
+		p=self.parent
+		return [("sessions",
+					self.sessions,
+					p._SMTPD_MAXSESSIONS,
+					self.rejected["sessions"]),
+				("inflight",
+					self.inflight,
+					p._SMTPD_MAXINFLIGHT,
+					self.rejected["inflight"]),
+				("queuedbytes",
+					self.queuedbytes,
+					p._SMTPD_MAXQUEUEDBYTES,
+					self.rejected["queuedbytes"]),
+				("iprate",
+					self._maxrate(self._iprates),
+					p._SMTPD_IPRATELIMIT,
+					self.rejected["iprate"]),
+				("senderrate",
+					self._maxrate(self._senderrates),
+					p._SMTPD_SENDERRATELIMIT,
+					self.rejected["senderrate"])]
+
+__all__=["_ADMISSION"]
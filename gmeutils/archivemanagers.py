@@ -1,14 +1,28 @@
 #!/usr/bin/env python3
 #License GPL v3
 #Author Horst Knorr <gpgmailencrypt@gmx.de>
+import io
 import os
 import shutil
 import subprocess
 import tempfile
+import zipfile
 from .child 			import _gmechild
 from .version 			import *
 from   ._dbg 			import _dbg
 
+try:
+	import pyzipper
+	_pyzipper_available=True
+except:
+	_pyzipper_available=False
+
+try:
+	import py7zr
+	_py7zr_available=True
+except:
+	_py7zr_available=False
+
 _filecmd=shutil.which("file")
 _use_filecmd=(_filecmd!=None and len(_filecmd)>0)
 
@@ -59,7 +73,7 @@ class _baseunpacker(_gmechild):
 			return False,None
 
 		if directory==None:
-			directory = tempfile.mkdtemp()
+			directory = self.parent._mkdtemp()
 
 		if self.chdir:
 			_origdir=os.getcwd()
@@ -97,7 +111,7 @@ class _basedeleteunpacker(_baseunpacker):
 		result=False
 
 		if directory==None:
-			directory = tempfile.mkdtemp()
+			directory = self.parent._mkdtemp()
 
 		if self.chdir:
 			_origdir=os.getcwd()
@@ -1109,6 +1123,107 @@ class _ZIP(_baseunpacker):
 		"valid ciphers are ZipCrypto,AES128,AES256"
 		self.zipcipher=cipher.upper()
 
+	#################
+	#_native_possible
+	#################
+
+	@_dbg
+	def _native_possible(self,password):
+		"""returns True, if the archive can be created without 7za.
+		Python can't write ZipCrypto archives, AES needs pyzipper"""
+
+		if password==None:
+			return True
+
+		return (self.zipcipher in ["AES128","AES192","AES256"]
+				and _pyzipper_available)
+
+	################
+	#_native_zipdata
+	################
+
+	@_dbg
+	def _native_zipdata(self,members,password=None,compress=True):
+		"""writes the members, a list of 'arcname'/'filename or binary data'
+		tuples, into a zip archive and returns it as binary string"""
+		output=io.BytesIO()
+		compression=zipfile.ZIP_STORED
+		level=None
+
+		if compress:
+			compression=zipfile.ZIP_DEFLATED
+			level=self.parent._ZIPCOMPRESSION
+
+		if password!=None:
+			z=pyzipper.AESZipFile(	output,
+									"w",
+									compression=compression,
+									compresslevel=level)
+			z.setpassword(password.encode("UTF-8"))
+			z.setencryption(pyzipper.WZ_AES,nbits=int(self.zipcipher[3:]))
+		else:
+			z=zipfile.ZipFile(	output,
+								"w",
+								compression=compression,
+								compresslevel=level)
+
+		with z:
+
+			for arcname,content in members:
+
+				if isinstance(content,bytes):
+					z.writestr(arcname,content)
+				else:
+					z.write(content,arcname)
+
+		return output.getvalue()
+
+	###############
+	#create_zipdata
+	###############
+
+	@_dbg
+	def create_zipdata(	self,
+						members,
+						password=None,
+						containerfile=None):
+		"""like create_zipfile, but the content is given as list of
+		'filename'/'binarydata' tuples, no temporary files are needed.
+
+		This functions returns 2 values:
+
+		result : True if everything worked correctly, else False
+		encdata: if 'result' is True encdata returns a binary string with the
+				 zip-file, else None
+		"""
+
+		try:
+
+			if containerfile!=None:
+				inner=self._native_zipdata(members,compress=False)
+				members=[("%s%s"%(containerfile,self.extension),inner)]
+
+			if self._native_possible(password):
+				return True,self._native_zipdata(members,password)
+
+		except:
+			self.log("Archive could not be created","e")
+			self.log_traceback()
+			return False,None
+
+		tempdir=self.parent._mkdtemp()
+
+		try:
+
+			for arcname,content in members:
+
+				with open(os.path.join(tempdir,arcname),"wb") as f:
+					f.write(content)
+
+			return self.create_zipfile(tempdir,password)
+		finally:
+			shutil.rmtree(tempdir,ignore_errors=True)
+
 	###############
 	#create_zipfile
 	###############
@@ -1137,6 +1252,32 @@ class _ZIP(_baseunpacker):
 		encdata: if 'result' is True encdata returns a binary string with the
 				 zip-file, else None
 		"""
+
+		if self._native_possible(password):
+			members=[]
+
+			for root, subdirs, files in os.walk(directory):
+
+				for filename in files:
+					longfilename=os.path.join(root,filename)
+					members.append((os.path.relpath(longfilename,directory),
+									longfilename))
+
+			result,encdata=self.create_zipdata(	members,
+												password=password,
+												containerfile=containerfile)
+
+			if not result or not returnfilename:
+				return result,encdata
+
+			f=self.parent._new_tempfile()
+			f.close()
+
+			with open(f.name+self.extension,"wb") as zf:
+				zf.write(encdata)
+
+			return result,f.name
+
 		f=self.parent._new_tempfile()
 		self.debug("_PDF.create_file _new_tempfile %s"%f.name)
 		f.close()
@@ -1144,27 +1285,27 @@ class _ZIP(_baseunpacker):
 		result=False
 
 		if containerfile!=None:
-			tempdir = tempfile.mkdtemp()
-			fname=os.path.join(tempdir,containerfile)
-			self.debug("ZIP creation command: '%s'" %
-					   ' '.join(self._createzipcommand_fromdir(fname,
-															   directory,
-															   password)))
-			_result = subprocess.call(
-					   ' '.join(self._createzipcommand_fromdir(fname,
-														directory,
-														None,
-														compress=False)),
-						shell=True )
-			directory=tempdir
+			#the inner container is not encrypted, so it is always
+			#created without 7za
+			tempdir = self.parent._mkdtemp()
+			fname=os.path.join(tempdir,containerfile+self.extension)
+			members=[]
 
-			if _result !=0:
-				self.log("Error executing command1"
-								" (Error code %d)"%_result,"e")
-				self.log("%s"%self._createzipcommand_fromdir(fname,
-															   directory,
-															   None,
-															   compress=False))
+			for root, subdirs, files in os.walk(directory):
+
+				for filename in files:
+					longfilename=os.path.join(root,filename)
+					members.append((os.path.relpath(longfilename,directory),
+									longfilename))
+
+			try:
+
+				with open(fname,"wb") as cf:
+					cf.write(self._native_zipdata(members,compress=False))
+
+			except:
+				self.log("Error creating container file","e")
+				self.log_traceback()
 
 				try:
 					shutil.rmtree(tempdir)
@@ -1173,6 +1314,8 @@ class _ZIP(_baseunpacker):
 
 				return result,None
 
+			directory=tempdir
+
 		self.debug("ZIP creation command: '%s'" %
 			' '.join(self._createzipcommand_fromdir(f.name,
 													directory,
@@ -1365,10 +1508,10 @@ class _ZIP(_baseunpacker):
 			return False,None
 
 		if directory==None:
-			directory = tempfile.mkdtemp()
+			directory = self.parent._mkdtemp()
 			self.debug("create end directory %s"%directory)
 
-		directory1=tempfile.mkdtemp()
+		directory1=self.parent._mkdtemp()
 		result=False
 		unzipcmd=self._createunzipcommand_indir(   zipfile,
 															directory1,
@@ -1387,7 +1530,7 @@ class _ZIP(_baseunpacker):
 
 		if containerfile!=None:
 			result=False
-			directory2 = tempfile.mkdtemp()
+			directory2 = self.parent._mkdtemp()
 			unzipcmd=self._createunzipcommand_indir(
 							os.path.join(directory1,"%s%s"%(containerfile,
 															self.extension)),
@@ -1478,54 +1621,68 @@ class _ZIP(_baseunpacker):
 	def decrypt_zipfile(  self,
 							inputfilename,
 							from_addr, to_addr):
-		result=False
-		pw=None
 
-		if hasattr(self.parent._backend,"_textbackend") :
-			pw=self.parent._backend._textbackend.pdf_additionalencryptionkey(None)
+		for source,pw in self.parent._pdfpassword_candidates(from_addr,
+															to_addr):
+			result,fname=self._decrypt_zipfile(inputfilename,password=pw)
 
-			if pw!=None:
-				result,fname=self._decrypt_zipfile(inputfilename,password=pw)
+			if result==True:
+				self.parent._remember_pdfpasswordsource(from_addr,
+														to_addr,
+														source)
+				return result,fname
 
-		if not result:
-			pw=self.parent._backend.get_pdfpassword(from_addr)
+		return False,None
 
-			if pw!=None:
-				result,fname=self._decrypt_zipfile(inputfilename,password=pw)
+##########
+#CLASS _7z
+##########
 
-		if not result:
-			pw=self.parent._backend.get_pdfpassword(to_addr)
+class _7Z(_ZIP):
 
-			if pw!=None:
-				result,fname=self._decrypt_zipfile(inputfilename,password=pw)
+	def __init__(self,parent):
+		_ZIP.__init__(self,parent)
+		self.extension=".7z"
 
-		if not result:
-			pw=self.parent._backend.pdf_additionalencryptionkey(to_addr)
+	#################
+	#_native_possible
+	#################
 
-			if pw!=None:
-				result,fname=self._decrypt_zipfile(inputfilename,password=pw)
+	@_dbg
+	def _native_possible(self,password):
+		return _py7zr_available
 
-		if not result:
-			pw=self.parent._backend.pdf_additionalencryptionkey(from_addr)
+	################
+	#_native_zipdata
+	################
 
-			if pw!=None:
-				result,fname=self._decrypt_zipfile(inputfilename,password=pw)
+	@_dbg
+	def _native_zipdata(self,members,password=None,compress=True):
+		output=io.BytesIO()
 
-		if result==True:
-			return result,fname
+		if compress:
+			filters=[{	"id":py7zr.FILTER_LZMA2,
+						"preset":self.parent._ZIPCOMPRESSION}]
 		else:
-			self.parent._del_tempfile(f.name)
-			return result,None
+			filters=[{"id":py7zr.FILTER_COPY}]
 
-##########
-#CLASS _7z
-##########
+		if password!=None:
+			filters.append({"id":py7zr.FILTER_CRYPTO_AES256_SHA256})
 
-class _7Z(_ZIP):
+		with py7zr.SevenZipFile(output,
+								"w",
+								filters=filters,
+								password=password,
+								header_encryption=(password!=None)) as z:
 
-	def __init__(self,parent):
-		_ZIP.__init__(self,parent)
-		self.extension=".7z"
+			for arcname,content in members:
+
+				if isinstance(content,bytes):
+					z.writestr(content,arcname)
+				else:
+					z.write(content,arcname)
+
+		return output.getvalue()
 
 	##########################
 	#_createzipcommand_fromdir
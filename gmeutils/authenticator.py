@@ -0,0 +1,191 @@
+#License GPL v3
+#Author Horst Knorr <gpgmailencrypt@gmx.de>
+from	.child			import _gmechild
+from	._dbg			import _dbg
+from	.password		import pw_verify,_deprecated_get_hash
+from	.version		import *
+import	concurrent.futures
+import	hashlib
+import	hmac
+import	os
+import	re
+import	threading
+import	time
+
+#hashes of the old sha512 algorithm are 128 hex digits, passlib hashes
+#always start with '$'
+_deprecated_hashformat=re.compile("^[0-9a-f]{128}$")
+
+###################
+#is_deprecated_hash
+###################
+
+def is_deprecated_hash(pwhash):
+	"returns True if 'pwhash' was created with the old sha512 algorithm"
+	return (isinstance(pwhash,str)
+			and _deprecated_hashformat.match(pwhash)!=None)
+
+###############
+#_AUTHENTICATOR
+###############
+
+class _AUTHENTICATOR(_gmechild):
+	"""
+	verifies SMTP AUTH passwords in a thread pool, so that the smtp loop
+	is not blocked, and keeps successfully verified credentials for 'ttl'
+	seconds in memory.
+	Don't call this class directly, use gme._get_authenticator() instead!
+	"""
+
+	def __init__(self,parent,workers=2,ttl=300):
+		_gmechild.__init__(self,parent=parent,filename=__file__)
+		self.workers=workers
+		self.ttl=ttl
+		self._key=os.urandom(32)
+		self._cache=dict()
+		self._lock=threading.Lock()
+		self._executor=None
+
+	########
+	#_digest
+	########
+
+	def _digest(self,user,password):
+		"the cache stores only a keyed hash, never the password"
+		return hmac.new(self._key,
+						("%s\0%s"%(user,password)).encode("UTF-8",
+															unicodeerror),
+						hashlib.sha256).digest()
+
+	#######
+	#cached
+	#######
+
+	@_dbg
+	def cached(self,user,password):
+		"returns True if the credentials were verified recently"
+
+		if self.ttl<=0:
+			return False
+
+		with self._lock:
+			entry=self._cache.get(user)
+
+		if entry==None or entry[1]<time.time():
+			return False
+
+		return hmac.compare_digest(entry[0],self._digest(user,password))
+
+	###########
+	#invalidate
+	###########
+
+	@_dbg
+	def invalidate(self,user=None):
+		"removes 'user' (or all users if None) from the cache"
+
+		with self._lock:
+
+			if user==None:
+				self._cache.clear()
+			else:
+				self._cache.pop(user,None)
+
+	########
+	#_verify
+	########
+
+	def _verify(self,password,pwhash):
+		"""the expensive part, runs in the thread pool.
+		returns result,'True if the hash has to be upgraded'"""
+
+		if is_deprecated_hash(pwhash):
+			return pwhash==_deprecated_get_hash(password),True
+
+		return pw_verify(password,pwhash,parent=self.parent),False
+
+	#######
+	#submit
+	#######
+
+	@_dbg
+	def submit(self,user,password):
+		"""starts the verification in the thread pool.
+		returns True/False if the result is known immediately, else a
+		future, whose result has to be passed to finish()"""
+
+		if self.cached(user,password):
+			self.debug("User '%s' found in authentication cache"%user)
+			return True
+
+		pwhash=self.parent.adm_get_pwhash(user)
+
+		if pwhash==None:
+			return False
+
+		if self._executor==None:
+			self._executor=concurrent.futures.ThreadPoolExecutor(
+									max_workers=self.workers,
+									thread_name_prefix="gmeauth")
+
+		return self._executor.submit(self._verify,password,pwhash)
+
+	#######
+	#finish
+	#######
+
+	@_dbg
+	def finish(self,user,password,future):
+		"""processes the result of a verification. Must be called in the
+		thread that owns the storage backend, because an old password hash
+		will be replaced"""
+
+		try:
+			result,upgrade=future.result()
+		except:
+			self.log("Password verification failed","e")
+			self.log_traceback()
+			return False
+
+		if not result:
+			return False
+
+		if upgrade:
+			self.debug("User '%s' with deprecated password hash algorithm "
+						"authenticated"%user)
+			self.parent.adm_set_user(user,password)
+
+		if self.ttl>0:
+
+			with self._lock:
+				self._cache[user]=(	self._digest(user,password),
+									time.time()+self.ttl)
+
+		return True
+
+	#############
+	#authenticate
+	#############
+
+	@_dbg
+	def authenticate(self,user,password):
+		"verifies the password and waits for the result"
+		f=self.submit(user,password)
+
+		if isinstance(f,bool):
+			return f
+
+		return self.finish(user,password,f)
+
+	######
+	#close
+	######
+
+	@_dbg
+	def close(self):
+
+		if self._executor!=None:
+			self._executor.shutdown(wait=True)
+			self._executor=None
+
+__all__=["_AUTHENTICATOR","is_deprecated_hash"]
@@ -4,6 +4,7 @@
 import email
 import os.path
 from .child 			import _gmechild
+from .helpers 			import message_as_bytes
 from .version 			import *
 
 from .thirdparty		import dkim
@@ -28,18 +29,29 @@ class mydkim(_gmechild):
 			self.log_traceback()
 
 	def sign_mail(self,mail):
-		origmail=email.message_from_string(mail)
+		"signs the mail (string or bytes) and returns it in the same type"
+
+		if isinstance(mail,bytes):
+			origmail=email.message_from_bytes(mail)
+			data=mail
+		else:
+			origmail=email.message_from_string(mail)
+			data=mail.encode("UTF-8",unicodeerror)
 
 		if "DKIM-Signature" in origmail:
 			del origmail["DKIM-Signature"]
 
 		try:
-			_res=dkim.sign(	mail.encode("UTF-8",unicodeerror),
+			_res=dkim.sign(	data,
 						self.selector.encode("UTF-8",unicodeerror),
 						self.domain.encode("UTF-8",unicodeerror),
 						self.privkey).decode("UTF-8",unicodeerror)
 			msg=_res.split(":",1)[1]
 			origmail["DKIM-Signature"]=msg
+
+			if isinstance(mail,bytes):
+				return message_as_bytes(origmail)
+
 			return origmail.as_string()
 		except:
 			self.log("Error executing dkim.sign_mail","e")
@@ -1,7 +1,9 @@
 #License GPL v3
 #Author Horst Knorr <gpgmailencrypt@gmx.de>
+import base64
 import email
 import email.utils
+import hashlib
 from   email.generator	import Generator
 from   io 				import StringIO
 import os
@@ -31,6 +33,7 @@ class _GPG(_gmechild):
 		self.debug("_GPG.__init__")
 		self._localGPGkeys=list()
 		self._local_from_user=None
+		self._additionalkeys=None
 
 		if isinstance(keyhome,str):
 			self._keyhome = os.path.expanduser(keyhome)
@@ -98,6 +101,16 @@ class _GPG(_gmechild):
 			self._recipient=email.utils.parseaddr(recipient)[1]
 			self.parent._GPGkeys = list()
 
+	###################
+	#set_additionalkeys
+	###################
+
+	@_dbg
+	def set_additionalkeys(self,keys):
+		"""sets the additional encryption keys, e.g. of the policy decision.
+		If they are not set, they are read from the storage backend"""
+		self._additionalkeys=keys
+
 	##########
 	#recipient
 	##########
@@ -211,8 +224,9 @@ class _GPG(_gmechild):
 			return
 			
 		if from_user==None:
-			self.parent._GPGkeys = list()
-			keys=self.parent._GPGkeys
+			#the list is published when it is complete, so that other
+			#threads never see a half filled key list
+			keys=list()
 			keyhome=self._keyhome.replace("%user",self._recipient)
 		else:
 			self._localGPGkeys=list()
@@ -273,6 +287,9 @@ class _GPG(_gmechild):
 							"directory '%s'?)"%keyhome,"e")
 			self.log_traceback()
 
+		if from_user==None:
+			self.parent._GPGkeys=keys
+
 	##################
 	#_get_private_keys
 	##################
@@ -393,11 +410,14 @@ class _GPG(_gmechild):
 		f=self.parent._new_tempfile()
 		self.debug("_GPG.encrypt_file _new_tempfile %s"%f.name)
 		f.close()
-		cmd=self._encryptcommand_fromfile(
-							f.name,
-							binary,
-							self.parent.gpg_additionalencryptionkeys(recipient)
-								)
+		additionalkeys=self._additionalkeys
+
+		if additionalkeys==None:
+			additionalkeys=self.parent.gpg_additionalencryptionkeys(recipient)
+
+		cmd=self._encryptcommand_fromfile(	f.name,
+											binary,
+											additionalkeys)
 		self.debug("Encryption command: '%s'" %
 					' '.join(cmd))
 		p1 = subprocess.Popen(	cmd,
@@ -563,7 +583,9 @@ class _GPG(_gmechild):
 		"""
 		messages can contain the public key of the sender address.
 		This function extracts the key and stores it in the directory
-		'targetdir'. 'mail' is a email.message.Message object
+		'targetdir'. 'mail' is a email.message.Message object.
+		Keys that are already stored are skipped, returns the list of
+		written files.
 		"""
 		self.debug("gpgclass extract_publickey_from_mail to '%s'"%targetdir)
 
@@ -574,32 +596,143 @@ class _GPG(_gmechild):
 			self.log("gpgclass mail object of wrong type","e")
 			return None
 
+		keys={".asc":[],".gpg":[]}
+
 		for part in mail.walk():
 			contenttype=part.get_content_type()
 
 			if contenttype!="application/pgp-keys":
 				continue
 
-			filename = part.get_filename()
 			payload=part.get_payload(decode=True)
 
 			if not payload:
 				self.log("pgpkey attachment returned None as payload","e")
 				continue
 
-			targetname=os.path.expanduser(os.path.join(targetdir,filename))
+			fingerprint=_pgp_fingerprint(payload)
+
+			if fingerprint==None:
+				#unknown key format, at least the same file is not
+				#stored twice
+				fingerprint=hashlib.sha256(payload).hexdigest()
+
+			if b"-----BEGIN PGP" in payload:
+				keys[".asc"].append((fingerprint,payload))
+			else:
+				keys[".gpg"].append((fingerprint,payload))
+
+		written=[]
+
+		for extension in keys:
+
+			if len(keys[extension])>0:
+				written+=self.parent._keyindex.store(targetdir,
+													keys[extension],
+													extension)
+
+		return written
+
+#############
+#_pgp_dearmor
+#############
+
+def _pgp_dearmor(data):
+	"returns the binary data of an ascii armored block or 'data' itself"
+	found=re.search(b"-----BEGIN PGP [A-Z ]+-----\r?\n(.*?)-----END PGP",
+					data,
+					re.DOTALL)
+
+	if found==None:
+		return data
+
+	block=found.group(1)
+	#the armor headers end with an empty line
+	parts=re.split(b"\r?\n[ \t]*\r?\n",block,1)
+
+	if len(parts)==2:
+		block=parts[1]
+
+	lines=[l.strip() for l in block.splitlines()]
+	#the line with the checksum starts with '='
+	return base64.b64decode(b"".join(l for l in lines
+										if len(l)>0 and not l.startswith(b"=")))
+
+#################
+#_pgp_fingerprint
+#################
+
+def _pgp_fingerprint(data):
+	"""returns the fingerprint of the first public key packet in 'data'
+	(RFC 4880 and RFC 9580) or None"""
+
+	try:
+		data=_pgp_dearmor(data)
+	except ValueError:
+		return None
+
+	pos=0
+
+	while pos<len(data):
+		b=data[pos]
+
+		if not b&0x80:
+			return None
+
+		try:
+
+			if b&0x40:
+				#new packet format
+				tag=b&0x3f
+				l=data[pos+1]
+
+				if l<192:
+					length=l
+					pos+=2
+				elif l<224:
+					length=((l-192)<<8)+data[pos+2]+192
+					pos+=3
+				elif l==255:
+					length=int.from_bytes(data[pos+2:pos+6],"big")
+					pos+=6
+				else:
+					#partial body length, not used for keys
+					return None
+
+			else:
+				tag=(b>>2)&0x0f
+				n=(1,2,4,0)[b&3]
+
+				if n==0:
+					return None
+
+				length=int.from_bytes(data[pos+1:pos+1+n],"big")
+				pos+=1+n
+
+		except IndexError:
+			return None
+
+		body=data[pos:pos+length]
+
+		if len(body)!=length or length==0:
+			return None
 
-			try:
+		if tag==6:
 
-				with open(targetname,"wb") as f:
-					f.write(payload)
+			if body[0]==4:
+				h=hashlib.sha1(b"\x99"+length.to_bytes(2,"big")+body)
+			elif body[0]==5:
+				h=hashlib.sha256(b"\x9a"+length.to_bytes(4,"big")+body)
+			elif body[0]==6:
+				h=hashlib.sha256(b"\x9b"+length.to_bytes(4,"big")+body)
+			else:
+				return None
 
-				self.debug("write to file %s"%targetname)
+			return h.hexdigest().upper()
 
-			except:
-				self.log("gpg key could not be written","e")
-				self.log_traceback()
+		pos+=length
 
+	return None
 
 #############################
 #CLASS GPGENCRYPTEDATTACHMENT
@@ -654,16 +787,16 @@ class _GPGEncryptedAttachment(email.message.Message,_gmechild):
 	###############
 
 	def _write_headers(self,g):
-		print ("Content-Type: application/pgp-encrypted",file=g._fp)
-		print ("Content-Description: PGP/MIME version identification\r\n"
-				"\r\nVersion: 1\r\n",file=g._fp)
-		print ("--%s"%self._masterboundary,file=g._fp)
+		#g.write works with the Generator and the BytesGenerator
+		g.write("Content-Type: application/pgp-encrypted\n")
+		g.write("Content-Description: PGP/MIME version identification\r\n"
+				"\r\nVersion: 1\r\n\n")
+		g.write("--%s\n"%self._masterboundary)
 		fname=self.get_filename()
 
 		if fname == None:
 			fname="encrypted.asc"
 
-		print ('Content-Type: application/octet-stream; name="%s"'%fname,
-																file=g._fp)
-		print ('Content-Description: OpenPGP encrypted message',file=g._fp)
-		print ('Content-Disposition: inline; filename="%s"\r\n'%fname,file=g._fp)
+		g.write('Content-Type: application/octet-stream; name="%s"\n'%fname)
+		g.write('Content-Description: OpenPGP encrypted message\n')
+		g.write('Content-Disposition: inline; filename="%s"\r\n\n'%fname)
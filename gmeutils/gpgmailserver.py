@@ -11,8 +11,74 @@ import smtpd
 import socket
 import ssl
 import sys
+import threading
+from	.admission		import _ADMISSION
+from	.mailstore		import _MAILSTORE
 from	.version		import *
-from .password        import pw_verify,_deprecated_get_hash
+
+###########
+#_loopwaker
+###########
+
+class _loopwaker(asyncore.dispatcher):
+	"""runs functions, that are handed over from other threads,
+	in the thread of the asyncore loop"""
+
+	def __init__(self):
+		self._sender,receiver=socket.socketpair()
+		self._sender.setblocking(False)
+		asyncore.dispatcher.__init__(self,receiver)
+		self._lock=threading.Lock()
+		self._calls=[]
+
+	#####
+	#call
+	#####
+
+	def call(self,function):
+		"queues 'function' and wakes up the loop, thread safe"
+
+		with self._lock:
+			self._calls.append(function)
+
+		try:
+			self._sender.send(b"\0")
+		except (BlockingIOError,OSError):
+			#the loop is already woken up or the waker is closed
+			pass
+
+	#########
+	#writable
+	#########
+
+	def writable(self):
+		return False
+
+	############
+	#handle_read
+	############
+
+	def handle_read(self):
+
+		try:
+			self.recv(4096)
+		except BlockingIOError:
+			pass
+
+		with self._lock:
+			calls=self._calls
+			self._calls=[]
+
+		for function in calls:
+			function()
+
+	######
+	#close
+	######
+
+	def close(self):
+		asyncore.dispatcher.close(self)
+		self._sender.close()
 
 ######################
 #_gpgmailencryptserver
@@ -25,7 +91,10 @@ class _gpgmailencryptserver(smtpd.SMTPServer):
 					"DEBUG",
 					"DELUSER",
 					"FLUSH",
+					"LIMITS",
 					"MESSAGES",
+					"METRICS",
+					"POLICY",
 					"RELOAD",
 					"RESETMESSAGES",
 					"RESETSTATISTICS",
@@ -45,14 +114,31 @@ class _gpgmailencryptserver(smtpd.SMTPServer):
 			use_tls=False,
 			use_auth=False,
 			force_tls=False,
-			data_size_limit=smtpd.DATA_SIZE_DEFAULT):
+			data_size_limit=smtpd.DATA_SIZE_DEFAULT,
+			sock=None):
+
+		smtputf8=parent!=None and parent._SMTPD_SMTPUTF8
 
 		try:
-			smtpd.SMTPServer.__init__(  self,
-										localaddr,
-										None,
-										data_size_limit=data_size_limit,
-										decode_data=True)
+
+			if sock!=None:
+				#the listening socket is shared with other worker processes
+				asyncore.dispatcher.__init__(self,sock)
+				self.accepting=True
+				self._localaddr=localaddr
+				self._remoteaddr=None
+				self.data_size_limit=data_size_limit
+				self.enable_SMTPUTF8=smtputf8
+				#the mails are received as bytes
+				self._decode_data=False
+			else:
+				smtpd.SMTPServer.__init__(  self,
+											localaddr,
+											None,
+											data_size_limit=data_size_limit,
+											enable_SMTPUTF8=smtputf8,
+											decode_data=False)
+
 		except socket.error as e:
 
 			if parent:
@@ -61,6 +147,7 @@ class _gpgmailencryptserver(smtpd.SMTPServer):
 
 		smtpd.__version__="gpgmailencrypt smtp server %s"%VERSION
 		self.parent=parent
+		self.admission=_ADMISSION(parent=parent)
 		self.sslcertfile=None
 
 		if self.parent:
@@ -88,6 +175,7 @@ class _gpgmailencryptserver(smtpd.SMTPServer):
 				self.force_tls=force_tls
 
 		self.use_authentication=use_auth
+		self._waker=None
 		_sslpossible=True
 
 		try:
@@ -116,6 +204,18 @@ class _gpgmailencryptserver(smtpd.SMTPServer):
 	def start(self):
 		asyncore.loop()
 
+	######
+	#close
+	######
+
+	def close(self):
+
+		if self._waker!=None:
+			self._waker.close()
+			self._waker=None
+
+		smtpd.SMTPServer.close(self)
+
 	#####################
 	#create_sslconnection
 	#####################
@@ -169,6 +269,18 @@ class _gpgmailencryptserver(smtpd.SMTPServer):
 					if conn==None:
 						return
 
+			reply=self.admission.open_session(addr[0])
+
+			if reply!=None:
+
+				try:
+					conn.sendall(("%s\r\n"%reply).encode("UTF-8"))
+					conn.close()
+				except:
+					pass
+
+				return
+
 			self.parent.debug("Incoming connection "
 								"from %s" % repr(addr),filename=__file__,lineno=inspect.currentframe().f_lineno)
 			_hksmtpchannel(self,
@@ -190,7 +302,8 @@ class _gpgmailencryptserver(smtpd.SMTPServer):
 							peer,
 							mailfrom,
 							recipient,
-							data):
+							data,
+							**kwargs):
 		self.parent.debug("_gpgmailencryptserver "
 						"from '%s' to '%s'"%(mailfrom,recipient),filename=__file__,lineno=inspect.currentframe().f_lineno)
 
@@ -212,15 +325,8 @@ class _gpgmailencryptserver(smtpd.SMTPServer):
 					password):
 		"checks user authentication against a password file"
 		self.parent.debug("authenticate",filename=__file__,lineno=inspect.currentframe().f_lineno)
-		pw=self.parent.adm_get_pwhash(user)
-
-		if pw==_deprecated_get_hash(password):
 
-			self.parent.debug("mailencryptserver: User '%s' with deprecated password hash algorithm authenticated"%user,filename=__file__,lineno=inspect.currentframe().f_lineno)
-			self.parent.adm_set_user(user,password)
-			pw=self.parent.adm_get_pwhash(user)
-
-		if pw_verify(password,pw,parent=self.parent):
+		if self.parent._get_authenticator().authenticate(user,password):
 			self.parent.debug("mailencryptserver: User '%s' password verifed"
 								%user,filename=__file__,lineno=inspect.currentframe().f_lineno)
 			return True
@@ -228,6 +334,32 @@ class _gpgmailencryptserver(smtpd.SMTPServer):
 		self.parent.debug("mailencryptserver: User '%s' password wrong"%user,filename=__file__,lineno=inspect.currentframe().f_lineno)
 		return False
 
+	###################
+	#authenticate_async
+	###################
+
+	def authenticate_async(	self,
+							user,
+							password,
+							callback):
+		"""verifies the password in the thread pool of the authenticator,
+		callback(result) is called in the thread of the asyncore loop"""
+		self.parent.debug("authenticate_async",filename=__file__,lineno=inspect.currentframe().f_lineno)
+		authenticator=self.parent._get_authenticator()
+		future=authenticator.submit(user,password)
+
+		if isinstance(future,bool):
+			callback(future)
+			return
+
+		if self._waker==None:
+			self._waker=_loopwaker()
+
+		def _done():
+			callback(authenticator.finish(user,password,future))
+
+		future.add_done_callback(lambda f:self._waker.call(_done))
+
 
 ###############
 #_hksmtpchannel
@@ -248,7 +380,18 @@ class _hksmtpchannel(smtpd.SMTPChannel):
 				sslcertfile=None,
 				sslkeyfile=None,
 				sslversion=None):
-		smtpd.SMTPChannel.__init__(self, smtp_server, newsocket, fromaddr, decode_data=True)
+		#used by readable() and _set_post_data_state(), that are already
+		#called in the constructors of the base classes
+		self._authpending=False
+		self._inmessage=False
+		self._mailstore=None
+		self._session=True
+		smtpd.SMTPChannel.__init__(	self,
+									smtp_server,
+									newsocket,
+									fromaddr,
+									enable_SMTPUTF8=smtp_server.enable_SMTPUTF8,
+									decode_data=False)
 		asynchat.async_chat.__init__(self, newsocket)
 		self.parent=parent
 		self.sslcertfile=sslcertfile
@@ -265,8 +408,12 @@ class _hksmtpchannel(smtpd.SMTPChannel):
 		self.user=""
 		self.password=""
 		self.in_loginauth=0 # 0=False, 1 get user, 2 get password
+		self._pendinglines=[]
+		self._databytes=0
+		self._dataoverload=False
+		self._datatoobig=False
 		self.seen_greeting=False
-		self.data_size_limit=0
+		self.data_size_limit=self._max_message_size()
 		self.fqdn=socket.getfqdn()
 		_sslpossible=True
 
@@ -285,13 +432,42 @@ class _hksmtpchannel(smtpd.SMTPChannel):
 		if _sslpossible and self.sslversion:
 			self.starttls_available=True
 
+	##################
+	#_max_message_size
+	##################
+
+	def _max_message_size(self):
+		"""returns the size limit of a message, that is advertised with SIZE.
+		Mails that are not spilled to disk must fit into maxqueuedbytes"""
+		size=self.parent._SMTPD_MAXMESSAGESIZE
+		queued=self.parent._SMTPD_MAXQUEUEDBYTES
+		spill=self.parent._SMTPD_SPILLSIZE
+
+		if queued>0 and (spill<=0 or spill>=queued):
+
+			if size<=0 or size>queued:
+				size=queued
+
+		return size
+
+	#########
+	#readable
+	#########
+
+	def readable(self):
+
+		if self._authpending:
+			return False
+
+		return smtpd.SMTPChannel.readable(self)
+
 	######################
 	#collect_incoming_data
 	######################
 
-	#the following method is taken from SMTPChannel and is corrected to not
-	#throw an encoding error if something else than unciode comes
-	#through the line
+	#the following method is taken from SMTPChannel and is extended by the
+	#admission control. The data stays bytes, commands are decoded in
+	#found_terminator
 	def collect_incoming_data(self, data):
 		limit = None
 
@@ -305,29 +481,82 @@ class _hksmtpchannel(smtpd.SMTPChannel):
 		elif limit:
 			self.num_bytes += len(data)
 
-		encodeddata=None
+		if self.smtp_state==self.DATA and self._inmessage:
 
-		for e in [  "UTF-8",
-					"ISO8859-15",
-					"UTF-16"]:
+			if self._dataoverload:
+				return
 
-			try:
-				encodeddata=data.decode(e,unicodeerror)
-				break
-			except:
-				pass
+			if self._mailstore!=None and self._mailstore.spilled():
+				#the mail is written to disk and doesn't use memory anymore
+				self._mailstore.write(data)
+				return
+
+			self._databytes+=len(data)
+
+			if not self.smtp_server.admission.add_bytes(len(data)):
+				#drop the message to free the memory, the client gets
+				#an error after the end of DATA. If the message alone is
+				#bigger than the limit, a retry can't succeed
+				self._dataoverload=True
+				self._datatoobig=(self._databytes>
+									self.parent._SMTPD_MAXQUEUEDBYTES)
+				self.received_lines=[]
+				self._close_mailstore()
+				self.smtp_server.admission.release_bytes(self._databytes)
+				self._databytes=0
+				return
+
+			if self._mailstore!=None:
+				self._mailstore.write(data)
 
-		if encodeddata==None:
-			encodeddata=data.decode("UTF-8",unicodeerror)
+				if self._mailstore.spilled():
+					self.smtp_server.admission.release_bytes(self._databytes)
+					self._databytes=0
 
-		self.received_lines.append(encodeddata)
+				return
+
+		self.received_lines.append(data)
 
 	#################
 	#found_terminator
 	#################
 
 	def found_terminator(self):
-		line = "".join(self._SMTPChannel__line)
+
+		if self._authpending:
+			#pipelined commands must wait for the authentication result
+			self._pendinglines.append(self._SMTPChannel__line)
+			self._SMTPChannel__line=[]
+			return
+
+		if self.smtp_state==self.DATA and self._dataoverload:
+
+			if self._datatoobig:
+				self.parent.log("Message from '%s' rejected, bigger than "
+								"maxqueuedbytes"%self.mailfrom,"w",filename=__file__,lineno=inspect.currentframe().f_lineno)
+				self._set_rset_state()
+				self.push("552 5.3.4 Message too big for system")
+				return
+
+			self.parent.log("Message from '%s' dropped, too many queued bytes"
+							%self.mailfrom,"w",filename=__file__,lineno=inspect.currentframe().f_lineno)
+			self._set_rset_state()
+			self.push("451 4.3.1 Insufficient system resources, "
+						"try again later")
+			return
+
+		if self.smtp_state==self.DATA and self._mailstore!=None:
+			self._process_data()
+			return
+
+		if self.smtp_state!=self.COMMAND:
+			smtpd.SMTPChannel.found_terminator(self)
+			return
+
+		#don't throw an encoding error if something else than unicode
+		#comes through the line
+		line=b"".join(self._SMTPChannel__line).decode("UTF-8",unicodeerror)
+		self._SMTPChannel__line=[line.encode("UTF-8")]
 		i = line.find(' ')
 
 		if i < 0:
@@ -358,21 +587,9 @@ class _hksmtpchannel(smtpd.SMTPChannel):
 				elif self.in_loginauth==2:
 					self.password=binascii.a2b_base64(
 										line).decode("UTF-8",unicodeerror)
-
-					if self.smtp_server.authenticate(
-										self.user,
-										self.password):
-						self.push("235 Authentication successful.")
-						self.is_authenticated=True
-						self.is_admin=self.parent.is_admin(self.user)
-					else:
-						self.push("454 Temporary authentication failure.")
-						self.parent.log(
-							"User '%s' failed to AUTH LOGIN login"%self.user
-							,"w",filename=__file__,lineno=inspect.currentframe().f_lineno)
-
 					self.in_loginauth=0
 					self._SMTPChannel__line=[]
+					self._start_auth(self.user,self.password,"LOGIN")
 					return
 
 			if not command in (SIMPLECOMMANDS+["AUTH"]):
@@ -399,6 +616,151 @@ class _hksmtpchannel(smtpd.SMTPChannel):
 
 		smtpd.SMTPChannel.found_terminator(self)
 
+	##############
+	#_process_data
+	##############
+
+	def _process_data(self):
+		"""the end of DATA, taken from SMTPChannel.found_terminator, but the
+		mail comes from the mail store"""
+		self._SMTPChannel__line=[]
+
+		if self.data_size_limit and self.num_bytes > self.data_size_limit:
+			self.push('552 Error: Too much mail data')
+			self.num_bytes = 0
+			self._set_post_data_state()
+			return
+
+		self._mailstore.finish()
+		status = self.smtp_server.process_message(
+										self.peer,
+										self.mailfrom,
+										self.rcpttos,
+										self._mailstore,
+										mail_options=self.mail_options,
+										rcpt_options=self.rcpt_options)
+		self._set_post_data_state()
+
+		if not status:
+			self.push('250 OK')
+		else:
+			self.push(status)
+
+	#################
+	#_close_mailstore
+	#################
+
+	def _close_mailstore(self):
+
+		if self._mailstore!=None:
+			self._mailstore.close()
+			self._mailstore=None
+
+	############
+	#_start_auth
+	############
+
+	def _start_auth(self,user,password,mechanism):
+		"password verification runs outside of the asyncore loop"
+		self._authpending=True
+		self.smtp_server.authenticate_async(
+						user,
+						password,
+						lambda result:self._auth_done(user,result,mechanism))
+
+	###########
+	#_auth_done
+	###########
+
+	def _auth_done(self,user,result,mechanism):
+		self._authpending=False
+
+		if not self.connected:
+			self._pendinglines=[]
+			return
+
+		if result:
+			self.push("235 Authentication successful.")
+			self.is_authenticated=True
+			self.is_admin=self.parent.is_admin(user)
+			self.user=user
+
+			if self.is_admin:
+				self.parent.log("admin user '%s' logged in"%user,filename=__file__,lineno=inspect.currentframe().f_lineno)
+			else:
+				self.parent.log("User '%s' successfully logged in"%user,filename=__file__,lineno=inspect.currentframe().f_lineno)
+
+		else:
+			self.push("454 Temporary authentication failure.")
+
+			if mechanism=="LOGIN":
+				self.parent.log("User '%s' failed to AUTH LOGIN login"%user,"w",filename=__file__,lineno=inspect.currentframe().f_lineno)
+			else:
+				self.parent.log("User '%s' failed to login"%user,"w",filename=__file__,lineno=inspect.currentframe().f_lineno)
+
+		while self._pendinglines and not self._authpending:
+			self._SMTPChannel__line=self._pendinglines.pop(0)
+			self.found_terminator()
+
+	#####################
+	#_set_post_data_state
+	#####################
+
+	def _set_post_data_state(self):
+		"called after the message was processed and by RSET"
+
+		if self._inmessage:
+			self.smtp_server.admission.end_message(self._databytes)
+			self._inmessage=False
+			self._databytes=0
+			self._dataoverload=False
+			self._datatoobig=False
+
+		self._close_mailstore()
+		smtpd.SMTPChannel._set_post_data_state(self)
+
+	######
+	#close
+	######
+
+	def close(self):
+
+		if self._inmessage:
+			self.smtp_server.admission.end_message(self._databytes)
+			self._inmessage=False
+			self._databytes=0
+
+		self._close_mailstore()
+
+		if self._session:
+			self.smtp_server.admission.close_session()
+			self._session=False
+
+		smtpd.SMTPChannel.close(self)
+
+	######################
+	#_forward_admincommand
+	######################
+
+	def _forward_admincommand(self,command,arg):
+		"""in a worker process of the multi-process daemon the command is
+		executed by the supervisor. Returns False if the command has to be
+		executed here"""
+
+		if self.parent._controlchannel==None:
+			return False
+
+		lines=self.parent._controlchannel.admin(command,arg)
+
+		if lines==None:
+			self.push("451 4.3.0 Supervisor not reachable, try again later")
+		else:
+
+			for l in lines:
+				self.push(l)
+
+		return True
+
 	######
 	#_dash
 	######
@@ -473,9 +835,17 @@ class _hksmtpchannel(smtpd.SMTPChannel):
 				   and (not self.force_tls
 				   or (self.force_tls and self.tls_active))
 			  )
-		countentries=  _starttls+_size+_auth
+		_smtputf8=self.enable_SMTPUTF8
+		countentries=  _starttls+_size+_auth+1+_smtputf8
 		self.push('250%s%s' % (self._dash(countentries),self.fqdn) )
 		countentries-=1
+		self.push('250%s8BITMIME'%self._dash(countentries))
+		countentries-=1
+
+		if _smtputf8:
+			self.push('250%sSMTPUTF8'%self._dash(countentries))
+			self.command_size_limits['MAIL']=self.command_size_limit+10
+			countentries-=1
 
 		if _starttls:
 			self.push('250%sSTARTTLS'%self._dash(countentries))
@@ -499,6 +869,50 @@ class _hksmtpchannel(smtpd.SMTPChannel):
 		self.reset_values()
 		smtpd.SMTPChannel.smtp_RSET(self,arg)
 
+	##########
+	#smtp_MAIL
+	##########
+
+	def smtp_MAIL(self,arg):
+
+		if self.seen_greeting and arg and not self.mailfrom:
+			address,params=self._getaddr(
+								self._strip_command_keyword("FROM:",arg))
+
+			if address:
+				reply=self.smtp_server.admission.check_mail(address)
+
+				if reply!=None:
+					self.push(reply)
+					return
+
+		smtpd.SMTPChannel.smtp_MAIL(self,arg)
+
+	##########
+	#smtp_DATA
+	##########
+
+	def smtp_DATA(self,arg):
+
+		if self.seen_greeting and self.rcpttos and not arg:
+			reply=self.smtp_server.admission.start_message()
+
+			if reply!=None:
+				self.push(reply)
+				return
+
+			self._inmessage=True
+			self._databytes=0
+			self._dataoverload=False
+			self._datatoobig=False
+
+		smtpd.SMTPChannel.smtp_DATA(self,arg)
+
+		if self.smtp_state==self.DATA:
+			#big mails are spilled to disk while they are received
+			self._mailstore=_MAILSTORE(	parent=self.parent,
+										spillsize=self.parent._SMTPD_SPILLSIZE)
+
 	##########
 	#smtp_AUTH
 	##########
@@ -563,21 +977,7 @@ class _hksmtpchannel(smtpd.SMTPChannel):
 
 			user=d[0]
 			password=d[1]
-
-			if (self.smtp_server.authenticate(user,password)):
-				self.push("235 Authentication successful.")
-				self.is_authenticated=True
-				self.is_admin=self.parent.is_admin(user)
-				self.user=user
-
-				if self.is_admin:
-					self.parent.log("admin user '%s' logged in"%user,filename=__file__,lineno=inspect.currentframe().f_lineno)
-				else:
-					self.parent.log("User '%s' successfully logged in"%user,filename=__file__,lineno=inspect.currentframe().f_lineno)
-
-			else:
-				self.push("454 Temporary authentication failure.")
-				self.parent.log("User '%s' failed to login"%user,"w",filename=__file__,lineno=inspect.currentframe().f_lineno)
+			self._start_auth(user,password,"PLAIN")
 
 		else:
 			self.push("454 Temporary authentication failure.")
@@ -636,6 +1036,10 @@ class _hksmtpchannel(smtpd.SMTPChannel):
 	################
 
 	def smtp_QUARANTINE(self,arg):
+
+		if self._forward_admincommand("QUARANTINE",arg):
+			return
+
 		syntaxerror=("501 Syntax error: QUARANTINE SHOW|DELETE xxx|RELEASE xxx"
 			"|FORWARD xxx email@tld")
 
@@ -741,6 +1145,9 @@ class _hksmtpchannel(smtpd.SMTPChannel):
 
 	def smtp_STATISTICS(self,arg):
 
+		if self._forward_admincommand("STATISTICS",arg):
+			return
+
 		if arg:
 			self.push("501 Syntax error: no arguments allowed")
 			return
@@ -762,6 +1169,86 @@ class _hksmtpchannel(smtpd.SMTPChannel):
 									str(statistics[s]).rjust(4)) )
 			c+=1
 
+	#############
+	#smtp_METRICS
+	#############
+
+	def smtp_METRICS(self,arg):
+
+		if arg and arg.strip().upper()=="PROMETHEUS":
+			lines=self.parent._metrics.get_prometheus().splitlines()
+		elif arg:
+			self.push("501 Syntax error: only argument 'prometheus' allowed")
+			return
+		else:
+			metrics=self.parent.get_metrics()
+			lines=["gpgmailencrypt version %s (%s)"%(VERSION,DATE),
+					"%s%s%s%s%s%s"%("stage".ljust(10),
+									"count".rjust(8),
+									"avg ms".rjust(10),
+									"p50 ms".rjust(10),
+									"p99 ms".rjust(10),
+									"max ms".rjust(10))]
+
+			for s in self.parent._metrics.STAGES:
+				st=metrics["stages"][s]
+				lines.append("%s%s%s%s%s%s"%(
+									s.ljust(10),
+									str(st["count"]).rjust(8),
+									("%.1f"%(st["avg"]*1000)).rjust(10),
+									("%.1f"%(st["p50"]*1000)).rjust(10),
+									("%.1f"%(st["p99"]*1000)).rjust(10),
+									("%.1f"%(st["max"]*1000)).rjust(10)))
+
+			lines.append("%s%s"%("queue".ljust(25),
+								str(metrics["queue"]).rjust(4)))
+			lines.append("%s%s"%("deferred".ljust(25),
+								str(metrics["deferred"]).rjust(4)))
+			lines.append("%s%s"%("inflight".ljust(25),
+								str(metrics["inflight"]).rjust(4)))
+
+			for p in sorted(metrics["spawns"]):
+				lines.append("%s%s"%(("spawned %s"%p).ljust(25),
+									str(metrics["spawns"][p]).rjust(4)))
+
+		c=len(lines)-1
+
+		for l in lines:
+			self.push("250%s%s"%(self._dash(c),l))
+			c-=1
+
+	############
+	#smtp_LIMITS
+	############
+
+	def smtp_LIMITS(self,arg):
+
+		if arg:
+			self.push("501 Syntax error: no arguments allowed")
+			return
+
+		lines=["%s%s%s%s"%(	"limit".ljust(16),
+							"current".rjust(12),
+							"maximum".rjust(12),
+							"rejected".rjust(10))]
+
+		for name,current,limit,rejected in (
+							self.smtp_server.admission.get_values()):
+
+			if limit<=0:
+				limit="-"
+
+			lines.append("%s%s%s%s"%(	name.ljust(16),
+										str(current).rjust(12),
+										str(limit).rjust(12),
+										str(rejected).rjust(10)))
+
+		c=len(lines)-1
+
+		for l in lines:
+			self.push("250%s%s"%(self._dash(c),l))
+			c-=1
+
 	##############
 	#smtp_MESSAGES
 	##############
@@ -796,17 +1283,47 @@ class _hksmtpchannel(smtpd.SMTPChannel):
 	###########
 
 	def smtp_FLUSH(self,arg):
+
+		if self._forward_admincommand("FLUSH",arg):
+			return
+
 		self.parent.log("FLUSH",filename=__file__,lineno=inspect.currentframe().f_lineno)
 		self.parent.check_deferred_list()
 		self.parent.check_mailqueue()
 		self.push("250 OK")
 
+	############
+	#smtp_POLICY
+	############
+
+	def smtp_POLICY(self,arg):
+
+		if not arg or len(arg.split())>2:
+			self.push("501 Syntax error: POLICY recipient [sender]")
+			return
+
+		args=arg.split()
+		from_addr=None
+
+		if len(args)>1:
+			from_addr=args[1]
+
+		lines=self.parent.explain_policy(args[0],from_addr)
+		c=len(lines)-1
+
+		for l in lines:
+			self.push("250%s%s"%(self._dash(c),l))
+			c-=1
+
 	############
 	#smtp_RELOAD
 	############
 
 	def smtp_RELOAD(self,arg):
 
+		if self._forward_admincommand("RELOAD",arg):
+			return
+
 		if arg:
 			self.push("501 Syntax error: no arguments allowed")
 			return
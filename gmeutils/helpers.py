@@ -4,6 +4,7 @@ import base64
 import binascii
 from email import header
 import email
+import email.generator
 import email.utils
 import hashlib
 import html
@@ -687,6 +688,44 @@ def decodetxt( text,
 
 	return result.decode(charset,unicodeerror)
 
+#################
+#message_as_bytes
+#################
+
+def message_as_bytes(message):
+	"""returns the email.message as bytes. 8bit parts, that were parsed
+	from bytes, are written unchanged"""
+
+	f=BytesIO()
+	write_message(f,message)
+	return f.getvalue()
+
+##############
+#write_message
+##############
+
+def write_message(f,message):
+	"""writes the email.message to the binary file 'f' without creating
+	a copy in memory"""
+
+	try:
+		email.generator.BytesGenerator(	f,
+										mangle_from_=False,
+										policy=message.policy).flatten(message)
+	except UnicodeEncodeError:
+		#parsed from a string with non ascii characters
+		f.seek(0)
+		f.truncate()
+		f.write(message.as_string().encode("UTF-8",unicodeerror))
+
+########
+#is_8bit
+########
+
+def is_8bit(data):
+	"returns True if the bytes 'data' contain non ascii characters"
+	return re.search(b"[\x80-\xff]",data)!=None
+
 ##############
 #is_attachment
 ##############
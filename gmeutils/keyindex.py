@@ -0,0 +1,118 @@
+#License GPL v3
+#Author Horst Knorr <gpgmailencrypt@gmx.de>
+from	.child			import _gmechild
+from	._dbg			import _dbg
+from	.version		import *
+import	os
+import	threading
+
+##########
+#_KEYINDEX
+##########
+
+class _KEYINDEX(_gmechild):
+	"""
+	fingerprints of the public keys, that were extracted from mails.
+	The extracted keys are stored with their fingerprint as file name,
+	so the index of a directory is read once with os.listdir and a key,
+	that is already known, is not written again.
+	The os.listdir snapshot is taken once per process and never refreshed,
+	keys that other processes write or remove later are not seen.
+	Fingerprints are compared upper case and without colons, so that
+	files named like openssl's 'AB:CD:...' fingerprint are recognized.
+	"""
+
+	def __init__(self,parent):
+		_gmechild.__init__(self,parent=parent,filename=__file__)
+		self._directories={}
+		self._lock=threading.Lock()
+
+	###########
+	#_normalize
+	###########
+
+	def _normalize(self,fingerprint):
+		return fingerprint.replace(":","").upper()
+
+	##############
+	#_fingerprints
+	##############
+
+	def _fingerprints(self,directory):
+		"the lock must be held by the caller"
+
+		if directory not in self._directories:
+
+			try:
+				names=os.listdir(directory)
+			except OSError:
+				names=[]
+
+			self._directories[directory]=set(
+							self._normalize(os.path.splitext(n)[0])
+							for n in names)
+			self.debug("_KEYINDEX %i keys in '%s'"%(
+								len(self._directories[directory]),
+								directory))
+
+		return self._directories[directory]
+
+	######
+	#known
+	######
+
+	def known(self,directory,fingerprint):
+		"returns True if the key is already stored in 'directory'"
+
+		with self._lock:
+			return self._normalize(fingerprint) in self._fingerprints(
+											os.path.expanduser(directory))
+
+	######
+	#store
+	######
+
+	@_dbg
+	def store(self,directory,keys,extension):
+		"""writes the new keys of the list 'keys' of (fingerprint,data)
+		tuples into 'directory' and returns the written file names"""
+		directory=os.path.expanduser(directory)
+		new=[]
+
+		with self._lock:
+			fingerprints=self._fingerprints(directory)
+
+			for fingerprint,data in keys:
+				fingerprint=self._normalize(fingerprint)
+
+				if fingerprint in fingerprints:
+					self.debug("key %s already known"%fingerprint)
+					continue
+
+				fingerprints.add(fingerprint)
+				new.append((fingerprint,data))
+
+		written=[]
+
+		for fingerprint,data in new:
+			targetname=os.path.join(directory,fingerprint+extension)
+
+			try:
+				#written under a temporary name, so that a script, that
+				#imports the keys, never sees an incomplete file
+				with open(targetname+".tmp","wb") as f:
+					f.write(data)
+
+				os.replace(targetname+".tmp",targetname)
+				self.debug("write key to file %s"%targetname)
+				written.append(targetname)
+			except:
+				self.log("key %s could not be written"%fingerprint,"e")
+				self.log_traceback()
+
+				with self._lock:
+					self._fingerprints(directory).discard(fingerprint)
+
+		return written
+
+__all__=["_KEYINDEX"]
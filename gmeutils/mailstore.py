@@ -0,0 +1,182 @@
+#License GPL v3
+#Author Horst Knorr <gpgmailencrypt@gmx.de>
+from	.child			import _gmechild
+from	._dbg			import _dbg
+from	.version		import *
+import	email
+import	mmap
+
+###########
+#_MAILSTORE
+###########
+
+class _MAILSTORE(_gmechild):
+	"""
+	keeps a received mail. Small mails stay in memory, mails bigger than
+	'spillsize' bytes are written to a temporary file and are read with
+	mmap, so that they are not copied in memory.
+	write() expects the data as it comes with SMTP DATA (dot stuffed,
+	CRLF line ends). Like smtpd the store contains the mail with LF line
+	ends and without the dot stuffing.
+	"""
+
+	def __init__(self,parent,spillsize=0):
+		_gmechild.__init__(self,parent=parent,filename=__file__)
+		self.spillsize=spillsize
+		self.size=0
+		self._chunks=[]
+		self._file=None
+		self._mmap=None
+		#the line break before the first line, so that a leading dot
+		#of the first line is removed, too
+		self._tail=b"\r\n"
+		self._first=True
+
+	#########
+	#_unstuff
+	#########
+
+	def _unstuff(self,data):
+		"'data' starts with CRLF, returns it with LF and without dot stuffing"
+		data=data.replace(b"\r\n.",b"\r\n").replace(b"\r\n",b"\n")
+
+		if self._first and len(data)>0:
+			self._first=False
+			data=data[1:]
+
+		return data
+
+	#####
+	#_add
+	#####
+
+	def _add(self,data):
+
+		if len(data)==0:
+			return
+
+		self.size+=len(data)
+
+		if self._file!=None:
+			self._file.write(data)
+			return
+
+		self._chunks.append(data)
+
+		if self.spillsize>0 and self.size>self.spillsize:
+			self._spill()
+
+	#######
+	#_spill
+	#######
+
+	@_dbg
+	def _spill(self):
+		self._file=self.parent._new_tempfile()
+		self.debug("mail bigger than %i bytes, spill to '%s'"%(
+															self.spillsize,
+															self._file.name))
+
+		for c in self._chunks:
+			self._file.write(c)
+
+		self._chunks=[]
+
+	######
+	#write
+	######
+
+	def write(self,data):
+		"adds received SMTP DATA"
+		data=self._tail+data
+		#the tail always starts with CRLF, so that a dot at the beginning
+		#of the next chunk is recognized
+		end=data.rfind(b"\r\n")
+		self._tail=data[end:]
+		self._add(self._unstuff(data[:end]))
+
+	#######
+	#finish
+	#######
+
+	@_dbg
+	def finish(self):
+		"all data is received"
+		self._add(self._unstuff(self._tail))
+		self._tail=b""
+
+		if self._file!=None:
+			self._file.close()
+		elif len(self._chunks)>1:
+			self._chunks=[b"".join(self._chunks)]
+
+	########
+	#spilled
+	########
+
+	def spilled(self):
+		"returns True if the mail is stored in a file"
+		return self._file!=None
+
+	##########
+	#getbuffer
+	##########
+
+	def getbuffer(self):
+		"""returns the mail as bytes or, if it is stored in a file, as
+		read only mmap. Must be called after finish()"""
+
+		if self._file==None:
+
+			if len(self._chunks)==0:
+				return b""
+
+			return self._chunks[0]
+
+		if self._mmap==None:
+
+			with open(self._file.name,"rb") as f:
+				self._mmap=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+
+		return self._mmap
+
+	########
+	#message
+	########
+
+	@_dbg
+	def message(self):
+		"returns the parsed email.message, a stored file is read in blocks"
+
+		if self._file==None:
+			return email.message_from_bytes(self.getbuffer())
+
+		with open(self._file.name,"rb") as f:
+			return email.message_from_binary_file(f)
+
+	######
+	#close
+	######
+
+	@_dbg
+	def close(self):
+		"frees the memory and removes the file"
+
+		if self._mmap!=None:
+
+			try:
+				self._mmap.close()
+			except:
+				#still exported, the mmap is freed with the last reference
+				pass
+
+			self._mmap=None
+
+		if self._file!=None:
+			self._file.close()
+			self.parent._del_tempfile(self._file.name)
+			self._file=None
+
+		self._chunks=[]
+
+__all__=["_MAILSTORE"]
@@ -0,0 +1,310 @@
+#License GPL v3
+#Author Horst Knorr <gpgmailencrypt@gmx.de>
+from	.child			import _gmechild
+from	.version		import *
+from	functools		import wraps
+import	os
+import	sys
+import	threading
+import	time
+import	weakref
+
+#registries that count the subprocesses spawned by this process
+_spawnregistries=weakref.WeakSet()
+
+###########
+#_spawnhook
+###########
+
+def _spawnhook(event,args):
+	"audit hook, counts every started subprocess per program name"
+
+	if event=="subprocess.Popen":
+		executable,cmd=args[0],args[1]
+
+		if (isinstance(cmd,(list,tuple))
+		and len(cmd)>2
+		and cmd[1]=="-c"
+		and isinstance(cmd[2],str)):
+			#shell=True
+			executable=cmd[2].strip().split(" ")[0]
+		elif executable==None and isinstance(cmd,(list,tuple)) and cmd:
+			executable=cmd[0]
+		elif executable==None and isinstance(cmd,(str,bytes)):
+			executable=cmd.split()[0]
+	elif event=="os.system":
+		executable=os.fsdecode(args[0]).strip().split(" ")[0]
+	else:
+		return
+
+	try:
+		name=os.path.basename(os.fsdecode(executable).strip("\"'"))
+	except:
+		name="unknown"
+
+	for r in list(_spawnregistries):
+		r.add_spawn(name)
+
+if hasattr(sys,"addaudithook"):
+	sys.addaudithook(_spawnhook)
+
+#########
+#_measure
+#########
+
+def _measure(stage):
+	"decorator, records the duration of a gme method as pipeline 'stage'"
+
+	def decorator(func):
+
+		@wraps(func)
+		def wrapper(self,*args,**kwargs):
+			m=getattr(self,"_metrics",None)
+
+			if m==None:
+				return func(self,*args,**kwargs)
+
+			with m.timer(stage):
+				return func(self,*args,**kwargs)
+
+		return wrapper
+
+	return decorator
+
+############
+#_stagetimer
+############
+
+class _stagetimer:
+	"context manager, that adds the elapsed time to a histogram"
+
+	def __init__(self,metrics,stage):
+		self.metrics=metrics
+		self.stage=stage
+
+	def __enter__(self):
+		self.start=time.perf_counter()
+		return self
+
+	def __exit__(self,exc_type,exc_value,traceback):
+		self.metrics.observe(self.stage,time.perf_counter()-self.start)
+		return False
+
+#########
+#_METRICS
+#########
+
+class _METRICS(_gmechild):
+	"""
+	registry for per stage latency histograms, gauges and subprocess counts.
+	Don't call this class directly, use gme.get_metrics() instead!
+	"""
+	BUCKETS=(0.001,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0)
+	STAGES=["parse","spam","virus","policy","gpg","smime","pdf","zip","dkim",
+			"send"]
+
+	def __init__(self,parent):
+		_gmechild.__init__(self,parent=parent,filename=__file__)
+		self._lock=threading.Lock()
+		self.reset()
+		_spawnregistries.add(self)
+
+	######
+	#reset
+	######
+
+	def reset(self):
+		"sets all histograms and counters to zero"
+
+		with self._lock:
+			self._histograms={}
+			self._spawns={}
+			self._inflight=0
+
+			for s in self.STAGES:
+				self._histograms[s]=[[0]*(len(self.BUCKETS)+1),0.0,0.0]
+
+	######
+	#timer
+	######
+
+	def timer(self,stage):
+		"""returns a context manager, that measures the time of a
+		pipeline stage
+		with metrics.timer("gpg"):
+			...
+		"""
+		return _stagetimer(self,stage)
+
+	########
+	#observe
+	########
+
+	def observe(self,stage,seconds):
+		"adds a duration in seconds to the histogram of 'stage'"
+
+		with self._lock:
+			h=self._histograms.setdefault(stage,
+										[[0]*(len(self.BUCKETS)+1),0.0,0.0])
+			i=0
+
+			while i<len(self.BUCKETS) and seconds>self.BUCKETS[i]:
+				i+=1
+
+			h[0][i]+=1
+			h[1]+=seconds
+
+			if seconds>h[2]:
+				h[2]=seconds
+
+	##########
+	#add_spawn
+	##########
+
+	def add_spawn(self,name):
+
+		with self._lock:
+			self._spawns[name]=self._spawns.get(name,0)+1
+
+	#############
+	#add_inflight
+	#############
+
+	def add_inflight(self,value):
+		"changes the number of messages that are processed right now"
+
+		with self._lock:
+			self._inflight+=value
+
+	##########
+	#_quantile
+	##########
+
+	def _quantile(self,buckets,count,q):
+		"returns the upper bucket bound, that contains the quantile 'q'"
+
+		if count==0:
+			return 0.0
+
+		rank=q*count
+		total=0
+
+		for i,c in enumerate(buckets):
+			total+=c
+
+			if total>=rank:
+
+				if i<len(self.BUCKETS):
+					return self.BUCKETS[i]
+
+				break
+
+		return float("inf")
+
+	############
+	#get_metrics
+	############
+
+	def get_metrics(self):
+		"returns a dictionary with all stage timings, gauges and counters"
+
+		with self._lock:
+			stages={}
+
+			for s in self._histograms:
+				buckets,total,maximum=self._histograms[s]
+				count=sum(buckets)
+				stages[s]={	"count":count,
+							"sum":total,
+							"avg":total/count if count else 0.0,
+							"max":maximum,
+							"p50":min(self._quantile(buckets,count,0.5),
+										maximum),
+							"p99":min(self._quantile(buckets,count,0.99),
+										maximum),
+							"buckets":list(buckets)}
+
+			return {"stages":stages,
+					"queue":len(self.parent._email_queue),
+					"deferred":len(self.parent._deferred_emails),
+					"inflight":self._inflight,
+					"spawns":dict(self._spawns)}
+
+	###############
+	#get_prometheus
+	###############
+
+	def get_prometheus(self):
+		"returns all metrics in the Prometheus text exposition format"
+		m=self.get_metrics()
+		lines=[]
+		name="gpgmailencrypt_stage_duration_seconds"
+		lines.append("# HELP %s duration of the pipeline stages"%name)
+		lines.append("# TYPE %s histogram"%name)
+
+		for s in sorted(m["stages"]):
+			st=m["stages"][s]
+			total=0
+
+			for i,c in enumerate(st["buckets"]):
+				total+=c
+
+				if i<len(self.BUCKETS):
+					le=repr(self.BUCKETS[i])
+				else:
+					le="+Inf"
+
+				lines.append("%s_bucket{stage=\"%s\",le=\"%s\"} %i"%(name,
+																	s,
+																	le,
+																	total))
+
+			lines.append("%s_sum{stage=\"%s\"} %f"%(name,s,st["sum"]))
+			lines.append("%s_count{stage=\"%s\"} %i"%(name,s,st["count"]))
+
+		for g,h in (("queue","mails in the mail queue"),
+					("deferred","deferred mails"),
+					("inflight","mails processed right now")):
+			lines.append("# HELP gpgmailencrypt_%s %s"%(g,h))
+			lines.append("# TYPE gpgmailencrypt_%s gauge"%g)
+			lines.append("gpgmailencrypt_%s %i"%(g,m[g]))
+
+		name="gpgmailencrypt_subprocess_spawns_total"
+		lines.append("# HELP %s started subprocesses per program"%name)
+		lines.append("# TYPE %s counter"%name)
+
+		for p in sorted(m["spawns"]):
+			lines.append("%s{program=\"%s\"} %i"%(	name,
+													p.replace("\"","'"),
+													m["spawns"][p]))
+
+		return "\n".join(lines)+"\n"
+
+	#################
+	#write_prometheus
+	#################
+
+	def write_prometheus(self,filename):
+		"""writes the metrics in the Prometheus text format to 'filename',
+		e.g. for the node_exporter textfile collector"""
+		tmpname="%s.%i.tmp"%(filename,os.getpid())
+
+		try:
+
+			with open(tmpname,"w") as f:
+				f.write(self.get_prometheus())
+
+			os.replace(tmpname,filename)
+			return True
+		except:
+			self.log("Could not write metrics file '%s'"%filename,"e")
+			self.log_traceback()
+
+			try:
+				os.remove(tmpname)
+			except:
+				pass
+
+			return False
+
+__all__=["_METRICS","_measure"]
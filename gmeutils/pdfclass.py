@@ -1,14 +1,47 @@
 #License GPL v3
 #Author Horst Knorr <gpgmailencrypt@gmx.de>
+import email
+import io
 import os
 import PyPDF2
+import re
 import shutil
 import subprocess
+import threading
 from	.child 			import _gmechild 
+from	.helpers		import decodetxt,localedb
 from	.version		import *
 from	._dbg 			import _dbg
 from	.thirdparty		import email2pdf
 
+try:
+	import reportlab
+	from reportlab.lib.pagesizes	import A4
+	from reportlab.pdfbase			import pdfmetrics
+	from reportlab.pdfbase.ttfonts	import TTFont
+	from reportlab.pdfgen			import canvas
+	_reportlab_available=True
+except:
+	_reportlab_available=False
+
+#fonts for the native text renderer, the first font found will be used
+_TEXTFONTS=[	"/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf",
+				"/usr/share/fonts/dejavu/DejaVuSansMono.ttf",
+				"/usr/share/fonts/TTF/DejaVuSansMono.ttf",
+				"/usr/share/fonts/truetype/liberation/LiberationMono-Regular.ttf",
+				"/usr/share/fonts/liberation/LiberationMono-Regular.ttf",
+				"/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+				"/usr/share/fonts/dejavu/DejaVuSans.ttf",
+				"/usr/share/fonts/TTF/DejaVuSans.ttf"]
+
+if _reportlab_available:
+	_TEXTFONTS.append(os.path.join(os.path.dirname(reportlab.__file__),
+									"fonts",
+									"Vera.ttf"))
+
+_registeredfonts={}
+_fontlock=threading.Lock()
+
 ###########
 #CLASS _PDF
 ###########
@@ -68,54 +101,257 @@ class _PDF(_gmechild):
 			self.log( 'Error: create_pdffile: filename not set',"e")
 			return result,None
 
-		f=self.parent._new_tempfile(delete=True)
-		self.debug("_PDF.create_file _new_tempfile %s"%f.name)
-		f.close()
+		rendered=self._render_textmail()
 
-		try:
-			os.remove(f.name)
-		except:
-			pass
+		if len(rendered)==0:
+			missing=self._missing_htmlrenderer()
+
+			if missing!=None:
+				self.log("%s not available, mail can't be converted to "
+						"PDF"%missing,"e")
+				return False,None
 
-		self.debug("PDF creation command: '%s'" %
+			f=self.parent._new_tempfile(delete=True)
+			self.debug("_PDF.create_file _new_tempfile %s"%f.name)
+			f.close()
+
+			try:
+				os.remove(f.name)
+			except:
+				pass
+
+			self.debug("PDF creation command: '%s'" %
 						' '.join(self._createpdfcommand_fromfile(f.name)))
-		_result=0
+
+			pool=self.parent._get_renderpool()
+			renderer=None
+
+			if pool!=None:
+				renderer=pool.render
+
+			try:
+				email2pdf.main(	self._createpdfcommand_fromfile(f.name),
+								None,
+								None,
+								self.parent,
+								result=rendered,
+								renderer=renderer)
+			except:
+				self.log_traceback()
+
+			self.parent._del_tempfile(f.name)
+
+			if len(rendered.get("pdf",b""))==0:
+			  self.log("Error executing command","e")
+			  self.log(self._createpdfcommand_fromfile(f.name),"e")
+			  return False,None
 
 		try:
-			email2pdf.main(self._createpdfcommand_fromfile(f.name),None,None,self.parent)
+			encdata=self._finish_pdf(	rendered["pdf"],
+										rendered["metadata"],
+										password,
+										from_addr)
 		except:
-			_result=1
+			self.log("Error encrypting pdf file","e")
 			self.log_traceback()
-
-		if _result !=0:
-		  self.log("Error executing command (Error code )","e")
-		  self.log(self._createpdfcommand_fromfile(f.name),"e")
-		  return False,None
-		else:
-			result=True
+			return False,None
 
 		if password==None:
-			res=open(f.name,mode="br")
 			self.debug("return PDF unencrypted")
-			encdata=res.read()
-			res.close()
-			self.parent._del_tempfile(f.name)
-			return result,encdata
-
-		_res,encryptedfile=self._encrypt_pdffile(f.name,password,from_addr)
 
-		if _res==False:
-		  self.log("Error encrypting pdf file (Error code %d)"%_res,"e")
-		  return False,None
-
-		res=open(encryptedfile,mode="br")
-		self.debug("PDF.encrypt_file binary open")
-		encdata=res.read()
-		res.close()
-		self.parent._del_tempfile(f.name)
-		self.parent._del_tempfile(encryptedfile)
+		result=True
 		return result,encdata
  
+	##########
+	#_textfont
+	##########
+
+	@_dbg
+	def _textfont(self):
+		"""returns the name of the font for the native text renderer or
+		None, if no TrueType font could be loaded"""
+		fonts=list(_TEXTFONTS)
+
+		if len(self.parent._PDFTEXTFONT)>0:
+			fonts.insert(0,self.parent._PDFTEXTFONT)
+
+		with _fontlock:
+
+			for fontfile in fonts:
+
+				if fontfile in _registeredfonts:
+
+					if _registeredfonts[fontfile]!=None:
+						return _registeredfonts[fontfile]
+
+					continue
+
+				if not os.path.exists(fontfile):
+					continue
+
+				try:
+					name="gmetext%i"%len(_registeredfonts)
+					pdfmetrics.registerFont(TTFont(name,fontfile))
+					_registeredfonts[fontfile]=name
+					self.debug("text font '%s' loaded"%fontfile)
+					return name
+				except:
+					self.log("Font '%s' could not be loaded"%fontfile,"w")
+					_registeredfonts[fontfile]=None
+
+		return None
+
+	##########
+	#_wrapline
+	##########
+
+	@_dbg
+	def _wrapline(self,line,font,size,maxwidth):
+		"splits a line into lines, that fit into 'maxwidth'"
+		lines=[]
+
+		while pdfmetrics.stringWidth(line,font,size)>maxwidth:
+			low,high=1,len(line)
+
+			while low<high:
+				middle=(low+high+1)//2
+
+				if pdfmetrics.stringWidth(line[:middle],font,size)<=maxwidth:
+					low=middle
+				else:
+					high=middle-1
+
+			cut=line.rfind(" ",0,low+1)
+
+			if cut<=0:
+				cut=low
+
+			lines.append(line[:cut].rstrip())
+			line=line[cut:].lstrip(" ")
+
+		lines.append(line)
+		return lines
+
+	#################
+	#_render_textmail
+	#################
+
+	@_dbg
+	def _render_textmail(self):
+		"""
+		renders a mail without HTML part directly to PDF, without
+		starting wkhtmltopdf.
+
+		returns a dictionary with the keys 'pdf' and 'metadata' or an empty
+		dictionary, if the mail has to be rendered by email2pdf
+		"""
+
+		if not self.parent._PDFNATIVETEXT or not _reportlab_available:
+			return {}
+
+		try:
+
+			with open(self._filename,"r",encoding="UTF-8",
+						errors=unicodeerror) as f:
+				mail=email.message_from_file(f)
+
+			for part in mail.walk():
+
+				if part.get_content_type() in ("text/html","text/calendar"):
+					return {}
+
+			font=self._textfont()
+			size=9
+			leading=11
+
+			if font==None:
+				font="Courier"
+
+			lines=[]
+
+			for h in email2pdf.FORMATTED_HEADERS_TO_INCLUDE:
+
+				if mail[h]:
+					lines.append("%s: %s"%(
+									localedb(self.parent,h.lower()),
+									email2pdf.get_utf8_header(mail[h])))
+
+			headerlines=len(lines)
+			lines.append("")
+			part=email2pdf.find_part_by_content_type(mail,"text/plain")
+
+			if part!=None:
+				text=decodetxt(	part.get_payload(decode=False),
+								part["Content-Transfer-Encoding"],
+								part.get_content_charset())
+				text=text.replace("\r\n","\n").replace("\r","\n")
+				text=re.sub(r"[\x00-\x08\x0b-\x1f\x7f]","",text)
+				lines+=text.expandtabs(8).split("\n")
+
+			attachmentnames=email2pdf.get_all_attachmentnames(mail,
+																[],
+																self.parent)
+
+			if len(attachmentnames)>0:
+				aname="attachment"
+
+				if len(attachmentnames)>1:
+					aname="attachments"
+
+				lines+=["","%s:"%localedb(self.parent,aname)]
+
+				for a in attachmentnames:
+					lines.append("  - %s"%a)
+
+			if font=="Courier":
+
+				try:
+					"\n".join(lines).encode("cp1252")
+				except:
+					self.debug("no unicode font, use email2pdf")
+					return {}
+
+			metadata={}
+
+			for key in email2pdf.HEADER_MAPPING:
+
+				if email2pdf.HEADER_MAPPING[key] in mail:
+					metadata[key]=email2pdf.get_utf8_header(
+									mail[email2pdf.HEADER_MAPPING[key]])
+
+			metadata["Producer"]="gpgmailencrypt"
+			output=io.BytesIO()
+			width,height=A4
+			margin=42
+			maxwidth=width-2*margin
+			c=canvas.Canvas(output,pagesize=A4,pageCompression=1)
+			c.setCreator("gpgmailencrypt")
+			c.setSubject(metadata.get("Title",""))
+			c.setFont(font,size)
+			y=height-margin
+
+			for i,line in enumerate(lines):
+
+				for l in self._wrapline(line,font,size,maxwidth):
+
+					if y<margin:
+						c.showPage()
+						c.setFont(font,size)
+						y=height-margin
+
+					c.drawString(margin,y,l)
+					y-=leading
+
+				if i==headerlines-1:
+					c.line(margin,y+leading-3,width-margin,y+leading-3)
+
+			c.save()
+			return {"pdf":output.getvalue(),"metadata":metadata}
+		except:
+			self.log("native text renderer failed, use email2pdf","w")
+			self.log_traceback()
+			return {}
+
 	###########################
 	#_createpdfcommand_fromfile
 	###########################
@@ -135,63 +371,54 @@ class _PDF(_gmechild):
 
 		return cmd
  
-	#################
-	#_encrypt_pdffile
-	#################
+	############
+	#_finish_pdf
+	############
 
 	@_dbg
-	def _encrypt_pdffile(   self,
-							inputfilename,
-							password,
-							from_addr):
-		result=False
-		f=self.parent._new_tempfile()
-		self.debug("_PDF.encrypt_file _new_tempfile %s"%f.name)
-		self.debug("Encryption command: '%s'" %
-			' '.join(self._encryptcommand_fromfile( inputfilename,
-													f.name,password,
-													from_addr)))
-		_result = subprocess.call( 
-				' '.join(self._encryptcommand_fromfile(  inputfilename,
-														 f.name,password,
-													from_addr))
-				 ,shell=True ) 
-
-		if _result != 0:
-			self.log("Error executing command "
-							"(Error code %d)"%_result,"e")
-			self.log(' '.join(self._encryptcommand_fromfile(  inputfilename,
-														 f.name,password,
-														from_addr))
-					,"e")
-			return result,None
-		else:
-			result=True
+	def _finish_pdf(	self,
+						pdfdata,
+						metadata,
+						password,
+						from_addr):
+		"""
+		adds the metadata to the rendered PDF and encrypts it in one pass.
+		If the sender has an additional pdf encryption key, it is used as
+		the owner password.
 
-		return result,f.name
- 
-	#########################
-	#_encryptcommand_fromfile
-	#########################
+		returns the resulting PDF as a (binary) string
+		"""
+		reader=PyPDF2.PdfFileReader(io.BytesIO(pdfdata),strict=False)
+		writer=PyPDF2.PdfFileWriter()
+		writer.appendPagesFromReader(reader)
+		info={}
 
-	@_dbg
-	def _encryptcommand_fromfile(
-							self,
-							fromfile,
-							tofile,
-							password,
-							from_addr):
-		cmd=[   self._pdfencryptcmd,
-				fromfile, 
-				"output",tofile,
-				"user_pw","\"%s\""%password]
-		pw=self.parent.pdf_additionalencryptionkey(from_addr)
+		try:
 
-		if pw!=None and len(pw)>0:
-			cmd.append("owner_pw")
-			cmd.append(pw)
+			for k,v in reader.getDocumentInfo().items():
 
-		return cmd
+				if isinstance(v,str):
+					info[k]=v
+
+		except:
+			pass
+
+		for k in metadata:
+			info["/%s"%k]=metadata[k]
+
+		writer.addMetadata(info)
+
+		if password!=None:
+			ownerpw=self.parent.pdf_additionalencryptionkey(from_addr)
+
+			if ownerpw==None or len(ownerpw)==0:
+				ownerpw=None
+
+			writer.encrypt(password,ownerpw,use_128bit=True)
+
+		output=io.BytesIO()
+		writer.write(output)
+		return output.getvalue()
 
 	################
 	#decrypt_pdffile
@@ -247,73 +474,150 @@ class _PDF(_gmechild):
 							inputfilename,
 							from_addr=None,
 							to_addr=None):
-		result=False
-		pw=None
-		f=self.parent._new_tempfile()
+		"""
+		tries the PDF passwords of sender and recipient, the password source
+		that worked last time for both addresses first. The passwords are
+		checked in process against the encryption dictionary and the
+		decrypted PDF is written once. pdftk is only used for encryptions
+		PyPDF2 doesn't support.
 
-		if hasattr(self.parent._backend,"_textbackend") :
-			pw=self.parent._backend._textbackend.pdf_additionalencryptionkey(None)
+		returns (True,filename of the decrypted PDF) or (False,None)
+		"""
+		reader=None
 
-			if pw!=None:
-				result=self.decrypt_pdffile(inputfilename,f.name,pw)
+		try:
+			with open(inputfilename,"rb") as f:
+				data=f.read()
 
-		if not result:
-			pw=self.parent._backend.get_pdfpassword(from_addr)
+			reader=PyPDF2.PdfFileReader(io.BytesIO(data),strict=False)
 
-			if pw!=None:
-				result=self.decrypt_pdffile(inputfilename,f.name,pw)
+			if not reader.isEncrypted:
+				self.debug("decrypt_file: PDF is not encrypted")
+				return False,None
 
-		if not result:
-			pw=self.parent._backend.get_pdfpassword(to_addr)
+		except:
+			self.log("decrypt_file: PDF could not be read","w")
+			self.log_traceback()
+			reader=None
 
-			if pw!=None:
-				result=self.decrypt_pdffile(inputfilename,f.name,pw)
+		for source,pw in self.parent._pdfpassword_candidates(from_addr,
+															to_addr):
 
-		if not result:
-			pw=self.parent._backend.pdf_additionalencryptionkey(to_addr)
+			if reader!=None:
 
-			if pw!=None:
-				result=self.decrypt_pdffile(inputfilename,f.name,pw)
+				try:
+
+					if reader.decrypt(pw)==0:
+						continue
 
-		if not result:
-			pw=self.parent._backend.pdf_additionalencryptionkey(from_addr)
+				except NotImplementedError:
+					#e.g. AES, only pdftk can check the password
+					self.debug("decrypt_file: encryption not supported "
+								"by PyPDF2, use pdftk")
+					reader=None
+				except:
+					self.log_traceback()
+					continue
 
-			if pw!=None:
+			f=self.parent._new_tempfile()
+			f.close()
+
+			if reader!=None:
+				result=self._write_decrypted(reader,f.name)
+			else:
 				result=self.decrypt_pdffile(inputfilename,f.name,pw)
 
-		if result==True:
-			return result,f.name
-		else:
+			if result:
+				self.debug("decrypt_file: password source '%s'"%source)
+				self.parent._remember_pdfpasswordsource(from_addr,
+														to_addr,
+														source)
+				return True,f.name
+
 			self.parent._del_tempfile(f.name)
-			return result,None
+
+		return False,None
+
+	#################
+	#_write_decrypted
+	#################
 
 	@_dbg
-	def is_available(self):
+	def _write_decrypted(self,reader,outputfilename):
+		"writes the PDF of the decrypted 'reader' without encryption"
 
 		try:
-			import bs4
+			writer=PyPDF2.PdfFileWriter()
+			writer.appendPagesFromReader(reader)
+
+			try:
+				info={}
+
+				for k,v in reader.getDocumentInfo().items():
+
+					if isinstance(v,str):
+						info[k]=v
+
+				writer.addMetadata(info)
+			except:
+				pass
+
+			with open(outputfilename,"wb") as f:
+				writer.write(f)
+
 		except:
-			self.log("beautifulsoup4 not available","e")
+			self.log("decrypted PDF could not be written","e")
+			self.log_traceback()
 			return False
 
+		return True
+
+	@_dbg
+	def is_available(self):
+		"""returns True if PDF files can be created. Without wkhtmltopdf only
+		plain text mails can be converted"""
+
 		try:
 			import PyPDF2
 		except:
 			self.log("pypdf2 not available","e")
 			return False
 
+		missing=self._missing_htmlrenderer()
+
+		if missing==None:
+			return True
+
+		if self.parent._PDFNATIVETEXT and _reportlab_available:
+			self.debug("%s not available, only plain text mails can be "
+						"converted to PDF"%missing)
+			return True
+
+		self.log("%s not available"%missing,"e")
+		return False
+
+	######################
+	#_missing_htmlrenderer
+	######################
+
+	def _missing_htmlrenderer(self):
+		"""returns the name of the program or module email2pdf needs, but
+		which is not installed, or None"""
+
+		try:
+			import bs4
+		except:
+			return "beautifulsoup4"
+
 		try:
 			import magic
 		except:
-			self.log("python-magic not available","e")
-			return False
-		
-		if ( self._pdfencryptcmd and len(self._pdfencryptcmd)>0
-			and self._pdfwkhtml2pdf and len(self._pdfwkhtml2pdf)>0):
-			return True
-		else:
-			self.log("pdftk and/or wkhtmltopdf not available","e")
-			return False
+			return "python-magic"
+
+		if not self._pdfwkhtml2pdf or len(self._pdfwkhtml2pdf)==0:
+			return "wkhtmltopdf"
+
+		return None
 
 	@_dbg
 	def is_encrypted(self,pdffile):
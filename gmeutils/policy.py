@@ -0,0 +1,266 @@
+#License GPL v3
+#Author Horst Knorr <gpgmailencrypt@gmx.de>
+from	.child			import _gmechild
+from	._dbg			import _dbg
+from	.helpers		import maildomain
+from	.version		import *
+import	collections
+import	email.utils
+
+#the encryption decision for one recipient
+#gpg/smime:		True if the mail can be encrypted with GPG/S/MIME
+#gpgkey/smimekey:	the address of the key (after the usermap)
+#method:		the preferred encryption method
+#cipher:		the cipher of the encryptionmap entry (e.g. for PDF/ZIP) or None
+#gpgkeys:		the additional GPG encryption keys, only looked up if the mail
+#			can be GPG encrypted or for explain()
+#smimekeys:		the additional S/MIME encryption keys, only for explain()
+#encryptsubject:	True if the subject is encrypted with PGP/MIME, looked up
+#			like 'gpgkeys'
+#explain:		the reasons for the decision, only filled by explain()
+_DECISION=collections.namedtuple("_DECISION",[	"recipient",
+												"gpg",
+												"gpgkey",
+												"smime",
+												"smimekey",
+												"method",
+												"cipher",
+												"gpgkeys",
+												"smimekeys",
+												"encryptsubject",
+												"explain"])
+
+_METHODS=("PGPMIME","PGPINLINE","SMIME","PDF","NONE")
+
+##############
+#_POLICYENGINE
+##############
+
+class _POLICYENGINE(_gmechild):
+	"""
+	decides for a list of recipients if and how their mails are encrypted.
+	The configuration ('domains', 'homedomains', the default method) is
+	compiled once, the lookups in the storage backend and the key checks
+	are done once per address and call, so that all recipients of a mail
+	are resolved consistently.
+	Use gme._get_policyengine(), it is compiled again when the settings
+	change.
+	"""
+
+	def __init__(self,parent):
+		_gmechild.__init__(self,parent=parent,filename=__file__)
+		self.config=_POLICYENGINE.get_config(parent)
+		self.domains=frozenset(d.strip().lower()
+								for d in parent._DOMAINS.split(",")
+								if len(d.strip())>0)
+		self.homedomains=frozenset(parent._HOMEDOMAINS)
+		self.default=parent._PREFERRED_ENCRYPTION
+
+	###########
+	#get_config
+	###########
+
+	@staticmethod
+	def get_config(parent):
+		"the settings, the engine is compiled from"
+		return (parent._DOMAINS,
+				tuple(parent._HOMEDOMAINS),
+				parent._PREFERRED_ENCRYPTION)
+
+	########
+	#resolve
+	########
+
+	@_dbg
+	def resolve(self,recipients,from_addr,explain=False):
+		"""returns a dictionary recipient:_DECISION for all 'recipients'.
+		If 'explain' is True, the decisions contain the reasons"""
+		lookups={}
+		keys={}
+		gpg=self.parent.gpg_factory()
+		smime=self.parent.smime_factory()
+
+		if maildomain(from_addr) in self.homedomains:
+			#the keys of the sender's local keyring, read only once
+			gpg.set_fromuser(from_addr)
+
+		decisions={}
+
+		for recipient in recipients:
+
+			try:
+				decisions[recipient]=self._decide(	recipient,
+													gpg,
+													smime,
+													lookups,
+													keys,
+													explain)
+			except:
+				self.log_traceback()
+				decisions[recipient]=self._fallback(recipient)
+
+		return decisions
+
+	########
+	#explain
+	########
+
+	@_dbg
+	def explain(self,recipient,from_addr=None):
+		"returns the decision for 'recipient' as text lines for admins"
+		d=self.resolve([recipient],from_addr,explain=True).get(recipient)
+
+		if d==None:
+			return ["%s: no decision possible"%recipient]
+
+		lines=["recipient      %s"%d.recipient,
+				"method         %s"%d.method,
+				"gpg            %s (key %s)"%(d.gpg,d.gpgkey),
+				"smime          %s (key %s)"%(d.smime,d.smimekey),
+				"cipher         %s"%d.cipher,
+				"gpg keys       %s"%",".join(d.gpgkeys),
+				"smime keys     %s"%",".join(d.smimekeys),
+				"encryptsubject %s"%d.encryptsubject]
+
+		for e in d.explain:
+			lines.append("because        %s"%e)
+
+		return lines
+
+	##########
+	#_fallback
+	##########
+
+	def _fallback(self,recipient):
+		"the decision for a recipient, that could not be resolved"
+		return _DECISION(	recipient=recipient,
+							gpg=False,
+							gpgkey=recipient.lower(),
+							smime=False,
+							smimekey=recipient.lower(),
+							method=self.default,
+							cipher=None,
+							gpgkeys=(),
+							smimekeys=(),
+							encryptsubject=False,
+							explain=("the policy could not be resolved, "
+									"mail is not encrypted",))
+
+	########
+	#_lookup
+	########
+
+	def _lookup(self,lookups,func,key):
+		"""calls the (backend) function 'func' once per key, returns None
+		if the key is unknown"""
+
+		if (func,key) not in lookups:
+
+			try:
+				lookups[(func,key)]=func(key)
+			except:
+				lookups[(func,key)]=None
+
+		return lookups[(func,key)]
+
+	########
+	#_decide
+	########
+
+	def _decide(self,recipient,gpg,smime,lookups,keys,explain):
+		reasons=[]
+		to_addr=recipient.lower()
+		domain=maildomain(to_addr)
+		address=email.utils.parseaddr(to_addr)[1]
+		backend=self.parent._backend
+		keyaddress=self._lookup(lookups,backend.usermap,to_addr)
+
+		if keyaddress==None:
+			keyaddress=to_addr
+		elif explain:
+			reasons.append("usermap %s=>%s"%(to_addr,keyaddress))
+
+		in_domains=len(self.domains)==0 or domain in self.domains
+
+		if ("gpg",keyaddress) not in keys:
+			keys[("gpg",keyaddress)]=gpg.has_public_key(keyaddress)
+			keys[("smime",keyaddress)]=smime.has_public_key(keyaddress)
+
+		has_gpg=keys[("gpg",keyaddress)]
+		has_smime=keys[("smime",keyaddress)]
+
+		if explain:
+			reasons.append("gpg key %sfound, smime key %sfound"%(
+										("" if has_gpg else "not "),
+										("" if has_smime else "not ")))
+
+			if not in_domains:
+				reasons.append("'%s' is not in 'domains'"%domain)
+
+		#the preferred method, like get_preferredencryptionmethod
+		methodaddress=self._lookup(lookups,backend.usermap,address)
+
+		if methodaddress==None:
+			methodaddress=address
+
+		entry=self._lookup(lookups,backend.encryptionmap,methodaddress)
+		source=methodaddress
+
+		if (not entry or len(entry[0])==0) and len(domain)>0:
+			entry=self._lookup(lookups,backend.encryptionmap,"*@%s"%domain)
+			source="*@%s"%domain
+
+		method=self.default
+		cipher=None
+
+		if entry and len(entry[0])>0:
+			m=entry[0].upper()
+
+			if len(entry)>1 and len(entry[1])>0:
+				cipher=entry[1]
+
+			if m in _METHODS:
+				method=m
+
+				if explain:
+					reasons.append("encryptionmap %s=>%s"%(source,m))
+
+			elif explain:
+				reasons.append("encryptionmap %s=>%s is unknown, "
+								"default method"%(source,m))
+
+		elif explain:
+			reasons.append("no encryptionmap entry, default method")
+
+		gpg_possible=has_gpg and in_domains
+		gpgkeys=None
+		smimekeys=None
+		encryptsubject=None
+
+		#the encryption needs them only for GPG
+		if (gpg_possible and method!="NONE") or explain:
+			gpgkeys=self._lookup(	lookups,
+									backend.gpg_additionalencryptionkeys,
+									to_addr)
+			encryptsubject=self._lookup(lookups,
+										self.parent.pgpmime_do_encryptsubject,
+										to_addr)
+
+		if explain:
+			smimekeys=self._lookup(	lookups,
+									backend.smime_additionalencryptionkeys,
+									to_addr)
+
+		return _DECISION(	recipient=recipient,
+							gpg=gpg_possible,
+							gpgkey=keyaddress,
+							smime=has_smime and in_domains,
+							smimekey=keyaddress,
+							method=method,
+							cipher=cipher,
+							gpgkeys=tuple(gpgkeys or ()),
+							smimekeys=tuple(smimekeys or ()),
+							encryptsubject=bool(encryptsubject),
+							explain=tuple(reasons))
+
+__all__=["_DECISION","_POLICYENGINE"]
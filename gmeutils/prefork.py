@@ -0,0 +1,669 @@
+#License GPL v3
+#Author Horst Knorr <gpgmailencrypt@gmx.de>
+from	.child			import _gmechild
+from	._dbg			import _dbg
+from	.gpgmailserver	import _gpgmailencryptserver,_hksmtpchannel
+from	.version		import *
+import	asyncore
+import	json
+import	os
+import	select
+import	signal
+import	socket
+import	time
+
+#seconds between two reports of a worker to the supervisor
+_REPORTINTERVAL=1
+#seconds a worker waits for the answer of an admin command
+_ADMINTIMEOUT=30
+#seconds the supervisor waits for the workers to shut down
+_STOPTIMEOUT=10
+#a worker, that ran shorter, is restarted with an increasing delay
+_MINWORKERLIFETIME=10
+_MAXRESTARTDELAY=60
+
+###############
+#_controlsocket
+###############
+
+class _controlsocket:
+	"""
+	control channel between the supervisor and a worker process.
+	Messages are dictionaries, sent as JSON lines over a socketpair.
+	"""
+
+	def __init__(self,sock):
+		self.sock=sock
+		self._buffer=b""
+
+	#####
+	#send
+	#####
+
+	def send(self,**msg):
+		data=json.dumps(msg).encode("UTF-8")+b"\n"
+		timeout=self.sock.gettimeout()
+
+		try:
+			self.sock.settimeout(_ADMINTIMEOUT)
+			self.sock.sendall(data)
+		finally:
+			self.sock.settimeout(timeout)
+
+	#####
+	#read
+	#####
+
+	def read(self):
+		"""reads the available data
+		returns a list of the complete messages or None if the connection
+		is closed"""
+
+		try:
+			data=self.sock.recv(65536)
+		except (BlockingIOError,InterruptedError):
+			return []
+		except OSError:
+			data=b""
+
+		if not data:
+			return None
+
+		self._buffer+=data
+		msgs=[]
+
+		while b"\n" in self._buffer:
+			line,self._buffer=self._buffer.split(b"\n",1)
+
+			try:
+				msgs.append(json.loads(line.decode("UTF-8")))
+			except:
+				pass
+
+		return msgs
+
+	#######
+	#fileno
+	#######
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	######
+	#close
+	######
+
+	def close(self):
+
+		try:
+			self.sock.close()
+		except:
+			pass
+
+##############
+#_admincapture
+##############
+
+class _admincapture:
+	"""
+	runs the admin commands of _hksmtpchannel in the supervisor and
+	collects the replies
+	"""
+	_dash=_hksmtpchannel._dash
+
+	def __init__(self,parent):
+		self.parent=parent
+		self.lines=[]
+
+	def push(self,line):
+		self.lines.append(line)
+
+	def _forward_admincommand(self,command,arg):
+		return False
+
+###############
+#_workercontrol
+###############
+
+class _workercontrol(asyncore.dispatcher):
+	"receives the messages of the supervisor in the loop of a worker"
+
+	def __init__(self,worker,sock):
+		asyncore.dispatcher.__init__(self,sock)
+		self.worker=worker
+
+	def writable(self):
+		return False
+
+	def handle_read(self):
+		msgs=self.worker.control.read()
+
+		if msgs==None:
+			self.worker.log("Supervisor has gone, worker stops","e")
+			self.close()
+			self.worker.stopped=True
+			return
+
+		self.worker.pending+=msgs
+
+	def handle_close(self):
+		self.close()
+		self.worker.stopped=True
+
+###############
+#_PREFORKWORKER
+###############
+
+class _PREFORKWORKER(_gmechild):
+	"""
+	a worker process of the multi-process daemon. It accepts connections
+	on the shared listening socket with its own smtp server. Deferred and
+	quarantined mails are handed over to the supervisor, admin commands,
+	that need the state of all workers, are executed there.
+	"""
+
+	def __init__(self,parent,index,listensock,ctrlsock):
+		_gmechild.__init__(self,parent=parent,filename=__file__)
+		self.index=index
+		self.listensock=listensock
+		self.control=_controlsocket(ctrlsock)
+		self.pending=[]
+		self.stopped=False
+		self._laststatistics=None
+
+	####
+	#run
+	####
+
+	@_dbg
+	def run(self):
+		signal.signal(signal.SIGTERM,self.parent._sigtermhandler)
+		signal.signal(signal.SIGHUP,signal.SIG_IGN)
+		signal.signal(signal.SIGINT,signal.SIG_IGN)
+		self.parent._reset_after_fork()
+		self.parent._controlchannel=self
+		p=self.parent
+		server=_gpgmailencryptserver(	p,
+										(p._SMTPD_HOST,p._SMTPD_PORT),
+										use_auth=p._SMTPD_USE_AUTH,
+										use_smtps=p._SMTPD_USE_SMTPS,
+										use_tls=p._SMTPD_USE_STARTTLS,
+										force_tls=p._SMTPD_FORCETLS,
+										sslkeyfile=p._SMTPD_SSL_KEYFILE,
+										sslcertfile=p._SMTPD_SSL_CERTFILE,
+										sock=self.listensock)
+		_workercontrol(self,self.control.sock)
+		self.debug("worker %i started"%self.index)
+
+		try:
+
+			while not self.stopped:
+				asyncore.loop(timeout=_REPORTINTERVAL,count=1)
+				self._dispatch()
+				self.report()
+
+		except SystemExit:
+			pass
+
+		server.close()
+		#mails, that are still in process, will be sent later
+		self.parent._deferred_emails+=list(self.parent._email_queue.values())
+		self.parent._email_queue={}
+
+		try:
+			self.report()
+		except:
+			self.log_traceback()
+
+		self.control.close()
+
+	##########
+	#_dispatch
+	##########
+
+	def _dispatch(self):
+		"handles the commands of the supervisor"
+		msgs=self.pending
+		self.pending=[]
+
+		for m in msgs:
+
+			if m.get("cmd")=="reload":
+				self.log("worker %i reloads configuration"%self.index)
+				self.parent.init()
+				self.parent._parse_commandline()
+				self.parent._RUNMODE=self.parent.m_daemon
+
+	#######
+	#report
+	#######
+
+	def report(self):
+		"""hands the new deferred and quarantined mails and the statistics
+		over to the supervisor"""
+		p=self.parent
+
+		if p._deferred_emails:
+			self.control.send(cmd="deferred",mails=p._deferred_emails)
+			p._deferred_emails=[]
+
+		if p._virus_queue:
+			self.control.send(cmd="virus",mails=p._virus_queue)
+			p._virus_queue=[]
+
+		statistics=p.get_statistics()
+
+		if statistics!=self._laststatistics:
+			self.control.send(cmd="statistics",statistics=statistics)
+			self._laststatistics=statistics
+
+	######
+	#admin
+	######
+
+	@_dbg
+	def admin(self,command,arg):
+		"""executes an admin command in the supervisor
+		returns the reply lines or None on error"""
+
+		try:
+			self.report()
+			self.control.send(cmd="admin",command=command,arg=arg)
+		except:
+			self.log("admin command could not be sent to supervisor","e")
+			self.log_traceback()
+			return None
+
+		end=time.monotonic()+_ADMINTIMEOUT
+
+		while time.monotonic()<end:
+			r,w,x=select.select(	[self.control],
+									[],
+									[],
+									max(0,end-time.monotonic()))
+
+			if not r:
+				continue
+
+			msgs=self.control.read()
+
+			if msgs==None:
+				self.stopped=True
+				return None
+
+			for i in range(len(msgs)):
+
+				if msgs[i].get("cmd")=="reply":
+					self.pending+=msgs[i+1:]
+					return msgs[i].get("lines")
+
+				self.pending.append(msgs[i])
+
+		self.log("supervisor did not answer admin command '%s'"%command,"e")
+		return None
+
+###################
+#_PREFORKSUPERVISOR
+###################
+
+class _PREFORKSUPERVISOR(_gmechild):
+	"""
+	supervisor of the multi-process daemon. Opens the listening socket,
+	forks the workers, restarts crashed workers and keeps the state, that
+	is shared by all workers: the deferred mails, the quarantine and the
+	statistics.
+	The supervisor runs no threads, so that new workers can be forked at
+	any time.
+	"""
+
+	def __init__(self,parent,workers=2):
+		_gmechild.__init__(self,parent=parent,filename=__file__)
+		self.count=workers
+		self.workers={}
+		self.listensock=None
+		self._stop=False
+		self._reload=False
+
+	#############
+	#_open_socket
+	#############
+
+	@_dbg
+	def _open_socket(self):
+		p=self.parent
+		family=socket.getaddrinfo(	p._SMTPD_HOST,
+									p._SMTPD_PORT,
+									type=socket.SOCK_STREAM)[0][0]
+		s=socket.socket(family,socket.SOCK_STREAM)
+		s.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+		s.bind((p._SMTPD_HOST,p._SMTPD_PORT))
+		s.listen(128)
+		s.setblocking(False)
+		p._used_smtpdport=s.getsockname()[1]
+
+		if p._used_smtpdport!=p._SMTPD_PORT:
+			print("used_smtpdport=%i"%p._used_smtpdport)
+
+		return s
+
+	##############
+	#_start_worker
+	##############
+
+	@_dbg
+	def _start_worker(self,index):
+		mine,theirs=socket.socketpair()
+		pid=os.fork()
+
+		if pid==0:
+			code=0
+
+			try:
+				mine.close()
+
+				for w in self.workers.values():
+					w["control"].close()
+
+				_PREFORKWORKER(	self.parent,
+								index,
+								self.listensock,
+								theirs).run()
+				self.parent.close()
+			except:
+				self.log("worker %i crashed"%index,"e")
+				self.log_traceback()
+				code=1
+
+			os._exit(code)
+
+		theirs.close()
+		self.workers[index]={	"pid":pid,
+								"control":_controlsocket(mine),
+								"started":time.monotonic(),
+								"restart":None,
+								"failures":self.workers.get(index,
+														{}).get("failures",0)}
+		self.log("worker %i started with pid %i"%(index,pid))
+
+	################
+	#_handle_message
+	################
+
+	def _handle_message(self,index,msg):
+		p=self.parent
+		w=self.workers[index]
+		cmd=msg.get("cmd")
+
+		if cmd=="statistics":
+			p._workerstatistics[w["pid"]]=msg.get("statistics",{})
+		elif cmd=="deferred":
+
+			for mail in msg.get("mails",[]):
+				p._deferred_emails.append(mail)
+
+			p.store_deferred_list()
+		elif cmd=="virus":
+
+			for mail in msg.get("mails",[]):
+				p._virus_queue.append(mail)
+
+			p.store_virus_list()
+		elif cmd=="admin":
+			command=msg.get("command","")
+			lines=self._admin(command,msg.get("arg"))
+
+			try:
+				w["control"].send(cmd="reply",lines=lines)
+			except:
+				self.log("reply to worker %i could not be sent"%index,"e")
+
+			if command=="RELOAD" and lines==["250 OK"]:
+				self._reload=True
+
+	#######
+	#_admin
+	#######
+
+	@_dbg
+	def _admin(self,command,arg):
+		"executes the admin command of a worker, returns the reply lines"
+		c=_admincapture(self.parent)
+
+		if command not in ["FLUSH","QUARANTINE","RELOAD","STATISTICS"]:
+			return ["502 Command not implemented in the supervisor"]
+
+		if command=="RELOAD":
+
+			if arg:
+				return ["501 Syntax error: no arguments allowed"]
+
+			return ["250 OK"]
+
+		try:
+			getattr(_hksmtpchannel,"smtp_%s"%command)(c,arg)
+		except:
+			self.log("admin command '%s' failed"%command,"e")
+			self.log_traceback()
+			return ["451 4.3.0 Admin command failed"]
+
+		return c.lines
+
+	############
+	#_reload_all
+	############
+
+	@_dbg
+	def _reload_all(self):
+		"reloads the configuration of the supervisor and all workers"
+		self.log("reload configuration of all workers")
+		p=self.parent
+		p.init()
+		p._parse_commandline()
+		p._RUNMODE=p.m_daemon
+
+		for index in self.workers:
+
+			try:
+				self.workers[index]["control"].send(cmd="reload")
+			except:
+				self.log("worker %i could not be reloaded"%index,"e")
+
+	######
+	#_reap
+	######
+
+	def _reap(self):
+		"finds exited workers and restarts them"
+		p=self.parent
+		now=time.monotonic()
+
+		for index in list(self.workers):
+			w=self.workers[index]
+
+			if w["pid"]!=None:
+
+				try:
+					pid,status=os.waitpid(w["pid"],os.WNOHANG)
+				except ChildProcessError:
+					pid,status=w["pid"],0
+
+				if pid==0:
+					continue
+
+				self._drain(index)
+
+				if not self._stop:
+					self.log("worker %i (pid %i) exited with status %i"%(
+												index,
+												w["pid"],
+												status),"e")
+
+				#the counts of the old worker are kept
+				last=p._workerstatistics.pop(w["pid"],{})
+				retired=p._workerstatistics.setdefault("retired",{})
+
+				for s in last:
+
+					if s!="deferred still":
+						retired[s]=retired.get(s,0)+last[s]
+
+				w["control"].close()
+				w["pid"]=None
+
+				if now-w["started"]<_MINWORKERLIFETIME:
+					w["failures"]+=1
+				else:
+					w["failures"]=0
+
+				delay=0
+
+				if w["failures"]>0:
+					delay=min(_MAXRESTARTDELAY,2**w["failures"])
+
+				w["restart"]=now+delay
+
+			if (not self._stop
+			and w["pid"]==None
+			and w["restart"]<=now):
+				self._start_worker(index)
+
+	#######
+	#_drain
+	#######
+
+	def _drain(self,index):
+		"handles the last messages of a worker"
+		w=self.workers[index]
+
+		while True:
+
+			try:
+				r,_w,_x=select.select([w["control"]],[],[],0)
+			except (OSError,ValueError):
+				return
+
+			if not r:
+				return
+
+			msgs=w["control"].read()
+
+			if msgs==None:
+				return
+
+			for m in msgs:
+				self._handle_message(index,m)
+
+	####
+	#run
+	####
+
+	@_dbg
+	def run(self):
+		p=self.parent
+
+		def _sigterm(signum,frame):
+			self._stop=True
+
+		def _sighup(signum,frame):
+			self._reload=True
+
+		signal.signal(signal.SIGTERM,_sigterm)
+		signal.signal(signal.SIGHUP,_sighup)
+
+		try:
+			self.listensock=self._open_socket()
+		except:
+			self.log("Couldn't start mail server")
+			self.log_traceback()
+			exit(5)
+
+		p.load_deferred_list()
+		p.load_virus_list()
+		p._deferredlisthandler()
+		nextmaintenance=time.monotonic()+3600
+		self.log("gpgmailencrypt %s starts as daemon on %s:%s with %i "
+					"workers"%(	VERSION,
+								p._SMTPD_HOST,
+								p._SMTPD_PORT,
+								self.count))
+
+		for index in range(self.count):
+			self._start_worker(index)
+
+		try:
+
+			while not self._stop:
+				controls={}
+
+				for index in self.workers:
+
+					if self.workers[index]["pid"]!=None:
+						controls[self.workers[index]["control"]]=index
+
+				r,_w,_x=select.select(list(controls),[],[],_REPORTINTERVAL)
+
+				for c in r:
+					msgs=c.read()
+
+					for m in msgs or []:
+						self._handle_message(controls[c],m)
+
+				if self._reload:
+					self._reload=False
+					self._reload_all()
+
+				self._reap()
+
+				if time.monotonic()>=nextmaintenance:
+					nextmaintenance=time.monotonic()+3600
+					p._deferredlisthandler()
+
+		except KeyboardInterrupt:
+			self.log("Keyboard Exit")
+
+		self.stop()
+
+	#####
+	#stop
+	#####
+
+	@_dbg
+	def stop(self):
+		"stops all workers and stores the deferred and quarantined mails"
+		self._stop=True
+		self.log("stop workers")
+
+		for w in self.workers.values():
+
+			if w["pid"]!=None:
+
+				try:
+					os.kill(w["pid"],signal.SIGTERM)
+				except:
+					pass
+
+		end=time.monotonic()+_STOPTIMEOUT
+
+		while time.monotonic()<end:
+			self._reap()
+
+			if not [w for w in self.workers.values() if w["pid"]!=None]:
+				break
+
+			time.sleep(0.1)
+
+		for w in self.workers.values():
+
+			if w["pid"]!=None:
+				self.log("worker pid %i killed"%w["pid"],"e")
+
+				try:
+					os.kill(w["pid"],signal.SIGKILL)
+					os.waitpid(w["pid"],0)
+				except:
+					pass
+
+		self.listensock.close()
+		self.parent.store_deferred_list()
+
+__all__=["_PREFORKSUPERVISOR"]
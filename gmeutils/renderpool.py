@@ -0,0 +1,229 @@
+#License GPL v3
+#Author Horst Knorr <gpgmailencrypt@gmx.de>
+from	.child			import _gmechild
+from	._dbg			import _dbg
+from	.version		import *
+import	queue
+import	shutil
+import	subprocess
+import	threading
+import	time
+
+##################
+#_basehtmlrenderer
+##################
+
+class _basehtmlrenderer(_gmechild):
+	"""
+	base class of the HTML to PDF renderers of the render pool.
+	A renderer is started before the job arrives and is recycled after
+	'maxjobs' jobs.
+	"""
+	maxjobs=1
+
+	def __init__(self,parent):
+		_gmechild.__init__(self,parent=parent,filename=__file__)
+		self.jobs=0
+
+	######
+	#start
+	######
+
+	def start(self):
+		"starts the renderer, so that it is ready when a job arrives"
+		raise NotImplementedError
+
+	#######
+	#render
+	#######
+
+	def render(self,payload,timeout):
+		"""renders the HTML 'payload' (bytes)
+		returns output,error,returncode"""
+		raise NotImplementedError
+
+	#####
+	#stop
+	#####
+
+	def stop(self):
+		pass
+
+#####################
+#_WKHTMLTOPDFRENDERER
+#####################
+
+class _WKHTMLTOPDFRENDERER(_basehtmlrenderer):
+	"""
+	wkhtmltopdf renders only one document per process, but the browser
+	engine starts before the HTML is read from stdin. So a process that
+	waits for its input is a warm worker.
+	"""
+	maxjobs=1
+
+	def __init__(self,parent):
+		_basehtmlrenderer.__init__(self,parent)
+		self.cmd=shutil.which("wkhtmltopdf")
+		self._process=None
+
+	######
+	#start
+	######
+
+	@_dbg
+	def start(self):
+		self._process=subprocess.Popen([	self.cmd,
+											"-q",
+											"--load-error-handling","ignore",
+											"--load-media-error-handling",
+											"ignore",
+											"--encoding","utf-8",
+											"-",
+											"-"],
+											stdin=subprocess.PIPE,
+											stdout=subprocess.PIPE,
+											stderr=subprocess.PIPE)
+
+	#######
+	#render
+	#######
+
+	@_dbg
+	def render(self,payload,timeout):
+		self.jobs+=1
+
+		try:
+			output,error=self._process.communicate(	input=payload,
+													timeout=timeout)
+		except subprocess.TimeoutExpired:
+			self.log("wkhtmltopdf timed out after %i seconds"%timeout,"e")
+			self.stop()
+			return b"",b"timeout",-1
+
+		return output,error,self._process.returncode
+
+	#####
+	#stop
+	#####
+
+	@_dbg
+	def stop(self):
+
+		if self._process!=None and self._process.poll()==None:
+
+			try:
+				self._process.kill()
+				self._process.communicate()
+			except:
+				pass
+
+		self._process=None
+
+############
+#_RENDERPOOL
+############
+
+class _RENDERPOOL(_gmechild):
+	"""
+	keeps 'size' started HTML renderers. Jobs wait in a bounded queue for
+	a free renderer, renderers are replaced after 'maxjobs' jobs.
+	Don't call this class directly, use gme._get_renderpool() instead!
+	"""
+
+	def __init__(	self,
+					parent,
+					size=2,
+					queuesize=20,
+					timeout=60,
+					renderer=_WKHTMLTOPDFRENDERER):
+		_gmechild.__init__(self,parent=parent,filename=__file__)
+		self.size=size
+		self.queuesize=queuesize
+		self.timeout=timeout
+		self.renderer=renderer
+		self._idle=queue.Queue()
+		self._lock=threading.Lock()
+		self._waiting=0
+		self._closed=False
+
+		for i in range(self.size):
+			self._start_renderer()
+
+	################
+	#_start_renderer
+	################
+
+	@_dbg
+	def _start_renderer(self):
+
+		try:
+			r=self.renderer(parent=self)
+			r.start()
+			self._idle.put(r)
+		except:
+			self.log("HTML renderer could not be started","e")
+			self.log_traceback()
+
+	#######
+	#render
+	#######
+
+	@_dbg
+	def render(self,payload):
+		"""renders the HTML 'payload' (bytes) to PDF
+		returns output,error,returncode like the renderer"""
+		start=time.time()
+
+		with self._lock:
+
+			if self._closed or self._waiting>=self.queuesize:
+				self.log("render queue is full","w")
+				return b"",b"render queue is full",-1
+
+			self._waiting+=1
+
+		try:
+			r=self._idle.get(timeout=self.timeout)
+		except queue.Empty:
+			r=None
+
+		with self._lock:
+			self._waiting-=1
+
+		if r==None:
+			self.log("no HTML renderer available","e")
+			return b"",b"no renderer available",-1
+
+		try:
+			timeout=max(1,self.timeout-(time.time()-start))
+			return r.render(payload,timeout)
+		finally:
+
+			if r.jobs>=r.maxjobs:
+				r.stop()
+
+				if not self._closed:
+					self._start_renderer()
+
+			else:
+				self._idle.put(r)
+
+	######
+	#close
+	######
+
+	@_dbg
+	def close(self):
+		"stops all idle renderers"
+		self._closed=True
+
+		while True:
+
+			try:
+				r=self._idle.get_nowait()
+			except queue.Empty:
+				break
+
+			r.stop()
+
+__all__=["_RENDERPOOL","_basehtmlrenderer"]
@@ -1,15 +1,120 @@
 #License GPL v3
 #Author Horst Knorr <gpgmailencrypt@gmx.de>
+import base64
 import email
 import email.utils
+import hashlib
 import os
 import re
 import subprocess
-import tempfile
 from	.child 			import _gmechild
 from	.version		import *
 from	._dbg 			import _dbg
 
+#the MIME types, that can contain a PKCS#7 signedData structure
+_PKCS7TYPES=(   "application/pkcs7-signature",
+				"application/x-pkcs7-signature",
+				"application/pkcs7-mime",
+				"application/x-pkcs7-mime")
+#OID 1.2.840.113549.1.7.2 (signedData)
+_SIGNEDDATA=bytes.fromhex("2a864886f70d010702")
+
+#############
+#_der_element
+#############
+
+def _der_element(data,pos):
+	"returns the tag, start and end of the content of the element at 'pos'"
+	tag=data[pos]
+	length=data[pos+1]
+	pos+=2
+
+	if length&0x80:
+		n=length&0x7f
+
+		if n==0 or n>4:
+			#indefinite length (BER) or too big
+			raise ValueError("unsupported length")
+
+		length=int.from_bytes(data[pos:pos+n],"big")
+		pos+=n
+
+	if pos+length>len(data):
+		raise ValueError("element longer than data")
+
+	return tag,pos,pos+length
+
+####################
+#_pkcs7_certificates
+####################
+
+def _pkcs7_certificates(data):
+	"returns the DER encoded certificates of a PKCS#7 signedData structure"
+	tag,start,end=_der_element(data,0)
+
+	if tag!=0x30:
+		raise ValueError("no ContentInfo")
+
+	tag,start,end=_der_element(data,start)
+
+	if tag!=0x06 or data[start:end]!=_SIGNEDDATA:
+		#e.g. envelopedData, it does not contain certificates
+		return []
+
+	tag,start,end=_der_element(data,end)
+
+	if tag!=0xa0:
+		raise ValueError("no content")
+
+	tag,pos,end=_der_element(data,start)
+
+	if tag!=0x30:
+		raise ValueError("no SignedData")
+
+	certs=[]
+
+	while pos<end:
+		tag,start,stop=_der_element(data,pos)
+
+		#certificates [0] IMPLICIT, the other elements are skipped
+		if tag==0xa0:
+
+			while start<stop:
+				t,s,e=_der_element(data,start)
+
+				if t==0x30:
+					certs.append(bytes(data[start:e]))
+
+				start=e
+
+			break
+
+		pos=stop
+
+	return certs
+
+#########
+#_der2pem
+#########
+
+def _der2pem(der):
+	b64=base64.b64encode(der)
+	lines=[b64[i:i+64] for i in range(0,len(b64),64)]
+	return (b"-----BEGIN CERTIFICATE-----\n"+
+			b"\n".join(lines)+
+			b"\n-----END CERTIFICATE-----\n")
+
+#########
+#_pem2der
+#########
+
+def _pem2der(pem):
+	"returns the DER encoded certificates of a PEM file"
+	return [base64.b64decode(c) for c in re.findall(
+						b"-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----",
+						pem,
+						re.DOTALL)]
+
 #############
 #CLASS _SMIME
 #############
@@ -426,49 +531,86 @@ class _SMIME(_gmechild):
 		"""
 		smime messages usually contain the public key of the sender address.
 		This function extracts the key and stores it in the directory
-		'targetdir'.
+		'targetdir'. The certificates are read from the signature parts
+		of 'mail', certificates that are already stored are skipped.
+		Returns the name of the last written file or None.
 		"""
 		self.debug("extract_publickey_from_mail to '%s'"%targetdir)
-		f=tempfile.NamedTemporaryFile(mode='wb',delete=False,prefix='mail-')
-		fname=f.name
 
-		if isinstance(mail,email.message.Message):
-			mail=mail.as_string()
+		if isinstance(mail,str):
+			mail=email.message_from_string(mail)
+		elif isinstance(mail,bytes):
+			mail=email.message_from_bytes(mail)
 
-		if not isinstance(mail,str):
+		if not isinstance(mail,email.message.Message):
 			self.log("smimeclass mail object of wrong type","e")
 			return None
 
-		mailfile=self.parent._new_tempfile()
-		mailfile.write(mail.encode("UTF-8",unicodeerror))
-		mailfile.close()
+		keys=[]
 
-		cmd=[   self.parent._SMIMECMD,
-				"smime",
-				"-in", mailfile.name,
-				"-pk7out",
-				"2>/dev/null","|",
+		for part in mail.walk():
 
-				self.parent._SMIMECMD,
-				"pkcs7",
-				"-print_certs",
-				"-out",f.name,
-				"2>/dev/null"]
-		self.debug("extractcmd :'%s'"%" ".join(cmd))
-		_result = subprocess.call( " ".join(cmd) ,shell=True)
-		f.close()
-		size=os.path.getsize(fname)
-		self.parent._del_tempfile(mailfile.name)
+			if part.get_content_type() not in _PKCS7TYPES:
+				continue
+
+			payload=part.get_payload(decode=True)
+
+			if not payload:
+				continue
+
+			certs=self._get_certificates(payload)
+
+			if len(certs)==0:
+				continue
+
+			#the file is named after the first certificate and contains
+			#the whole chain, like 'openssl pkcs7 -print_certs' does
+			keys.append((	hashlib.sha1(certs[0]).hexdigest(),
+							b"".join(_der2pem(c) for c in certs)))
+
+		if len(keys)==0:
+			return None
+
+		written=self.parent._keyindex.store(targetdir,keys,".pem")
 
-		if size==0:
-			os.remove(fname)
+		if len(written)==0:
 			return None
 
-		fp=self.get_certfingerprint(fname)
-		targetname=os.path.join(targetdir,"%s.pem"%fp)
-		self._copyfile(fname,targetname)
-		os.remove(fname)
-		return targetname
+		return written[-1]
+
+	##################
+	#_get_certificates
+	##################
+
+	@_dbg
+	def _get_certificates(self,payload):
+		"""returns the DER encoded certificates of a PKCS#7 signature.
+		openssl is only called if the signature can't be read directly"""
+
+		if payload.lstrip().startswith(b"-----BEGIN"):
+			return _pem2der(payload)
+
+		try:
+			return _pkcs7_certificates(payload)
+		except (IndexError,ValueError):
+			self.debug("PKCS#7 structure could not be read, use openssl")
+
+		cmd=[   self.parent._SMIMECMD,
+				"pkcs7",
+				"-inform","DER",
+				"-print_certs"]
+
+		try:
+			p = subprocess.Popen(   cmd,
+									stdin=subprocess.PIPE,
+									stdout=subprocess.PIPE,
+									stderr=subprocess.PIPE )
+			output,error=p.communicate(input=payload)
+		except:
+			self.log_traceback()
+			return []
+
+		return _pem2der(output)
 
 	###############
 	#create_keylist
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 #License GPL v3
 #Author Horst Knorr <gpgmailencrypt@gmx.de>
+import os
+import select
 import shutil
+import socket
 import subprocess
+import threading
 from	.child 				import _gmechild
 from	._dbg	 			import _dbg
 from	.version 			import *
@@ -29,6 +33,14 @@ class _basespamchecker(_gmechild):
 	def is_spam(self,mail):
 		raise NotImplementedError
 
+	@_dbg
+	def is_spam_batch(self,mails):
+		"returns a list of (spamlevel,score) tuples, one for every mail"
+		return [self.is_spam(m) for m in mails]
+
+	def close(self):
+		pass
+
 	def is_available(self):
 
 		if self.cmd!= None and len(self.cmd)>0:
@@ -36,6 +48,163 @@ class _basespamchecker(_gmechild):
 		else:
 			return False
 
+#############
+#_spamdclient
+#############
+
+class _spamdclient(_gmechild):
+	"""
+	native SPAMD/1.x protocol client, talks directly to spamd without
+	forking spamc. If 'persistent' is True the connection will be reused as
+	long as the server keeps it open, otherwise (or when the server closed
+	it) a new connection will be opened.
+	"""
+	PROTOCOL="SPAMC/1.5"
+
+	def __init__(	self,
+					parent,
+					host="localhost",
+					port=783,
+					timeout=30.0,
+					persistent=True):
+		_gmechild.__init__(self,parent=parent,filename=__file__)
+		self.host=host
+		self.port=port
+		self.timeout=timeout
+		self.persistent=persistent
+		self._sock=None
+		self._lock=threading.Lock()
+
+	######
+	#close
+	######
+
+	def close(self):
+
+		if self._sock!=None:
+
+			try:
+				self._sock.close()
+			except:
+				pass
+
+		self._sock=None
+
+	#############
+	#_is_reusable
+	#############
+
+	def _is_reusable(self):
+		"returns True if the open connection was not closed by spamd"
+
+		if self._sock==None:
+			return False
+
+		try:
+			r,w,e=select.select([self._sock],[],[],0)
+
+			if r and len(self._sock.recv(1,socket.MSG_PEEK))==0:
+				return False
+
+		except:
+			return False
+
+		return True
+
+	#########
+	#_connect
+	#########
+
+	def _connect(self):
+
+		if self.persistent and self._is_reusable():
+			return
+
+		self.close()
+		self._sock=socket.create_connection((self.host,self.port),
+											timeout=self.timeout)
+
+	##############
+	#_readresponse
+	##############
+
+	def _readresponse(self):
+		"returns the status line, the headers and the body of the response"
+		data=b""
+
+		while b"\r\n\r\n" not in data:
+			chunk=self._sock.recv(4096)
+
+			if not chunk:
+				break
+
+			data+=chunk
+
+		header,sep,body=data.partition(b"\r\n\r\n")
+		lines=header.decode("UTF-8",unicodeerror).split("\r\n")
+		headers={}
+
+		for l in lines[1:]:
+			key,sep,value=l.partition(":")
+			headers[key.strip().lower()]=value.strip()
+
+		try:
+			length=int(headers.get("content-length",0))
+		except:
+			length=0
+
+		while len(body)<length:
+			chunk=self._sock.recv(4096)
+
+			if not chunk:
+				break
+
+			body+=chunk
+
+		return lines[0],headers,body[:length]
+
+	########
+	#request
+	########
+
+	def request(self,verb,mail):
+		"""sends 'mail' (bytes or mmap) with the command 'verb' (CHECK or
+		SYMBOLS) and returns the status line, the headers and the body"""
+		header=("%s %s\r\nContent-length: %i\r\n\r\n"%(
+										verb,
+										self.PROTOCOL,
+										len(mail))).encode("UTF-8")
+
+		with self._lock:
+
+			for attempt in (1,2):
+				reused=self._sock!=None
+
+				try:
+					self._connect()
+
+					#big mails are sent separately, so that they are not
+					#copied. Small ones in one piece to avoid Nagle delays
+					if len(mail)>65536:
+						self._sock.sendall(header)
+						self._sock.sendall(mail)
+					else:
+						self._sock.sendall(header+mail)
+					result=self._readresponse()
+
+					if len(result[0])==0:
+						raise ConnectionError("empty response from spamd")
+
+					if not self.persistent:
+						self.close()
+
+					return result
+				except:
+					self.close()
+
+					if not reused or attempt==2:
+						raise
+
 ##############
 #_SPAMASSASSIN
 ##############
@@ -49,9 +218,24 @@ class _SPAMASSASSIN(_basespamchecker):
 		self._SPAMHOST="localhost"
 		self._SPAMPORT=783
 		self._SPAMMAXSIZE=5000000
-		self.cmd=shutil.which("spamc")
+		self._SPAMTIMEOUT=30.0
+		self._SPAMVERB="CHECK"
+		self._SPAMPERSISTENT=True
+		self._USESPAMC=False
+		self.symbols=[]
 		self.set_leveldict(leveldict)
 
+		if self._USESPAMC:
+			self.cmd=shutil.which("spamc")
+		else:
+			self.cmd="spamd"
+
+		self._client=_spamdclient(	parent,
+									host=self._SPAMHOST,
+									port=self._SPAMPORT,
+									timeout=self._SPAMTIMEOUT,
+									persistent=self._SPAMPERSISTENT)
+
 	@_dbg
 	def set_leveldict(self,leveldict):
 		self.spamlevel=5.0
@@ -62,39 +246,98 @@ class _SPAMASSASSIN(_basespamchecker):
 			self.spammaybelevel,
 			self._SPAMHOST,
 			self._SPAMPORT,
-			self._SPAMMAXSIZE)=leveldict["SPAMASSASSIN"]
+			self._SPAMMAXSIZE)=leveldict["SPAMASSASSIN"][:5]
 		except:
 			self.log_traceback()
 
+		try:
+			(self._SPAMTIMEOUT,
+			self._SPAMVERB,
+			self._SPAMPERSISTENT,
+			self._USESPAMC)=leveldict["SPAMASSASSIN"][5:9]
+		except:
+			pass
+
+		if self._SPAMVERB not in ("CHECK","SYMBOLS"):
+			self._SPAMVERB="CHECK"
+
+	def _spamlevel(self,score):
+		spamlevel=S_NOSPAM
+
+		if score >self.spammaybelevel:
+
+			if score >self.spamlevel:
+				spamlevel=S_SPAM
+			else:
+				spamlevel=S_MAYBESPAM
+
+		return spamlevel
+
 	@_dbg
 	def is_spam(self,mail):
-			spamlevel=S_NOSPAM
-			p=subprocess.Popen([self.cmd,
-								"-s",str(self._SPAMMAXSIZE),
-								"-d",self._SPAMHOST,
-								"-R",
-								"-p",str(self._SPAMPORT)],
-								stdin=subprocess.PIPE,
-								stdout=subprocess.PIPE,
-								stderr=subprocess.PIPE)
-			result=p.communicate(input=mail.encode("UTF-8",
-										unicodeerror))[0].decode("UTF-8",
-										unicodeerror)
-			scoretext=result[:result.find("\n")].split("/")[0]
+		score=0.0
+		self.symbols=[]
 
-			try:
-				score=float(scoretext)
-			except:
-				self.log("Could not convert score to float","e")
+		if isinstance(mail,str):
+			mail=mail.encode("UTF-8",unicodeerror)
+
+		if len(mail)>self._SPAMMAXSIZE:
+			self.debug("Mail too big for spamcheck (%i bytes)"%len(mail))
+			return S_NOSPAM,score
 
-			if score >self.spammaybelevel:
+		if self._USESPAMC:
+			return self._is_spam_spamc(mail)
+
+		try:
+			status,headers,body=self._client.request(self._SPAMVERB,mail)
+		except:
+			self.log("Could not connect to spamd %s:%s"%(self._SPAMHOST,
+														self._SPAMPORT),"e")
+			self.log_traceback()
+			return S_NOSPAM,score
 
-				if score >self.spamlevel:
-					spamlevel=S_SPAM
-				else:
-					spamlevel=S_MAYBESPAM
+		if not status.startswith("SPAMD/") or not status.endswith("EX_OK"):
+			self.log("spamd error '%s'"%status,"e")
+			return S_NOSPAM,score
 
-			return spamlevel,score
+		try:
+			#Spam: True ; 15.0 / 5.0
+			score=float(headers["spam"].split(";")[1].split("/")[0])
+		except:
+			self.log("Could not convert score to float","e")
+
+		if self._SPAMVERB=="SYMBOLS":
+			self.symbols=[	sym.strip()
+							for sym in body.decode("UTF-8",
+													unicodeerror).split(",")
+							if len(sym.strip())>0]
+			self.debug("Spam symbols: %s"%",".join(self.symbols))
+
+		return self._spamlevel(score),score
+
+	def _is_spam_spamc(self,mail):
+		score=0.0
+		p=subprocess.Popen([self.cmd,
+							"-s",str(self._SPAMMAXSIZE),
+							"-d",self._SPAMHOST,
+							"-R",
+							"-p",str(self._SPAMPORT)],
+							stdin=subprocess.PIPE,
+							stdout=subprocess.PIPE,
+							stderr=subprocess.PIPE)
+		result=p.communicate(input=mail)[0].decode("UTF-8",
+									unicodeerror)
+		scoretext=result[:result.find("\n")].split("/")[0]
+
+		try:
+			score=float(scoretext)
+		except:
+			self.log("Could not convert score to float","e")
+
+		return self._spamlevel(score),score
+
+	def close(self):
+		self._client.close()
 
 ############
 #_BOGOFILTER
@@ -111,31 +354,90 @@ class _BOGOFILTER(_basespamchecker):
 	def set_leveldict(self,leveldict):
 		pass
 
+	def _parse_result(self,level,scoretext):
+		spamlevel=S_NOSPAM
+		score=0.0
+
+		try:
+			score=float(scoretext)*50
+		except:
+			self.log("Could not convert score to float","e")
+
+		if level =="S":
+			spamlevel=S_SPAM
+		elif level == "U":
+			spamlevel=S_MAYBESPAM
+
+		return spamlevel,score
+
 	@_dbg
 	def is_spam(self,mail):
 			self.debug("Spamcheck bogofilter")
-			spamlevel=S_NOSPAM
+
+			if isinstance(mail,str):
+				mail=mail.encode("UTF-8",unicodeerror)
+
+			p=subprocess.Popen([self.cmd,
+								"-T"],
+								stdin=subprocess.PIPE,
+								stdout=subprocess.PIPE,
+								stderr=subprocess.PIPE)
+			result=p.communicate(input=mail)[0].decode("UTF-8",
+										unicodeerror)
+			level,sep,scoretext=result[:result.find("\n")].partition(" ")
+			return self._parse_result(level,scoretext.strip())
+
+	@_dbg
+	def is_spam_batch(self,mails):
+		"""scores all mails with one bogofilter process in bulk mode ('-b')
+		and returns a list of (spamlevel,score) tuples"""
+		self.debug("Spamcheck bogofilter bulk mode")
+		directory=self.parent._mkdtemp(prefix="gmespam-")
+		names=[]
+		results=[(S_NOSPAM,0.0)]*len(mails)
+
+		try:
+
+			for i,mail in enumerate(mails):
+
+				if isinstance(mail,str):
+					mail=mail.encode("UTF-8",unicodeerror)
+
+				name=os.path.join(directory,"%i.eml"%i)
+
+				with open(name,"wb") as f:
+					f.write(mail)
+
+				names.append(name)
+
 			p=subprocess.Popen([self.cmd,
+								"-b",
 								"-T"],
 								stdin=subprocess.PIPE,
 								stdout=subprocess.PIPE,
 								stderr=subprocess.PIPE)
-			result=p.communicate(input=mail.encode("UTF-8",
+			output=p.communicate(input=("\n".join(names)+"\n").encode(
+										"UTF-8",
 										unicodeerror))[0].decode("UTF-8",
 										unicodeerror)
-			level,scoretext=result[:result.find("\n")].split(" ")
 
-			try:
-				score=float(scoretext)*50
-			except:
-				self.log("Could not convert score to float","e")
+			for line in output.splitlines():
+				#<filename> <S|H|U> <score>
+				res=line.rsplit(" ",2)
 
-			if level =="S":
-				spamlevel=S_SPAM
-			elif level == "U":
-				spamlevel=S_MAYBESPAM
+				if len(res)!=3 or res[0] not in names:
+					continue
+
+				results[names.index(res[0])]=self._parse_result(res[1],
+																res[2])
+
+		except:
+			self.log("bogofilter bulk mode failed","e")
+			self.log_traceback()
+		finally:
+			shutil.rmtree(directory,ignore_errors=True)
 
-			return spamlevel,score
+		return results
 
 ################################################################################
 
@@ -39,6 +39,15 @@ class _base_storage(_gmechild):
 	def close(self):
 		pass
 
+	#####################
+	#reconnect_after_fork
+	#####################
+
+	@_dbg
+	def reconnect_after_fork(self):
+		"called in a forked process, which must not use the parent connection"
+		pass
+
 	################
 	#read_configfile
 	################
@@ -192,6 +201,34 @@ class _base_storage(_gmechild):
 		self.log("_base_storage adm_init_passwords not implemented")
 		raise NotImplementedError
 
+	##################
+	#get_virusverdicts
+	##################
+
+	@_dbg
+	def get_virusverdicts(self):
+		"""returns the stored virus verdicts as a list of tuples
+		(hash,infected,info,signature,checktime)"""
+		raise NotImplementedError
+
+	##################
+	#set_virusverdicts
+	##################
+
+	@_dbg
+	def set_virusverdicts(self,verdicts):
+		"stores a list of virus verdicts, see get_virusverdicts"
+		raise NotImplementedError
+
+	######################
+	#del_old_virusverdicts
+	######################
+
+	@_dbg
+	def del_old_virusverdicts(self,age):
+		"deletes clean verdicts, that are older than 'age' seconds"
+		raise NotImplementedError
+
 
 ##############
 #_TEXT_BACKEND
@@ -733,6 +770,31 @@ class _TEXT_BACKEND(_base_storage):
 
 		return users
 
+	##################
+	#get_virusverdicts
+	##################
+
+	@_dbg
+	def get_virusverdicts(self):
+		"the text backend keeps the verdict cache in memory only"
+		return []
+
+	##################
+	#set_virusverdicts
+	##################
+
+	@_dbg
+	def set_virusverdicts(self,verdicts):
+		pass
+
+	######################
+	#del_old_virusverdicts
+	######################
+
+	@_dbg
+	def del_old_virusverdicts(self,age):
+		pass
+
 #############
 #_sql_backend
 #############
@@ -776,6 +838,7 @@ class _sql_backend(_base_storage):
 		self._USE_SQLGPGADDITIONALENCRYPTIONKEYS=False
 		self._USE_SQLSMIMEADDITIONALENCRYPTIONKEYS=False
 		self._USE_SQLPDFADDITIONALENCRYPTIONKEY=False
+		self._USE_SQLVIRUSCACHE=False
 		self._db=None
 		self._cursor=None
 		self.placeholder="?"
@@ -841,6 +904,14 @@ class _sql_backend(_base_storage):
 		self._tabledefinition["pdfencryptionkeysindex"]=(
 				"create unique index pdfencindex on pdfencryptionkeys "
 													"(\"user\");")
+		self._tabledefinition["viruscache"]=("create table \"viruscache\" ("
+								"\"hash\" varchar (64) not null, "
+								"\"infected\" tinyint, "
+								"\"info\" varchar (255), "
+								"\"signature\" varchar (255), "
+								"\"checktime\" float);")
+		self._tabledefinition["viruscacheindex"]=(
+				"create unique index vcindex on viruscache (\"hash\");")
 
 
 	########
@@ -865,6 +936,21 @@ class _sql_backend(_base_storage):
 		self._db=None
 		self._cursor=None
 
+	#####################
+	#reconnect_after_fork
+	#####################
+
+	@_dbg
+	def reconnect_after_fork(self):
+		"opens a new database connection in a forked process"
+		#the inherited connection still belongs to the parent process.
+		#It is kept, because closing it would end the session of the
+		#parent on the database server
+		self._inherited_connection=(self._db,self._cursor)
+		self._db=None
+		self._cursor=None
+		self.connect()
+
 	########
 	#connect
 	########
@@ -1007,6 +1093,12 @@ class _sql_backend(_base_storage):
 			except:
 				pass
 
+			try:
+				self._USE_SQLVIRUSCACHE=cfg.getboolean('sql',
+														'use_sqlviruscache')
+			except:
+				pass
+
 			try:
 				self._PDFPASSWORDUSERFIELD=cfg.get('sql',
 													'sqlpdf_userfield')
@@ -1282,6 +1374,9 @@ class _sql_backend(_base_storage):
 				if not self.create_table("pdfencryptionkeys",logerror=logerror):
 					raise Exception
 
+				if not self.create_table("viruscache",logerror=logerror):
+					raise Exception
+
 			except:
 				return False
 
@@ -1350,6 +1445,14 @@ class _sql_backend(_base_storage):
 			if r==True:
 				return self.create_single_table("pdfencryptionkeysindex",
 												logerror=logerror)
+
+		if table=="viruscache":
+			r=self.create_single_table("viruscache",logerror=logerror)
+
+			if r==True:
+				return self.create_single_table("viruscacheindex",
+												logerror=logerror)
+
 		return False
 
 	##################
@@ -1393,6 +1496,10 @@ class _sql_backend(_base_storage):
 			failed.append("pdfencryptionkeys")
 			result=False
 
+		if not self.create_table("viruscache",logerror=logerror):
+			failed.append("viruscache")
+			result=False
+
 		return result,failed
 
 	##########
@@ -1772,6 +1879,87 @@ class _sql_backend(_base_storage):
 		self.con_end()
 		return pw
 
+	##################
+	#get_virusverdicts
+	##################
+
+	@_dbg
+	def get_virusverdicts(self):
+
+		if not self._USE_SQLVIRUSCACHE:
+			return self._textbackend.get_virusverdicts()
+
+		sql=("SELECT %(fbdlm)shash%(fedlm)s,%(fbdlm)sinfected%(fedlm)s,"
+			"%(fbdlm)sinfo%(fedlm)s,%(fbdlm)ssignature%(fedlm)s,"
+			"%(fbdlm)schecktime%(fedlm)s FROM %(fbdlm)sviruscache%(fedlm)s"
+			%{	"fbdlm":self._fieldbegindelimiter,
+				"fedlm":self._fieldenddelimiter})
+
+		if not self.execute(sql):
+			return []
+
+		verdicts=[]
+
+		for r in self._cursor.fetchall():
+			verdicts.append((r[0],(r[1]==1),r[2],r[3],float(r[4])))
+
+		self.con_end()
+		return verdicts
+
+	##################
+	#set_virusverdicts
+	##################
+
+	@_dbg
+	def set_virusverdicts(self,verdicts):
+
+		if not self._USE_SQLVIRUSCACHE:
+			return self._textbackend.set_virusverdicts(verdicts)
+
+		for _hash,infected,info,signature,checktime in verdicts:
+			fields={"fbdlm":self._fieldbegindelimiter,
+					"fedlm":self._fieldenddelimiter,
+					"tdlm":self._textdelimiter,
+					"hash":_hash,
+					"infected":int(infected),
+					"info":str(info).replace(self._textdelimiter,""),
+					"signature":str(signature).replace(self._textdelimiter,""),
+					"checktime":checktime}
+			deletesql=("DELETE FROM %(fbdlm)sviruscache%(fedlm)s "
+					"WHERE %(fbdlm)shash%(fedlm)s=%(tdlm)s%(hash)s%(tdlm)s"
+					%fields)
+			insertsql=("INSERT INTO %(fbdlm)sviruscache%(fedlm)s "
+					"(%(fbdlm)shash%(fedlm)s,%(fbdlm)sinfected%(fedlm)s,"
+					"%(fbdlm)sinfo%(fedlm)s,%(fbdlm)ssignature%(fedlm)s,"
+					"%(fbdlm)schecktime%(fedlm)s) "
+					"VALUES (%(tdlm)s%(hash)s%(tdlm)s,%(infected)i,"
+					"%(tdlm)s%(info)s%(tdlm)s,%(tdlm)s%(signature)s%(tdlm)s,"
+					"%(checktime)f)"
+					%fields)
+			self.execute_action(deletesql)
+			self.execute_action(insertsql)
+
+	######################
+	#del_old_virusverdicts
+	######################
+
+	@_dbg
+	def del_old_virusverdicts(self,age):
+
+		if not self._USE_SQLVIRUSCACHE:
+			return self._textbackend.del_old_virusverdicts(age)
+
+		sql=("DELETE FROM %(fbdlm)sviruscache%(fedlm)s "
+				"WHERE %(fbdlm)sinfected%(fedlm)s=0 "
+					"AND %(fbdlm)schecktime%(fedlm)s<%(age)f"
+				%	{
+					"fbdlm":self._fieldbegindelimiter,
+					"fedlm":self._fieldenddelimiter,
+					"age":(time.time()-age)
+					})
+		self.debug(sql)
+		self.execute_action(sql)
+
 #################
 #_SQLITE3_BACKEND
 #################
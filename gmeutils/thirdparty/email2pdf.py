@@ -63,7 +63,13 @@ WKHTMLTOPDF_ERRORS_IGNORE = frozenset(
 WKHTMLTOPDF_EXTERNAL_COMMAND = 'wkhtmltopdf'
 
 
-def main(argv, syslog_handler, syserr_handler,parent):
+def main(argv, syslog_handler, syserr_handler,parent,result=None,
+         renderer=None):
+    # if 'result' is a dictionary, the PDF is not written to the output file,
+    # but returned as result["pdf"] together with the metadata in
+    # result["metadata"]
+    # 'renderer' is a function, that renders the HTML to PDF instead of a
+    # new wkhtmltopdf process, see gmeutils.renderpool
     logger = logging.getLogger('email2pdf')
     warning_count_filter = WarningCountFilter()
     logger.addFilter(warning_count_filter)
@@ -141,7 +147,9 @@ def main(argv, syslog_handler, syserr_handler,parent):
         logger.debug("Final payload before output_body_pdf: " + payload)
         output_body_pdf(input_email,
                         payload.encode('UTF-8',_unicodeerror),
-                        output_file_name)
+                        output_file_name,
+                        result,
+                        renderer)
 
     if args.attachments:
         number_of_attachments = handle_attachments(input_email,
@@ -710,16 +718,29 @@ def handle_html_message_body(input_email, part,parent):
     return (payload, cid_parts_used)
 
 
-def output_body_pdf(input_email, payload, output_file_name):
+def output_body_pdf(input_email, payload, output_file_name, result=None,
+                    renderer=None):
     logger = logging.getLogger("email2pdf")
-    wkh2p_process = Popen([WKHTMLTOPDF_EXTERNAL_COMMAND, 
-    						'-q', 
-    						'--load-error-handling', 'ignore',
-                           '--load-media-error-handling', 'ignore', 
-                           '--encoding', 'utf-8', '-',
-                           output_file_name], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    output, error = wkh2p_process.communicate(input=payload)
-    assert output == b''
+
+    if result is not None and renderer is not None:
+        output, error, returncode = renderer(payload)
+    else:
+
+        if result is not None:
+            # write the PDF to stdout
+            output_file_name = '-'
+
+        wkh2p_process = Popen([WKHTMLTOPDF_EXTERNAL_COMMAND, 
+        						'-q', 
+        						'--load-error-handling', 'ignore',
+                               '--load-media-error-handling', 'ignore', 
+                               '--encoding', 'utf-8', '-',
+                               output_file_name], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        output, error = wkh2p_process.communicate(input=payload)
+        returncode = wkh2p_process.returncode
+
+    if result is None:
+        assert output == b''
     stripped_error = str(error, 'utf-8')
 
     for error_pattern in WKHTMLTOPDF_ERRORS_IGNORE:
@@ -731,10 +752,10 @@ def output_body_pdf(input_email, payload, output_file_name):
     original_error = str(error, 'utf-8').rstrip()
     stripped_error = stripped_error.rstrip()
 
-    if wkh2p_process.returncode > 0 and original_error == '':
-        logger.debug("wkhtmltopdf failed with exit code " + str(wkh2p_process.returncode) + ", no error output.")
-    elif wkh2p_process.returncode > 0 and stripped_error != '':
-        logger.debug("wkhtmltopdf failed with exit code " + str(wkh2p_process.returncode) + ", stripped error: " +
+    if returncode > 0 and original_error == '':
+        logger.debug("wkhtmltopdf failed with exit code " + str(returncode) + ", no error output.")
+    elif returncode > 0 and stripped_error != '':
+        logger.debug("wkhtmltopdf failed with exit code " + str(returncode) + ", stripped error: " +
                              str(stripped_error, 'utf-8'))
     elif stripped_error != '':
         logger.debug("wkhtmltopdf exited with rc = 0 but produced unknown stripped error output " + stripped_error)
@@ -747,6 +768,12 @@ def output_body_pdf(input_email, payload, output_file_name):
             add_metadata_obj[key] = get_utf8_header(input_email[HEADER_MAPPING[key]])
 
     add_metadata_obj['Producer'] = 'email2pdf'
+
+    if result is not None:
+        result['pdf'] = output
+        result['metadata'] = add_metadata_obj
+        return
+
     add_update_pdf_metadata(output_file_name, add_metadata_obj)
 
 def remove_invalid_urls(payload,use_externallinks=True):
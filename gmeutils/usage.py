@@ -110,6 +110,14 @@ def print_exampleconfig():
 	print ("decrypt=False".ljust(space)+
 	"#if True it will be tried to decrypt already encrypted e-mails sent to ")
 	print ("".ljust(space)+	"#recipients in 'homedomains'")
+	print ("parallelchecks=4".ljust(space)+
+	"#number of threads, that run spam check, virus check, key extraction")
+	print ("".ljust(space)+
+	"#and the policy lookup in parallel (1=one after the other)")
+	print ("tempdir=".ljust(space)+
+	"#directory for the temporary files, e.g. a tmpfs like /dev/shm.")
+	print ("".ljust(space)+
+	"#Every mail gets its own subdirectory, empty=system default")
 
 	print ("")
 	print ("[mailserver]")
@@ -174,12 +182,52 @@ def print_exampleconfig():
 	"#the x509 certificate cert file")
 	print ("authenticate = False".ljust(space)+
 	"#users must authenticate")
+	print ("authworkers=2".ljust(space)+
+	"#threads that verify passwords outside of the smtp loop")
+	print ("authcachettl=300".ljust(space)+
+	"#seconds a verified login is kept in memory (0=no cache)")
+	print ("workers=1".ljust(space)+
+	"#number of server processes, that share the smtp port. If >1 a")
+	print ("".ljust(space)+
+	"#supervisor process keeps the deferred mails and the quarantine and")
+	print ("".ljust(space)+
+	"#restarts crashed workers. The limits below apply per worker")
+	print ("maxsessions=100".ljust(space)+
+	"#max. concurrent smtp sessions, more are rejected with 421 (0=no limit)")
+	print ("maxinflight=20".ljust(space)+
+	"#max. messages received or processed at the same time, more are")
+	print ("".ljust(space)+
+	"#rejected with 451 (0=no limit)")
+	print ("maxqueuedbytes=268435456".ljust(space)+
+	"#max. bytes of these messages in memory, more are rejected with 451")
+	print ("".ljust(space)+
+	"#(0=no limit)")
+	print ("maxmessagesize=0".ljust(space)+
+	"#max. size of a message in bytes, announced with SIZE (0=no limit)")
+	print ("".ljust(space)+
+	"#without spilling at most maxqueuedbytes, bigger mails get 552")
+	print ("ipratelimit=0".ljust(space)+
+	"#max. connections per minute and client IP (0=no limit)")
+	print ("senderratelimit=0".ljust(space)+
+	"#max. messages per minute and sender (0=no limit)")
+	print ("smtputf8=True".ljust(space)+
+	"#announce SMTPUTF8, mails with UTF-8 addresses are accepted")
+	print ("spillsize=1048576".ljust(space)+
+	"#mails bigger than this are received into a temporary file instead")
+	print ("".ljust(space)+
+	"#of the memory (0=always in memory)")
 	print ("smtppasswords = /etc/gpgmailencrypt.pw".ljust(space)+
 	"#file that includes users and passwords")
 	print ("admins=admin1,admin2".ljust(space)+
 	"#comma separated list of admins, that can use the admin console")
 	print ("statistics=1".ljust(space)+
 	"#how often per day should statistical data be logged (0=none) max is 24")
+	print ("metricsfile=".ljust(space)+
+	"#if set, stage timings are written to this file in the")
+	print ("".ljust(space)+
+	"#Prometheus text format, e.g. for the node_exporter")
+	print ("metricsinterval=60".ljust(space)+
+	"#how often in seconds the metricsfile will be written")
 
 	print ("")
 	print ("[gpg]")
@@ -205,6 +253,8 @@ def print_exampleconfig():
 	"to encrypt each email")
 
 	print ("keyextractdir=~/.gnupg/extract")
+	print ("inlineworkers=4".ljust(space)+
+	"#number of mail parts, that are encrypted in parallel (PGPINLINE only)")
 
 	print ("")
 	print ("[smime]")
@@ -255,6 +305,20 @@ def print_exampleconfig():
 	"#the second password, with which all pdf files will be encrypted")
 	print ("includeimages=yes".ljust(space)+
 	"#if False  images from remote weblinks will not be embedded")
+	print ("nativetextrenderer=yes".ljust(space)+
+	"#if True, mails without HTML part are rendered without wkhtmltopdf")
+	print ("".ljust(space)+
+	"#(needs the python module reportlab)")
+	print ("textfont=".ljust(space)+
+	"#TrueType font for the native text renderer, default is DejaVuSansMono")
+	print ("renderers=2".ljust(space)+
+	"#number of wkhtmltopdf processes, that are started in advance")
+	print ("".ljust(space)+
+	"#in daemon mode. 0 starts a new process for every HTML mail")
+	print ("renderqueue=20".ljust(space)+
+	"#maximum number of HTML mails waiting for a free renderer")
+	print ("rendertimeout=60".ljust(space)+
+	"#maximum time in seconds for rendering an HTML mail")
 
 	print ("")
 	print ("[encryptionmap]")
@@ -290,6 +354,16 @@ def print_exampleconfig():
 	print ("zipattachments=False".ljust(space)+
 	"#if True all attachments will be zipped, independent "
 	"from the encryption method")
+	print ("workers=4".ljust(space)+
+	"#number of attachments of a mail, that are compressed in parallel")
+	print ("cpubudget=30".ljust(space)+
+	"#CPU seconds per mail for compressing attachments, remaining")
+	print ("".ljust(space)+
+	"#attachments will not be compressed. 0 means no limit")
+	print ("mingain=0.05".ljust(space)+
+	"#attachments will only be compressed, if a test compression of")
+	print ("".ljust(space)+
+	"#a sample saves at least this fraction. 0 switches the test off")
 
 	print ("")
 	print ("[virus]")
@@ -299,6 +373,14 @@ def print_exampleconfig():
 	"#how long an infected e-mail exists in the quarantine (in seconds)")
 	print ("".ljust(space)+
 	"#(default is 4 weeks). 0 deactivates automatic deletion")
+	print ("cache=True".ljust(space)+
+	"#if True, the scan results are cached per attachment content")
+	print ("cachettl=86400".ljust(space)+
+	"#how long a clean result is valid (in seconds), results with a virus")
+	print ("".ljust(space)+
+	"#are kept. Clean results expire, when the virus signatures change")
+	print ("cachesize=100000".ljust(space)+
+	"#maximum number of cached clean results")
 
 	print ("")
 	print ("[spam]")
@@ -319,6 +401,14 @@ def print_exampleconfig():
 	print("".ljust(space)+"#(value must be smaller than 'spamlevel')")
 	print ("maxsize=500000".ljust(space)+
 	"#maximum size of e-mail,that will be checked if it is spam")
+	print ("sa_timeout=30".ljust(space)+
+	"#timeout in seconds for the connection to spamd")
+	print ("sa_verb=CHECK".ljust(space)+
+	"#CHECK|SYMBOLS, SYMBOLS additionally logs the matched rules")
+	print ("sa_persistent=True".ljust(space)+
+	"#if True, the connection to spamd will be reused if possible")
+	print ("sa_usespamc=False".ljust(space)+
+	"#if True, 'spamc' is forked instead of talking directly to spamd")
 	print ("add_spamheader=False".ljust(space)+
 	"#if True the e-mail gets spam headers")
 	print ("change_subject=False".ljust(space)+
@@ -391,6 +481,8 @@ def print_exampleconfig():
 
 	print ("use_sqlpdfpasswords=False".ljust(space)+
 	"#if True the PDF passwords will be stored and taken from the sql database")
+	print ("use_sqlviruscache=False".ljust(space)+
+	"#if True the virus scan results will be stored in the sql database")
 	print ("sqlpdf_passwordtable=pdfpasswords".ljust(space)+
 	"#table that contains the pdf passwords")
 	print ("sqlpdf_userfield=user".ljust(space)+
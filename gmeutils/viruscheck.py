@@ -5,11 +5,168 @@ from 	.				import virusscanners
 from 	.				import archivemanagers
 from   	._dbg 			import _dbg
 from	.helpers		import decode_filename
+from	.mailstore		import _MAILSTORE
+import collections
 import email
+import hashlib
 import tempfile
 import os
 import re
 import shutil
+import threading
+import time
+
+##############
+#_verdictcache
+##############
+
+class _verdictcache(_gmechild):
+	"""
+	remembers the virus scan results per file content (SHA-256).
+	Clean verdicts expire after 'ttl' seconds or when the virus signatures
+	change, positive verdicts are kept.
+	"""
+
+	def __init__(self,parent,ttl,size,backend=None):
+		_gmechild.__init__(self,parent=parent,filename=__file__)
+		self.ttl=ttl
+		self.size=size
+		self.backend=backend
+		self._lock=threading.Lock()
+		self._clean=collections.OrderedDict()
+		self._infected={}
+		self._unsaved=[]
+		self.hits=0
+		self.misses=0
+		self.load()
+
+	#####
+	#load
+	#####
+
+	@_dbg
+	def load(self):
+		"reads the stored verdicts from the storage backend"
+
+		if self.backend==None:
+			return
+
+		try:
+			self.backend.del_old_virusverdicts(self.ttl)
+			verdicts=self.backend.get_virusverdicts()
+		except:
+			self.log("Virus verdicts could not be loaded","w")
+			self.log_traceback()
+			return
+
+		with self._lock:
+
+			for _hash,infected,info,signature,checktime in sorted(verdicts,
+														key=lambda v:v[4]):
+
+				if infected:
+					self._infected[_hash]=(info,signature,checktime)
+				else:
+					self._clean[_hash]=(signature,checktime)
+
+			while len(self._clean)>self.size:
+				self._clean.popitem(last=False)
+
+	####
+	#get
+	####
+
+	def get(self,_hash,signature):
+		"""returns (infected,info) or None, if the content with the
+		SHA-256 '_hash' has to be scanned"""
+
+		with self._lock:
+
+			if _hash in self._infected:
+				self.hits+=1
+				return True,self._infected[_hash][0]
+
+			v=self._clean.get(_hash)
+
+			if v!=None:
+
+				if v[0]==signature and time.time()-v[1]<self.ttl:
+					self._clean.move_to_end(_hash)
+					self.hits+=1
+					return False,""
+
+				del self._clean[_hash]
+
+			self.misses+=1
+			return None
+
+	####
+	#set
+	####
+
+	def set(self,_hash,infected,info,signature):
+		"stores the verdict for the content with the SHA-256 '_hash'"
+		checktime=time.time()
+
+		with self._lock:
+
+			if infected:
+				self._infected[_hash]=(info,signature,checktime)
+			else:
+				self._clean[_hash]=(signature,checktime)
+				self._clean.move_to_end(_hash)
+
+				while len(self._clean)>self.size:
+					self._clean.popitem(last=False)
+
+			self._unsaved.append((_hash,infected,info,signature,checktime))
+
+	######
+	#flush
+	######
+
+	@_dbg
+	def flush(self):
+		"""writes the new verdicts to the storage backend,
+		call it only from the thread, that uses the backend"""
+
+		with self._lock:
+			unsaved=self._unsaved
+			self._unsaved=[]
+
+		if self.backend==None or len(unsaved)==0:
+			return
+
+		try:
+			self.backend.set_virusverdicts(unsaved)
+		except:
+			self.log("Virus verdicts could not be stored","w")
+			self.log_traceback()
+
+	######
+	#clear
+	######
+
+	@_dbg
+	def clear(self):
+		"removes all verdicts from the memory"
+
+		with self._lock:
+			self._clean.clear()
+			self._infected.clear()
+			self._unsaved=[]
+			self.hits=0
+			self.misses=0
+
+	######
+	#count
+	######
+
+	def count(self):
+		"returns the number of cached verdicts"
+
+		with self._lock:
+			return len(self._clean)+len(self._infected)
 
 ###########
 #viruscheck
@@ -24,15 +181,28 @@ class _virus_check(_gmechild):
 		self.archivemap={}
 		self.unpacker={}
 		self.virusscanner={}
+		self._signature=None
+		self._signaturetime=0
+		self.cache=None
 		self._search_archivemanager()
 		self._search_virusscanner()
 
+		if parent._VIRUSCACHE:
+			self.cache=_verdictcache(	parent=self,
+										ttl=parent._VIRUSCACHETTL,
+										size=parent._VIRUSCACHESIZE,
+										backend=parent._backend)
+
 	###########
 	#_mktempdir
 	###########
 
 	@_dbg
 	def _mktempdir(self,directory=None):
+
+		if directory==None:
+			return self.parent._mkdtemp()
+
 		return tempfile.mkdtemp(dir=directory)
 
 	#######
@@ -81,6 +251,173 @@ class _virus_check(_gmechild):
 	def count_scanners(self):
 		return len(self.virusscanner)
 
+	##################
+	#signature_version
+	##################
+
+	@_dbg
+	def signature_version(self):
+		"""returns the combined signature version of all active scanners,
+		or None if the version of one scanner can't be found.
+		The scanners are asked at most once a minute"""
+
+		if time.time()-self._signaturetime>60:
+			versions=[]
+
+			for s in sorted(self.virusscanner):
+
+				try:
+					v=self.virusscanner[s].signature_version()
+				except:
+					v=None
+
+				if v==None:
+					self.log("Signature version of virus scanner %s unknown, "
+							"clean verdicts will not be cached"%s,"w")
+					versions=None
+					break
+
+				versions.append("%s=%s"%(s,v))
+
+			if versions==None:
+				self._signature=None
+			else:
+				self._signature=";".join(versions)
+
+			self._signaturetime=time.time()
+
+		return self._signature
+
+	############
+	#flush_cache
+	############
+
+	@_dbg
+	def flush_cache(self):
+		"writes new virus verdicts to the storage backend"
+
+		if self.cache!=None:
+			self.cache.flush()
+
+	##########
+	#_hashfile
+	##########
+
+	@_dbg
+	def _hashfile(self,filename):
+		h=hashlib.sha256()
+
+		with open(filename,"rb") as f:
+
+			for block in iter(lambda:f.read(65536),b""):
+				h.update(block)
+
+		return h.hexdigest()
+
+	#############
+	#_cachelookup
+	#############
+
+	@_dbg
+	def _cachelookup(self,directory,signature):
+		"""looks up every unpacked file in the verdict cache
+		returns the cached infections and a dictionary hash:[filenames]
+		of the content, that was not scanned yet"""
+		infections=[]
+		unseen={}
+
+		for root, directories, files in os.walk(directory):
+
+			for f in files:
+				pathf=os.path.join(root,f)
+
+				if os.path.islink(pathf):
+					continue
+
+				_hash=self._hashfile(pathf)
+				v=self.cache.get(_hash,signature)
+
+				if v==None:
+					unseen.setdefault(_hash,[]).append(pathf)
+				elif v[0]:
+					scanner,virusinfo=(v[1].split(":",1)+[""])[:2]
+					infections.append([scanner,f,virusinfo])
+
+		return infections,unseen
+
+	###############
+	#_move_for_scan
+	###############
+
+	@_dbg
+	def _move_for_scan(self,directory,unseen):
+		"""moves one file per unseen content into a new directory,
+		returns the directory and a dictionary filename:[hashes]"""
+		scandir=self._mktempdir()
+		names={}
+
+		for _hash in unseen:
+			pathf=unseen[_hash][0]
+			target=os.path.join(scandir,os.path.relpath(pathf,directory))
+			os.makedirs(os.path.dirname(target),exist_ok=True)
+			os.rename(pathf,target)
+			names.setdefault(os.path.basename(pathf),[]).append(_hash)
+
+		self._chmod(scandir)
+		return scandir,names
+
+	###############
+	#_store_results
+	###############
+
+	@_dbg
+	def _store_results(self,names,result,description,signature):
+		"""puts the verdicts of the scanned files into the cache
+		clean verdicts are only stored, if all scanners had a look at them
+		and their signature versions are known"""
+
+		if not result:
+
+			if signature==None:
+				return
+
+			for f in names:
+
+				for _hash in names[f]:
+					self.cache.set(_hash,False,"",signature)
+
+			return
+
+		for scanner,filename,virusinfo in description:
+
+			for _hash in names.get(filename,[]):
+				self.cache.set(	_hash,
+								True,
+								"%s:%s"%(scanner,virusinfo),
+								signature)
+
+	############
+	#_rmtempdirs
+	############
+
+	@_dbg
+	def _rmtempdirs(self,directories):
+
+		for directory in directories:
+
+			try:
+
+				if not self.parent._logger._DEBUG:
+					shutil.rmtree(directory)
+				else:
+					self.debug("keep directory %s for debugging reasons"
+								%directory)
+
+			except:
+				self.log("temporary directory '%s' could not be deleted"
+						%directory)
+				self.log_traceback()
+
 	#######################
 	#_search_archivemanager
 	#######################
@@ -242,6 +579,10 @@ class _virus_check(_gmechild):
 
 		if isinstance(mail,str):
 			mail=email.message_from_string(mail)
+		elif isinstance(mail,bytes):
+			mail=email.message_from_bytes(mail)
+		elif isinstance(mail,_MAILSTORE):
+			mail=mail.message()
 
 		tmpdir=self._mktempdir()
 		self.debug("has_virus tmpdir '%s'"%tmpdir)
@@ -293,12 +634,40 @@ class _virus_check(_gmechild):
 			return False,description
 
 		directory=self.unpack_email(mail)
+		tempdirs=[directory]
+		scandir=directory
+		names=None
 		result=False
+		complete=True
+
+		if self.cache!=None:
+
+			try:
+				signature=self.signature_version()
+				infections,unseen=self._cachelookup(directory,signature)
+
+				if len(infections)>0:
+					self.debug("_virus_check.has_virus cached virus found")
+					self._rmtempdirs(tempdirs)
+					return True,infections
+
+				if len(unseen)==0:
+					self.debug("_virus_check.has_virus all content known")
+					self._rmtempdirs(tempdirs)
+					return False,description
+
+				scandir,names=self._move_for_scan(directory,unseen)
+				tempdirs.append(scandir)
+			except:
+				self.log("Virus verdict cache failed, scan everything","w")
+				self.log_traceback()
+				scandir=directory
+				names=None
 
 		for scanner in self.virusscanner:
 			self.debug("Use virus scanner %s ..."%scanner)
 			try:
-				hasvirus,info=self.virusscanner[scanner].has_virus(directory)
+				hasvirus,info=self.virusscanner[scanner].has_virus(scandir)
 
 				if hasvirus:
 					self.debug("_virus_check.has_virus Virus found")
@@ -313,18 +682,12 @@ class _virus_check(_gmechild):
 						%scanner,
 						"e")
 				self.log_traceback()
+				complete=False
 
-		try:
-
-			if not self.parent._logger._DEBUG:
-				shutil.rmtree(directory)
-			else:
-				self.debug("keep directory %s for debugging reasons"%directory)
-
-		except:
-			self.log("temporary directory '%s' could not be deleted"%directory)
-			self.log_traceback()
+		if names!=None and (result or complete):
+			self._store_results(names,result,description,signature)
 
+		self._rmtempdirs(tempdirs)
 		return result,description
 
 
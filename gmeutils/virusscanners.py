@@ -15,18 +15,57 @@ from .version 			import *
 
 class _basevirusscanner(_gmechild):
 
+	#the directories with the virus definitions of the scanner
+	signaturedirs=[]
+
 	def __init__(self,parent):
 		_gmechild.__init__(self,parent=parent,filename=__file__)
 
 	def has_virus(self,directory):
 		raise NotImplementedError
 
+	##################
+	#signature_version
+	##################
+
+	@_dbg
+	def signature_version(self):
+		"""returns a string, that changes whenever the virus signatures
+		are updated, or None if the signature version can't be found.
+		The default is the newest modification time of the directories in
+		'signaturedirs' and of the files directly in them"""
+		versions=[]
+
+		for d in self.signaturedirs:
+
+			try:
+				mtime=os.stat(d).st_mtime
+
+				with os.scandir(d) as it:
+
+					for entry in it:
+
+						if entry.is_file():
+							mtime=max(mtime,entry.stat().st_mtime)
+
+			except OSError:
+				continue
+
+			versions.append("%s:%i"%(d,mtime))
+
+		if len(versions)==0:
+			return None
+
+		return ",".join(versions)
+
 #######
 #_AVAST
 #######
 
 class _AVAST(_basevirusscanner):
 
+	signaturedirs=["/var/lib/avast/Setup/filedir","/var/lib/avast"]
+
 	def __init__(self,parent):
 		self.cmd=shutil.which("scan")
 		_basevirusscanner.__init__(self,parent)
@@ -65,6 +104,8 @@ class _AVAST(_basevirusscanner):
 
 class _AVG(_basevirusscanner):
 
+	signaturedirs=["/opt/avg/av/var/data"]
+
 	def __init__(self,parent):
 		self.cmd=shutil.which("avgscan")
 		_basevirusscanner.__init__(self,parent)
@@ -105,6 +146,8 @@ class _AVG(_basevirusscanner):
 
 class _BITDEFENDER(_basevirusscanner):
 
+	signaturedirs=["/opt/BitDefender-scanner/var/lib/scan/Plugins"]
+
 	def __init__(self,parent):
 		self.cmd=shutil.which("bdscan")
 		_basevirusscanner.__init__(self,parent)
@@ -163,6 +206,8 @@ try:
 
 	class _CLAMAV(_basevirusscanner):
 
+		signaturedirs=["/var/lib/clamav"]
+
 		def __init__(self,parent):
 			self.clamd=pyclamd.ClamdAgnostic()
 			_basevirusscanner.__init__(self,parent)
@@ -182,6 +227,15 @@ try:
 
 			return result,information
 
+		@_dbg
+		def signature_version(self):
+
+			try:
+				#e.g. 'ClamAV 0.103.8/26950/Mon Jun 12 07:52:10 2023'
+				return self.clamd.version()
+			except:
+				return _basevirusscanner.signature_version(self)
+
 	_clamavscan_available=True
 except:
 	_clamavscan_available=False
@@ -192,6 +246,8 @@ except:
 
 class _COMODO(_basevirusscanner):
 
+	signaturedirs=["/opt/COMODO/scanners"]
+
 	def __init__(self,parent):
 		self.cmd=shutil.which("cmdscan")
 
@@ -239,6 +295,8 @@ class _COMODO(_basevirusscanner):
 
 class _DRWEB(_basevirusscanner):
 
+	signaturedirs=["/var/opt/drweb.com/bases","/var/drweb/bases"]
+
 	def __init__(self,parent):
 		self.cmd=shutil.which("drweb")
 		_basevirusscanner.__init__(self,parent)
@@ -279,6 +337,8 @@ class _DRWEB(_basevirusscanner):
 
 class _FPROT(_basevirusscanner):
 
+	signaturedirs=["/opt/f-prot"]
+
 	def __init__(self,parent):
 		self.cmd=shutil.which("fpscan")
 		_basevirusscanner.__init__(self,parent)
@@ -321,6 +381,8 @@ class _FPROT(_basevirusscanner):
 
 class _SOPHOS(_basevirusscanner):
 
+	signaturedirs=["/opt/sophos-av/lib/sav"]
+
 	def __init__(self,parent):
 		self.cmd=shutil.which("savscan")
 		_basevirusscanner.__init__(self,parent)
@@ -0,0 +1,84 @@
+#License GPL v3
+#Author Horst Knorr <gpgmailencrypt@gmx.de>
+from	.child			import _gmechild
+from	._dbg			import _dbg
+from	.version		import *
+from	functools		import wraps
+import	os
+import	shutil
+import	tempfile
+
+###########
+#_WORKSPACE
+###########
+
+class _WORKSPACE(_gmechild):
+	"""
+	scratch directory of one mail. All temporary files and directories,
+	that are created while the mail is processed, are inside of it and
+	are removed with one rmtree when the mail is done.
+	"""
+
+	def __init__(self,parent,directory=None):
+		_gmechild.__init__(self,parent=parent,filename=__file__)
+		self.path=tempfile.mkdtemp(prefix="gme-",dir=directory)
+		self.debug("_WORKSPACE '%s'"%self.path)
+
+	#########
+	#new_file
+	#########
+
+	def new_file(self,delete=False,prefix="mail-",suffix="",mode="wb"):
+		"returns a new NamedTemporaryFile in the workspace"
+		return tempfile.NamedTemporaryFile(	mode=mode,
+											delete=delete,
+											prefix=prefix,
+											suffix=suffix,
+											dir=self.path)
+
+	########
+	#mkdtemp
+	########
+
+	def mkdtemp(self,prefix=None):
+		"returns a new directory in the workspace"
+		return tempfile.mkdtemp(prefix=prefix,dir=self.path)
+
+	######
+	#close
+	######
+
+	@_dbg
+	def close(self):
+		"""removes the workspace. Returns the files, that were not deleted
+		by the code that created them"""
+		leftover=[]
+
+		for root,dirs,files in os.walk(self.path):
+			leftover+=[os.path.join(root,f) for f in files]
+
+		shutil.rmtree(self.path,ignore_errors=True)
+		return leftover
+
+###############
+#_use_workspace
+###############
+
+def _use_workspace(func):
+	"""decorator, the gme method runs in its own workspace. Nested calls
+	use the workspace of the outer call"""
+
+	@wraps(func)
+	def wrapper(self,*args,**kwargs):
+		created=self._open_workspace()
+
+		try:
+			return func(self,*args,**kwargs)
+		finally:
+
+			if created:
+				self._close_workspace()
+
+	return wrapper
+
+__all__=["_WORKSPACE","_use_workspace"]
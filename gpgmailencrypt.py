@@ -23,12 +23,14 @@ Create a configuration file with "gpgmailencrypt.py -x > ~/gpgmailencrypt.conf"
 and copy this file into the directory /etc
 """
 import base64
+import concurrent.futures
 import configparser
 import datetime
 import email
 import email.encoders
 import email.message
 import email.mime
+import email.parser
 import email.utils
 from   email.mime.base	  		import MIMEBase
 from   email.mime.multipart 	import MIMEMultipart
@@ -39,18 +41,25 @@ import gmeutils.archivemanagers as archivemanagers
 import gmeutils.storagebackend 	as backend
 import gmeutils.mylogger 		as mylogger
 from   gmeutils._dbg 		  	import _dbg
+from   gmeutils.authenticator 	import _AUTHENTICATOR
 from   gmeutils.gpgclass 		import _GPG,_GPGEncryptedAttachment
 from   gmeutils.gpgmailserver 	import _gpgmailencryptserver
 from   gmeutils.helpers			import *
+from   gmeutils.keyindex     	import _KEYINDEX
+from   gmeutils.mailstore     	import _MAILSTORE
+from   gmeutils.metrics       	import _METRICS,_measure
 from   gmeutils.mytimer       	import _mytimer
 from   gmeutils.smimeclass 		import _SMIME
 from   gmeutils.pdfclass 		import _PDF
+from   gmeutils.policy       	import _POLICYENGINE
+from   gmeutils.prefork       	import _PREFORKSUPERVISOR
+from   gmeutils.renderpool     	import _RENDERPOOL
 from   gmeutils.usage       	import show_usage,print_exampleconfig
 from   gmeutils.viruscheck    	import _virus_check
 from   gmeutils.version			import *
+from   gmeutils.workspace     	import _WORKSPACE,_use_workspace
 from   gmeutils.dkim			import mydkim
 import html
-from   io					  	import TextIOWrapper
 import locale
 import os
 import re
@@ -60,11 +69,78 @@ import smtplib
 import ssl
 import sys
 import tempfile
+import threading
 import time
 import traceback
+import zlib
 
 __all__ =["gme"]
 
+#file types, that are already compressed or shouldn't be touched
+_NOCOMPRESS_FILENAMES=frozenset(["winmail.dat","win.dat","signature.asc"])
+_COMPRESS_IMAGETYPES=frozenset(["bmp","x-windows-bmp","svg+xml","tiff",
+								"photoshop","x-photoshop","psd"])
+#raw image format
+_COMPRESS_RAWIMAGEEXTENSIONS=frozenset([
+		"3fr","ari","arw","bay","crw","cr2","cap","dcs","dcr","dng",
+		"drf","eip","erf","fff","iiq","k25","kdc","mdc","mef","mos",
+		"mrw","nef","nrw","obm","orf","pef","ptx","pxn","r3d","raf",
+		"raw","rwl","rw2","rwz","sr2","srf","srw","tif","x3f"])
+_COMPRESS_AUDIOTYPES=frozenset(["x-aiff","x-wav"])
+_NOCOMPRESS_APPLICATIONTYPES=frozenset([
+		#compressed archives
+		"zip","x-compressed","x-compress","x-gzip",
+		"x-gtar","x-lzip","x-lzma","x-lzh",
+		"x-lzop","x-zoo","x-rar-compressed","java-archive",
+		"x-7z-compressed","x-bzip","x-bzip2",
+		"vnd.android.package-archive","x-snappy-framed",
+		"x-xz","x-ace-compressed","x-astrotite-afa",
+		"x-alz-compressed","x-b1","x-dar","x-dgc-compressed",
+		"x-apple-diskimage","x-lzx",
+		"x-arj","vnd.ms-cab-compressed","x-cfs-compressed",
+		"x-stuffit","x-stuffitx",
+		#compressed Microsoft Office formats
+		"vnd.openxmlformats-officedocument.wordprocessingml.document",
+		"vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+		"vnd.openxmlformats-officedocument.presentationml.presentation",
+		#Openoffice/LibreOffice
+		"vnd.oasis.opendocument.text",
+		"vnd.oasis.opendocument.spreadsheet",
+		"vnd.oasis.opendocument.presentation",
+		"vnd.oasis.opendocument.graphics",
+		"vnd.oasis.opendocument.chart",
+		"vnd.oasis.opendocument.formula",
+		"vnd.oasis.opendocument.image",
+		"vnd.oasis.opendocument.text-master",
+		"vnd.oasis.opendocument.text-template",
+		"vnd.oasis.opendocument.spreadsheet-template",
+		"vnd.oasis.opendocument.presentation-template",
+		"vnd.oasis.opendocument.graphics-template",
+		#Miscellaneous
+		"epub+zip","vnd.gov.sk.e-form+zip"])
+_NOCOMPRESS_EXTENSIONS=frozenset([
+		#Images
+		"jpg","jpeg","png","gif","jif","jfif","jp2","j2k","jpx",
+		"j2c","psd",
+		#Videos
+		"mpeg","mpg","mpe","mpgv","mp4","mpg4","mov","avi","mkv",
+		"swf","flv","f4v","f4p","f4a","f4b","wmv","ogv","m2t",
+		"mjpeg","3gp","asx","m4v","rv","swz","rm","m2v","mv4",
+		"xwmv","3ga","mp3","ogg",
+		#Archives
+		"zip","zipx","arj","cpio","dar","deb","tgz","bz2","bz","gz",
+		"7z","s7z","7zip","ar","xar","kgb","lrz","lz","lzh",
+		"lha","lzo","lzma","rar","xz","apk","tbz","tbz2",
+		"tlz","txz","cab","rpm","sz","snappy","jar","z",
+		"zoo","zpaq",
+		#Office
+		"docx","xlsx","pptx","ods","odt","odp","ott","odm","oth",
+		"ots","odg","otg","odf","odb","oxt","odc","odi",
+		#Miscellaneous
+		"epub","ics"])
+#bytes per sample of the compression probe
+_COMPRESSPROBE_SAMPLESIZE=4096
+
 ####
 #gme
 ####
@@ -106,6 +182,9 @@ class gme:
 		self._queue_id=0
 		self._daemonstarttime=datetime.datetime.now()
 		self._RUNMODE=None
+		self._controlchannel=None
+		self._workerstatistics={}
+		self._metrics=_METRICS(parent=self)
 		self.reset_statistics()
 		self._logger=mylogger.mylogger(parent=self)
 		self.reset_messages()
@@ -133,6 +212,8 @@ class gme:
 		self._count_viruses=0
 		self._count_spam=0
 		self._count_maybespam=0
+		self._count_tempfileleaks=0
+		self._metrics.reset()
 
 	###############
 	#reset_messages
@@ -190,7 +271,9 @@ class gme:
 											_now-self._daemonstarttime))
 			self._log_statistics()
 
-		for f in self._tempfiles:
+		self._close_workspace()
+
+		for f in list(self._tempfiles):
 
 			try:
 				os.remove(f)
@@ -201,6 +284,32 @@ class gme:
 		if self._RUNMODE==self.m_daemon:
 			self.store_deferred_list()
 
+		if self._spam_checker!=None:
+			self._spam_checker.close()
+
+		if self._virus_checker!=None:
+			self._virus_checker.flush_cache()
+
+		if self._check_executor!=None:
+			self._check_executor.shutdown(wait=True)
+			self._check_executor=None
+
+		if self._zip_executor!=None:
+			self._zip_executor.shutdown(wait=True)
+			self._zip_executor=None
+
+		if self._encrypt_executor!=None:
+			self._encrypt_executor.shutdown(wait=True)
+			self._encrypt_executor=None
+
+		if self._renderpool!=None:
+			self._renderpool.close()
+			self._renderpool=None
+
+		if self._authenticator!=None:
+			self._authenticator.close()
+			self._authenticator=None
+
 		self._logger.close()
 		self._backend.close()
 
@@ -213,13 +322,22 @@ class gme:
 		"initiales the module and reads the config file"
 
 		#Internal variables
-		self._tempfiles = list()
+		self._tempfiles = set()
+		self._workspace=None
+		self._keyindex=_KEYINDEX(parent=self)
+		self._pdfpasswordsources=dict()
+		self._policyengine=None
 		self._mailcount=0
 		self._encryptgpgcomment="Encrypted by gpgmailencrypt version %s"%VERSION
 		self._smtpd_passwords=dict()
 		self._encoding = locale.getdefaultlocale()[1]
 		self._virus_checker=None
 		self._spam_checker=None
+		self._check_executor=None
+		self._zip_executor=None
+		self._encrypt_executor=None
+		self._renderpool=None
+		self._authenticator=None
 
 		if self._encoding==None:
 			self._encoding="UTF-8"
@@ -242,6 +360,8 @@ class gme:
 			os.makedirs(self._QUARANTINEDIR)
 
 		self._STATISTICS_PER_DAY=1
+		self._METRICSFILE=""
+		self._METRICSINTERVAL=60
 		self._SYSTEMMAILFROM="gpgmailencrypt@localhost"
 		self._ALWAYSENCRYPT=False
 		self._ADDHEADER=False
@@ -288,6 +408,7 @@ class gme:
 		self._GPGMIME_ENCRYPTSUBJECT=False
 		self._GPGINLINE_ZIPCONTAINER=False
 		self._GPGINLINE_CONTENTPDF=False
+		self._GPGINLINEWORKERS=4
 		self._SMIMEKEYEXTRACTDIR=os.path.join(self._SMIMEKEYHOME,"extract")
 		self._SMIMECIPHER="DES3"
 		self._SMIMEAUTOMATICEXTRACTKEYS=False
@@ -300,6 +421,17 @@ class gme:
 		self._SMTPD_USE_STARTTLS=False
 		self._SMTPD_USE_AUTH=False
 		self._SMTPD_FORCETLS=False
+		self._AUTHWORKERS=2
+		self._AUTHCACHETTL=300
+		self._SMTPD_WORKERS=1
+		self._SMTPD_MAXSESSIONS=100
+		self._SMTPD_MAXINFLIGHT=20
+		self._SMTPD_MAXQUEUEDBYTES=256*1024*1024
+		self._SMTPD_MAXMESSAGESIZE=0
+		self._SMTPD_IPRATELIMIT=0
+		self._SMTPD_SENDERRATELIMIT=0
+		self._SMTPD_SMTPUTF8=True
+		self._SMTPD_SPILLSIZE=1024*1024
 		self._USEPDF=False
 		self._PDFPASSWORDMODE=self.pdf_sender
 		self._PDFPASSWORDSCRIPT="~/mailscript.sh"
@@ -307,14 +439,27 @@ class gme:
 		self._PDFPASSWORDLENGTH=10
 		self._PDFPASSWORDLIFETIME=48*60*60
 		self._PDFINCLUDEIMAGES=True
+		self._PDFNATIVETEXT=True
+		self._PDFTEXTFONT=""
+		self._PDFRENDERERS=2
+		self._PDFRENDERQUEUE=20
+		self._PDFRENDERTIMEOUT=60
 		self._7ZIPCMD=""
 		self._USE7ZARCHIVE=False
 		self._ZIPCIPHER="ZipCrypto"
 		self._ZIPCOMPRESSION=5
 		self._ZIPATTACHMENTS=False
+		self._ZIPWORKERS=4
+		self._ZIPMINGAIN=0.05
+		self._ZIPCPUBUDGET=30
+		self._PARALLELCHECKS=4
+		self._TEMPDIR=None
 		self._ADMINS=[]
 		self._VIRUSCHECK=False
 		self._VIRUSLIFETIME=2419200 #4 weeks
+		self._VIRUSCACHE=True
+		self._VIRUSCACHETTL=86400
+		self._VIRUSCACHESIZE=100000
 		self._SPAMCHECK=False
 		self._SPAMSCANNER="SPAMASSASSIN"
 		self._SA_SPAMHOST="localhost"
@@ -322,6 +467,10 @@ class gme:
 		self._SA_SPAMLEVEL=6.2
 		self._SA_SPAMSUSPECTLEVEL=3.0
 		self._SPAMMAXSIZE=500000
+		self._SA_SPAMTIMEOUT=30.0
+		self._SA_SPAMVERB="CHECK"
+		self._SA_PERSISTENT=True
+		self._SA_USESPAMC=False
 		self._SPAMCHANGESUBJECT=False
 		self._SPAMSUBJECT="***SPAM***"
 		self._SPAMSUSPECTSUBJECT="***SPAMSUSPICION***"
@@ -529,6 +678,24 @@ class gme:
 			except:
 				pass
 
+			try:
+				self._PARALLELCHECKS=_cfg.getint('default','parallelchecks')
+
+				if self._PARALLELCHECKS<1:
+					self._PARALLELCHECKS=1
+
+			except:
+				pass
+
+			try:
+				d=_cfg.get('default','tempdir').strip()
+
+				if len(d)>0:
+					self._TEMPDIR=os.path.expanduser(d)
+
+			except:
+				pass
+
 		#gpg
 		if _cfg.has_section('gpg'):
 
@@ -582,6 +749,14 @@ class gme:
 			except:
 				pass
 
+			try:
+				self._GPGINLINEWORKERS=_cfg.getint('gpg','inlineworkers')
+
+				if self._GPGINLINEWORKERS<1:
+					self._GPGINLINEWORKERS=1
+			except:
+				pass
+
 		#mailserver
 		if _cfg.has_section('mailserver'):
 
@@ -715,6 +890,72 @@ class gme:
 			except:
 				pass
 
+			try:
+				self._AUTHWORKERS=_cfg.getint('daemon','authworkers')
+
+				if self._AUTHWORKERS<1:
+					self._AUTHWORKERS=1
+
+			except:
+				pass
+
+			try:
+				self._AUTHCACHETTL=_cfg.getint('daemon','authcachettl')
+			except:
+				pass
+
+			try:
+				self._SMTPD_WORKERS=_cfg.getint('daemon','workers')
+
+				if self._SMTPD_WORKERS<1:
+					self._SMTPD_WORKERS=1
+
+			except:
+				pass
+
+			try:
+				self._SMTPD_MAXSESSIONS=_cfg.getint('daemon','maxsessions')
+			except:
+				pass
+
+			try:
+				self._SMTPD_MAXINFLIGHT=_cfg.getint('daemon','maxinflight')
+			except:
+				pass
+
+			try:
+				self._SMTPD_MAXQUEUEDBYTES=_cfg.getint('daemon',
+														'maxqueuedbytes')
+			except:
+				pass
+
+			try:
+				self._SMTPD_MAXMESSAGESIZE=_cfg.getint('daemon',
+														'maxmessagesize')
+			except:
+				pass
+
+			try:
+				self._SMTPD_IPRATELIMIT=_cfg.getint('daemon','ipratelimit')
+			except:
+				pass
+
+			try:
+				self._SMTPD_SENDERRATELIMIT=_cfg.getint('daemon',
+														'senderratelimit')
+			except:
+				pass
+
+			try:
+				self._SMTPD_SMTPUTF8=_cfg.getboolean('daemon','smtputf8')
+			except:
+				pass
+
+			try:
+				self._SMTPD_SPILLSIZE=_cfg.getint('daemon','spillsize')
+			except:
+				pass
+
 			try:
 				self._STATISTICS_PER_DAY=_cfg.getint('daemon','statistics')
 
@@ -724,6 +965,21 @@ class gme:
 			except:
 				pass
 
+			try:
+				self._METRICSFILE=os.path.expanduser(
+										_cfg.get('daemon','metricsfile'))
+			except:
+				pass
+
+			try:
+				self._METRICSINTERVAL=_cfg.getint('daemon','metricsinterval')
+
+				if self._METRICSINTERVAL<1:
+					self._METRICSINTERVAL=1
+
+			except:
+				pass
+
 			try:
 				admins=_cfg.get('daemon','admins').split(",")
 
@@ -759,6 +1015,31 @@ class gme:
 			except:
 				pass
 
+			try:
+				self._PDFNATIVETEXT=_cfg.getboolean('pdf','nativetextrenderer')
+			except:
+				pass
+
+			try:
+				self._PDFTEXTFONT=os.path.expanduser(_cfg.get('pdf','textfont'))
+			except:
+				pass
+
+			try:
+				self._PDFRENDERERS=_cfg.getint('pdf','renderers')
+			except:
+				pass
+
+			try:
+				self._PDFRENDERQUEUE=_cfg.getint('pdf','renderqueue')
+			except:
+				pass
+
+			try:
+				self._PDFRENDERTIMEOUT=_cfg.getint('pdf','rendertimeout')
+			except:
+				pass
+
 			try:
 				o=_cfg.get('pdf','passwordmode').lower().strip()
 
@@ -818,6 +1099,24 @@ class gme:
 			except:
 				pass
 
+			try:
+				self._ZIPWORKERS=_cfg.getint('zip','workers')
+
+				if self._ZIPWORKERS<1:
+					self._ZIPWORKERS=1
+			except:
+				pass
+
+			try:
+				self._ZIPCPUBUDGET=_cfg.getfloat('zip','cpubudget')
+			except:
+				pass
+
+			try:
+				self._ZIPMINGAIN=_cfg.getfloat('zip','mingain')
+			except:
+				pass
+
 		#smime
 		if _cfg.has_section('smime'):
 
@@ -891,6 +1190,30 @@ class gme:
 			except:
 				pass
 
+			try:
+				self._SA_SPAMTIMEOUT=_cfg.getfloat('spam','sa_timeout')
+			except:
+				pass
+
+			try:
+				v=_cfg.get('spam','sa_verb').upper().strip()
+
+				if v in ("CHECK","SYMBOLS"):
+					self._SA_SPAMVERB=v
+
+			except:
+				pass
+
+			try:
+				self._SA_PERSISTENT=_cfg.getboolean('spam','sa_persistent')
+			except:
+				pass
+
+			try:
+				self._SA_USESPAMC=_cfg.getboolean('spam','sa_usespamc')
+			except:
+				pass
+
 			try:
 				self._SA_SPAMLEVEL=_cfg.getfloat('spam','sa_spamlevel')
 			except:
@@ -926,7 +1249,11 @@ class gme:
 												self._SA_SPAMSUSPECTLEVEL,
 												self._SA_SPAMHOST,
 												self._SA_SPAMPORT,
-												self._SPAMMAXSIZE]
+												self._SPAMMAXSIZE,
+												self._SA_SPAMTIMEOUT,
+												self._SA_SPAMVERB,
+												self._SA_PERSISTENT,
+												self._SA_USESPAMC]
 
 		#virus
 		if _cfg.has_section('virus'):
@@ -942,6 +1269,21 @@ class gme:
 			except:
 				pass
 
+			try:
+				self._VIRUSCACHE=_cfg.getboolean('virus','cache')
+			except:
+				pass
+
+			try:
+				self._VIRUSCACHETTL=_cfg.getint('virus','cachettl')
+			except:
+				pass
+
+			try:
+				self._VIRUSCACHESIZE=_cfg.getint('virus','cachesize')
+			except:
+				pass
+
 		#dkim
 		if _cfg.has_section('dkim'):
 
@@ -1368,7 +1710,15 @@ class gme:
 	@_dbg
 	def _debug_keepmail(self,mailtext):
 
-		if not isinstance(mailtext,str):
+		if len(self._logger._DEBUGSEARCHTEXT)==0:
+			return False
+
+		if isinstance(mailtext,_MAILSTORE):
+			mailtext=mailtext.getbuffer()[:]
+
+		if isinstance(mailtext,bytes):
+			mailtext=mailtext.decode("UTF-8",unicodeerror)
+		elif not isinstance(mailtext,str):
 			mailtext=mailtext.as_string()
 
 		searchtext=mailtext.lower()
@@ -1514,7 +1864,16 @@ class gme:
 											delete=False,
 											prefix='mail-',
 											dir=tmpdir)
-			f.write(message.encode("UTF-8",unicodeerror))
+
+			if isinstance(message,str):
+				f.write(message.encode("UTF-8",unicodeerror))
+			elif isinstance(message,_MAILSTORE):
+				f.write(message.getbuffer())
+			elif isinstance(message,bytes):
+				f.write(message)
+			else:
+				write_message(f,message)
+
 			f.close()
 
 			if add_deferred:
@@ -1535,6 +1894,36 @@ class gme:
 
 		return None
 
+	####################
+	#_link_temporaryfile
+	####################
+
+	@_dbg
+	def _link_temporaryfile(self,fname):
+		"""returns a new temporary file with the content of 'fname'. The
+		file is hard linked if possible, else copied"""
+
+		try:
+			f=tempfile.NamedTemporaryFile(  mode='wb',
+											delete=False,
+											prefix='mail-',
+											dir=os.path.dirname(fname))
+			f.close()
+
+			try:
+				os.link(fname,f.name+".lnk")
+				os.replace(f.name+".lnk",f.name)
+			except OSError:
+				shutil.copyfile(fname,f.name)
+
+			self.debug("Message in temporary file '%s'"%f.name)
+			return f.name
+		except:
+			self.log("Couldn't save email in temporary file, write error")
+			self.log_traceback()
+
+		return None
+
 	########################
 	#_remove_mail_from_queue
 	########################
@@ -1595,6 +1984,42 @@ class gme:
 		"returns a PDF class"
 		return _PDF(self)
 
+	################
+	#_get_renderpool
+	################
+
+	@_dbg
+	def _get_renderpool(self):
+		"""returns the pool of started HTML renderers or None,
+		the pool is only used in daemon mode"""
+
+		if (self._RUNMODE!=self.m_daemon
+		or self._PDFRENDERERS<=0):
+			return None
+
+		if self._renderpool==None:
+			self._renderpool=_RENDERPOOL(	parent=self,
+											size=self._PDFRENDERERS,
+											queuesize=self._PDFRENDERQUEUE,
+											timeout=self._PDFRENDERTIMEOUT)
+
+		return self._renderpool
+
+	###################
+	#_get_authenticator
+	###################
+
+	@_dbg
+	def _get_authenticator(self):
+		"returns the password verifier of the smtp server"
+
+		if self._authenticator==None:
+			self._authenticator=_AUTHENTICATOR(	parent=self,
+												workers=self._AUTHWORKERS,
+												ttl=self._AUTHCACHETTL)
+
+		return self._authenticator
+
 	##############
 	#smime_factory
 	##############
@@ -1617,6 +2042,7 @@ class gme:
 	#zip_attachments
 	################
 
+	@_measure("zip")
 	@_dbg
 	def zip_attachments(self,mailtext):
 
@@ -1625,12 +2051,7 @@ class gme:
 		else:
 			message=mailtext
 
-		tempdir = tempfile.mkdtemp()
-
-		if self._USE7ZARCHIVE:
-			Zip=self.a7z_factory()
-		else:
-			Zip=self.zip_factory()
+		jobs=[]
 
 		for m in message.walk():
 			contenttype=m.get_content_type()
@@ -1684,47 +2105,98 @@ class gme:
 					m.set_param("charset",charset)
 					raw_payload=raw_payload.encode(charset,unicodeerror)
 
-				fp=open(os.path.join(tempdir,filename),mode="wb")
+				if not self._probe_compressable(raw_payload):
+					self.debug("'%s' is not compressable"%filename)
+					continue
 
-				try:
-					fp.write(raw_payload)
-				except:
-					self.log("File '%s' could not be written"%filename)
-					self.log_traceback()
+				jobs.append((m,filename,raw_payload,zipFilenamecD,zipFilenamecT))
 
-				fp.close()
-				result,zipfile=Zip.create_zipfile(  tempdir,
-													password=None,
-													containerfile=None)
+		budget={"spent":0.0,"lock":threading.Lock()}
 
-				try:
-					os.remove(fp.name)
-				except:
-					pass
+		if self._ZIPWORKERS>1 and len(jobs)>1:
+			pool=self._zippool()
+			futures=[pool.submit(self._zip_one_attachment,
+								filename,
+								raw_payload,
+								budget)
+						for m,filename,raw_payload,cD,cT in jobs]
+			results=[f.result() for f in futures]
+		else:
+			results=[self._zip_one_attachment(filename,raw_payload,budget)
+						for m,filename,raw_payload,cD,cT in jobs]
 
-				if result==True:
+		#write back in the original order
+		for job,res in zip(jobs,results):
+			m,filename,raw_payload,zipFilenamecD,zipFilenamecT=job
+			result,zipfile=res
 
-					if m["Content-Transfer-Encoding"]:
-						del m["Content-Transfer-Encoding"]
+			if result==True:
 
-					m["Content-Transfer-Encoding"]="base64"
-					m.set_type( 'application/zip')
+				if m["Content-Transfer-Encoding"]:
+					del m["Content-Transfer-Encoding"]
 
-					if m["Content-Disposition"]:
-						del m["Content-Disposition"]
+				m["Content-Transfer-Encoding"]="base64"
+				m.set_type( 'application/zip')
 
-					m.add_header(   'Content-Disposition',
-									'attachment; filename*="%s"'%zipFilenamecD)
-					m.set_param( 'name', zipFilenamecT )
-					m.set_payload(str(base64.encodebytes(zipfile),"ascii"))
+				if m["Content-Disposition"]:
+					del m["Content-Disposition"]
 
-		try:
-			shutil.rmtree(tempdir)
-		except:
-			pass
+				m.add_header(   'Content-Disposition',
+								'attachment; filename*="%s"'%zipFilenamecD)
+				m.set_param( 'name', zipFilenamecT )
+				m.set_payload(str(base64.encodebytes(zipfile),"ascii"))
 
 		return message
 
+	#########
+	#_zippool
+	#########
+
+	def _zippool(self):
+		"returns the thread pool for the attachment compression"
+
+		if self._zip_executor==None:
+			self._zip_executor=concurrent.futures.ThreadPoolExecutor(
+									max_workers=self._ZIPWORKERS,
+									thread_name_prefix="gmezip")
+
+		return self._zip_executor
+
+	####################
+	#_zip_one_attachment
+	####################
+
+	@_dbg
+	def _zip_one_attachment(self,filename,raw_payload,budget):
+		"""compresses one attachment, returns result,zipdata.
+		If the CPU time of the message is used up, the attachment stays
+		uncompressed"""
+
+		if self._ZIPCPUBUDGET>0:
+
+			with budget["lock"]:
+
+				if budget["spent"]>=self._ZIPCPUBUDGET:
+					self.log("CPU budget for zipping used up, '%s' "
+							"will not be compressed"%filename,"w")
+					return False,None
+
+		if self._USE7ZARCHIVE:
+			Zip=self.a7z_factory()
+		else:
+			Zip=self.zip_factory()
+
+		start=time.thread_time()
+
+		try:
+			return Zip.create_zipdata(	[(filename,raw_payload)],
+										password=None,
+										containerfile=None)
+		finally:
+
+			with budget["lock"]:
+				budget["spent"]+=time.thread_time()-start
+
 	###################
 	#_create_contentpdf
 	###################
@@ -1757,16 +2229,17 @@ class gme:
 				while os.path.exists(newfilename):
 					fncount+=1
 					newfilename=os.path.join(tempdir,f1+str(fncount)+ext)
+			elif filename:
+				#only the name of the attachment, no file is needed
+				newfilename=filename
 			else:
-				f2=self._new_tempfile()
-				if filename:
-					newfilename=filename
-				else:
-					newfilename=f2.name
+				newfilename=self._new_tempfile().name
+
+			if tempdir or not filename:
+				fp=open(newfilename,"wb")
+				fp.write(pdffile)
+				fp.close()
 
-			fp=open(newfilename,"wb")
-			fp.write(pdffile)
-			fp.close()
 			self.debug("set filename to '%s'"%newfilename)
 			pgpFilenamecD,pgpFilenamecT=encode_filename("%s.pdf"%os.path.basename(newfilename))
 			msg = MIMEBase("application","pdf")
@@ -1790,8 +2263,8 @@ class gme:
 			email.encoders.encode_base64(msg)
 			self.debug("sucessfully return payload")
 
-			if not tempdir:
-				self._del_tempfile(f2.name)
+			if not tempdir and not filename:
+				self._del_tempfile(newfilename)
 
 			return msg
 		else:
@@ -1936,6 +2409,7 @@ class gme:
 	# zip_attachments_one_container
 	###############################
 
+	@_measure("zip")
 	@_dbg
 	def zip_attachments_one_container(   self,
 							message,
@@ -1950,7 +2424,7 @@ class gme:
 		newmsg=MIMEMultipart()
 		self._copy_headers(message,newmsg)
 		attachments=0
-		tempdir = tempfile.mkdtemp()
+		tempdir = self._mkdtemp()
 		contenttype=message.get_content_type()
 		self.debug("Message CONTENTTYPE %s"%contenttype)
 		filecounter=0
@@ -2016,7 +2490,11 @@ class gme:
 	@_dbg
 	def is_compressable(self,
 						filetype,
-						filename):
+						filename,
+						payload=None):
+		"""returns True if a file of this type is worth compressing.
+		If 'payload' is given, a sample of the data is test compressed"""
+
 		try:
 			maintype,subtype=filetype.lower().split("/")
 		except:
@@ -2025,7 +2503,7 @@ class gme:
 		f, extension = os.path.splitext(filename.lower())
 		extension=extension[1:]
 
-		if filename in ["winmail.dat","win.dat","signature.asc"]:
+		if filename in _NOCOMPRESS_FILENAMES:
 			return False
 
 		if maintype=="video":
@@ -2036,94 +2514,59 @@ class gme:
 
 		if maintype=="image":
 
-			if subtype in ["bmp","x-windows-bmp","svg+xml","tiff",
-					"photoshop","x-photoshop","psd"]:
-				return True
-			#raw image format
-			elif extension in [
-					"3fr","ari","arw","bay","crw","cr2","cap","dcs","dcr","dng",
-					"drf","eip","erf","fff","iiq","k25","kdc","mdc","mef","mos",
-					"mrw","nef","nrw","obm","orf","pef","ptx","pxn","r3d","raf",
-					"raw","rwl","rw2","rwz","sr2","srf","srw","tif","x3f"]:
-				return True
-			else:
+			if (subtype not in _COMPRESS_IMAGETYPES
+			and extension not in _COMPRESS_RAWIMAGEEXTENSIONS):
 				return False
 
-		if maintype=="audio":
+		elif maintype=="audio":
 
-			if subtype in ["x-aiff","x-wav"]:
-				return True
-			else:
+			if subtype not in _COMPRESS_AUDIOTYPES:
 				return False
 
-		if maintype=="application":
-
-			#compressed archives
-			if subtype in ["zip","x-compressed","x-compress","x-gzip",
-						  "x-gtar","x-lzip","x-lzma","x-lzh","x-lzip",
-						  "x-lzop","x-zoo","x-rar-compressed","java-archive",
-						  "x-7z-compressed","x-bzip","x-bzip2",
-						  "vnd.android.package-archive","x-snappy-framed",
-						  "x-xz","x-ace-compressed","x-astrotite-afa",
-						  "x-alz-compressed","x-b1","x-dar","x-dgc-compressed",
-						  "x-apple-diskimage","x-apple-diskimage","x-lzx",
-						  "x-arj","vnd.ms-cab-compressed","x-cfs-compressed",
-						  "x-stuffit","x-stuffitx"]:
-				return False
-			#compressed Microsoft Office formats
-			elif subtype in [
-			"application/vnd.openxmlformats-officedocument."
-								"wordprocessingml.document",
-			"application/vnd.openxmlformats-officedocument."
-								"spreadsheetml.sheet",
-			"application/vnd.openxmlformats-officedocument."
-								"presentationml.presentation"]:
-				return False
-			#Openoffice/LibreOffice
-			elif subtype in ["vnd.oasis.opendocument.text",
-							 "vnd.oasis.opendocument.spreadsheet",
-							 "vnd.oasis.opendocument.presentation",
-							 "vnd.oasis.opendocument.graphics",
-							 "vnd.oasis.opendocument.chart",
-							 "vnd.oasis.opendocument.formula",
-							 "vnd.oasis.opendocument.image",
-							 "vnd.oasis.opendocument.text-master",
-							 "vnd.oasis.opendocument.text-template",
-							 "vnd.oasis.opendocument.spreadsheet-template",
-							 "vnd.oasis.opendocument.presentation-template",
-							 "vnd.oasis.opendocument.graphics-template"]:
-				return False
-			#Miscellaneous
-			elif subtype in ["epub+zip","vnd.gov.sk.e-form+zip"]:
+		elif maintype=="application":
+
+			if subtype in _NOCOMPRESS_APPLICATIONTYPES:
 				return False
-			extension=extension[1:]
 
 			#same as above, just over the file extension
-			if subtype=="octet-stream":
-				if extension in [
-					#Images
-					"jpg","jpeg","png","gif","jif","jfif","jp2","j2k","jpx",
-					"j2c","psd",
-					#Videos
-					"mpeg","mpg","mpe","mpgv","mp4","mpg4","mov","avi","mkv",
-					"swf","flv","f4v","f4p","f4a","f4b","wmv","ogv","m2t",
-					"mjpeg","3gp","asx","m4v","rv","swz","rm","m2v","mv4",
-					"xwmv","3ga","mp3","ogg",
-					#Archives
-					"zip","zipx","arj","cpio","dar","deb","tgz","bz2","bz","gz",
-					"7z","s7z","7zip","ar","xar","cpio","kgb","lrz","lz","lzh",
-					"lha","lzo","lzma","rar","xz","apk","tgz","tbz","tbz2",
-					"tlz","txz","cab","rpm","sz","snappy","jar","z",
-					"zoo","zpaq",
-					#Office
-					"docx","xlsx","pptx","ods","odt","odp","ott","odm","oth",
-					"ots","odg","otg","odf","odb","oxt","odg","odc","odi",
-					#Miscellaneous
-					"epub","ics"
-					]:
-					return False
+			if (subtype=="octet-stream"
+			and extension in _NOCOMPRESS_EXTENSIONS):
+				return False
+
+		if payload!=None:
+			return self._probe_compressable(payload)
+
 		return True
 
+	####################
+	#_probe_compressable
+	####################
+
+	@_dbg
+	def _probe_compressable(self,payload):
+		"""compresses up to three samples of 'payload' and returns False if
+		the estimated gain is below the configured threshold"""
+
+		if self._ZIPMINGAIN<=0:
+			return True
+
+		if len(payload)==0:
+			return False
+
+		size=_COMPRESSPROBE_SAMPLESIZE
+
+		if len(payload)<=3*size:
+			sample=payload
+		else:
+			middle=len(payload)//2
+			sample=(payload[:size]
+					+payload[middle:middle+size]
+					+payload[-size:])
+
+		gain=1-len(zlib.compress(sample,1))/len(sample)
+		self.debug("estimated compression gain %.2f"%gain)
+		return gain>=self._ZIPMINGAIN
+
 	#############
 	#_send_rawmsg
 	#############
@@ -2138,6 +2581,10 @@ class gme:
 
 		if isinstance(message,str):
 			message = email.message_from_string( message )
+		elif isinstance(message,bytes):
+			#only the header is changed, the body is sent unchanged
+			message=email.parser.BytesParser().parsebytes(message,
+														headersonly=True)
 
 		if self._ADDHEADER and not self._encryptheader in message and msg:
 			message.add_header(self._encryptheader,msg)
@@ -2170,7 +2617,7 @@ class gme:
 				message.add_header(self._encryptheader,self._encryptgpgcomment)
 
 			return self._send_textmsg(	m_id,
-								message.as_string(),
+								message,
 								from_addr,
 								to_addr)
 
@@ -2178,6 +2625,7 @@ class gme:
 	#_send_textmsg
 	##############
 
+	@_measure("send")
 	@_dbg
 	def _send_textmsg(  self,
 						m_id,
@@ -2189,11 +2637,16 @@ class gme:
 		domain=maildomain(from_addr)
 		usessl=False
 
-		if not isinstance(message,str):
-			message=message.as_string()
+		#the mail is sent as bytes, so that 8bit parts stay unchanged
+		if isinstance(message,str):
+			message=message.encode("UTF-8",unicodeerror)
+		elif not isinstance(message,bytes):
+			message=message_as_bytes(message)
 
 		if self._USEDKIM and (domain in self._HOMEDOMAINS):
-				message=self._dkim.sign_mail(message)
+
+				with self._metrics.timer("dkim"):
+					message=self._dkim.sign_mail(message)
 
 		if self._OUTPUT==self.o_mail:
 
@@ -2309,9 +2762,15 @@ class gme:
 						return False
 
 				self.debug("smtp.sendmail")
-				message=re.sub(r'(?:\r\n|\n|\r(?!\n))', "\r\n", message)
-				smtp.sendmail( from_addr, to_addr, message.encode("UTF-8",
-																unicodeerror) )
+				message=re.sub(rb'(?:\r\n|\n|\r(?!\n))', b"\r\n", message)
+				smtp.sendmail(	from_addr,
+								to_addr,
+								message,
+								mail_options=self._smtp_mailoptions(
+															smtp,
+															message,
+															from_addr,
+															to_addr))
 				self._remove_mail_from_queue(m_id)
 				return True
 
@@ -2329,6 +2788,19 @@ class gme:
 
 				return False
 		elif (self._OUTPUT==self.o_file
+			and self._OUTFILE
+			and hasattr(self._OUTFILE,"write")):
+
+			try:
+				self._OUTFILE.write(message)
+				self._mailcount+=1
+				self._remove_mail_from_queue(m_id)
+				return True
+			except:
+				self.log("Could not write to Outputfile","e")
+				self.log_traceback()
+				return False
+		elif (self._OUTPUT==self.o_file
 			and self._OUTFILE
 			and len(self._OUTFILE)>0):
 
@@ -2338,7 +2810,7 @@ class gme:
 				if self._mailcount>0:
 					fname=f1+str(self._mailcount)+ext
 
-				f=open(fname,mode='w',encoding="UTF-8")
+				f=open(fname,mode='wb')
 				f.write(message)
 				f.close()
 				self._mailcount+=1
@@ -2349,10 +2821,34 @@ class gme:
 				self.log_traceback()
 				return False
 		else:
-			print (message)
+			print (message.decode("UTF-8",unicodeerror))
 			self._remove_mail_from_queue(m_id)
 			return True
 
+	##################
+	#_smtp_mailoptions
+	##################
+
+	def _smtp_mailoptions(self,smtp,message,from_addr,to_addr):
+		"returns the ESMTP options for MAIL FROM, that 'message' needs"
+		options=[]
+
+		if is_8bit(message):
+
+			if smtp.has_extn("8bitmime"):
+				options.append("BODY=8BITMIME")
+			else:
+				self.debug("8bit message, but server doesn't support 8BITMIME")
+
+		addresses=[email.utils.parseaddr(a)[1] for a in [from_addr,to_addr]
+																		if a]
+
+		if (not all([a.isascii() for a in addresses])
+		and smtp.has_extn("smtputf8")):
+			options.append("SMTPUTF8")
+
+		return options
+
 	################
 	#load_virus_list
 	################
@@ -2419,20 +2915,23 @@ class gme:
 	def store_deferred_list(self):
 		"stores the list with deferred emails, that have to be sent later"
 
+		if self._controlchannel!=None:
+			self.debug("store_deferred_list: lists are kept by the supervisor")
+			return
+
 		try:
 			self.debug("store_deferred_list '%s'"%self._DEFERLIST)
 			f=open(	self._DEFERLIST,mode="w",
 					encoding="UTF-8",errors=unicodeerror)
 
+			#the entries are still used, so mail[3] stays a float
 			for mail in self._deferred_emails:
-				mail[3]=str(mail[3])
-				f.write("|".join(mail))
+				f.write("|".join([str(m) for m in mail]))
 				f.write("\n")
 
 			for qid in self._email_queue:
 				mail=self._email_queue[qid]
-				mail[3]=str(mail[3])
-				f.write("|".join(mail))
+				f.write("|".join([str(m) for m in mail]))
 				f.write("\n")
 
 			f.close()
@@ -2455,8 +2954,7 @@ class gme:
 					encoding="UTF-8",errors=unicodeerror)
 
 			for mail in self._virus_queue:
-				mail[3]=str(mail[3])
-				f.write("|".join(mail))
+				f.write("|".join([str(m) for m in mail]))
 				f.write("\n")
 
 			f.close()
@@ -2498,7 +2996,7 @@ class gme:
 		for mail in self._deferred_emails:
 
 			try:
-				f=open(mail[0],encoding="UTF-8",errors=unicodeerror)
+				f=open(mail[0],mode="rb")
 				msg=f.read()
 				f.close()
 
@@ -2536,21 +3034,69 @@ class gme:
 
 	@_dbg
 	def check_mailqueue(self):
+		"""encrypts and sends the mails, that are still in the mail queue.
+		Their spam level is lost, so they are checked again in one batch"""
+		mails=[]
 
-		for qid in self._email_queue:
+		for qid in list(self._email_queue):
 			mail=self._email_queue[qid]
 
 			try:
 				f=open(mail[0],mode="rb")
-				m=f.read()
+				mails.append((qid,mail,f.read()))
 				f.close()
-				mailtext=m.decode("UTF-8",unicodeerror)
-				self._encrypt_single_mail(-1,mailtext,mail[1],mail[2])
+			except:
+				self.log("mail couldn't be read from email queue")
+				self.log_traceback()
+
+		spamlevels=[spamscanners.S_NOSPAM]*len(mails)
+
+		if len(mails)>0 and self._SPAMCHECK:
+			self._load_spamchecker()
+
+			if self._spam_checker!=None:
+
+				try:
+					spamlevels=[level for level,score in
+								self._spam_checker.is_spam_batch(
+												[m for q,mail,m in mails])]
+				except:
+					self.log("spam check of the email queue failed","e")
+					self.log_traceback()
+
+		for (qid,mail,m),spamlevel in zip(mails,spamlevels):
+
+			try:
+				self._encrypt_single_mail(-1,m,mail[1],mail[2],spamlevel)
 				del self._email_queue[qid]
 			except:
 				self.log("mail couldn't be removed from email queue")
 				self.log_traceback()
 
+	##################
+	#_load_spamchecker
+	##################
+
+	@_dbg
+	def _load_spamchecker(self):
+		"creates the spam checker, if the spam check is switched on"
+
+		if not self._SPAMCHECK or self._spam_checker!=None:
+			return
+
+		try:
+			self._spam_checker=spamscanners.get_spamscanner(self._SPAMSCANNER,
+												parent=self,
+												leveldict=self._spam_leveldict)
+
+			if self._spam_checker!=None:
+				self.log("SPAMCHECKER '%s' activated"%self._SPAMSCANNER)
+			else:
+				self.log("NOSPAMCHECKER")
+		except:
+			self.error("Error loading spam checker")
+			self.log_traceback()
+
 	#########
 	#is_admin
 	#########
@@ -2587,6 +3133,7 @@ class gme:
 		self.log("Spam mails: %i, maybe spam: %i" %(
 				self._count_spam,
 				self._count_maybespam))
+		self.log("Leaked temporary files: %i" %self._count_tempfileleaks)
 
 	##############
 	#_new_tempfile
@@ -2594,14 +3141,80 @@ class gme:
 
 	@_dbg
 	def _new_tempfile(self,delete=False):
-		"creates a new tempfile"
-		f=tempfile.NamedTemporaryFile(  mode='wb',
-										delete=delete,
-										prefix='mail-')
-		self._tempfiles.append(f.name)
+		"""creates a new tempfile, while a mail is processed in the
+		workspace of the mail"""
+
+		if self._workspace!=None:
+			f=self._workspace.new_file(delete=delete)
+		else:
+			f=tempfile.NamedTemporaryFile(  mode='wb',
+											delete=delete,
+											prefix='mail-',
+											dir=self._TEMPDIR)
+			self._tempfiles.add(f.name)
+
 		self.debug("_new_tempfile %s"%f.name)
 		return f
 
+	#########
+	#_mkdtemp
+	#########
+
+	@_dbg
+	def _mkdtemp(self,prefix=None):
+		"""creates a new temporary directory, while a mail is processed
+		in the workspace of the mail"""
+
+		if self._workspace!=None:
+			d=self._workspace.mkdtemp(prefix=prefix)
+		else:
+			d=tempfile.mkdtemp(prefix=prefix,dir=self._TEMPDIR)
+
+		self.debug("_mkdtemp %s"%d)
+		return d
+
+	################
+	#_open_workspace
+	################
+
+	@_dbg
+	def _open_workspace(self):
+		"""creates the workspace for the next mail. Returns False if a
+		workspace is already open"""
+
+		if self._workspace!=None:
+			return False
+
+		try:
+			self._workspace=_WORKSPACE(parent=self,directory=self._TEMPDIR)
+		except:
+			self.log("Workspace could not be created, use '%s'"%(
+										tempfile.gettempdir()),"w")
+			self.log_traceback()
+			return False
+
+		return True
+
+	#################
+	#_close_workspace
+	#################
+
+	@_dbg
+	def _close_workspace(self):
+		"removes the workspace and counts the files that were not deleted"
+
+		if self._workspace==None:
+			return
+
+		leftover=self._workspace.close()
+		self._workspace=None
+
+		if len(leftover)>0:
+			self._count_tempfileleaks+=len(leftover)
+			self.log("%i temporary file(s) were not deleted: %s"%(
+											len(leftover),
+											", ".join(leftover)),"w")
+
 	##############
 	#_del_tempfile
 	##############
@@ -2615,10 +3228,7 @@ class gme:
 
 		self.debug("_del_tempfile:%s"%f)
 
-		try:
-			self._tempfiles.remove(f)
-		except:
-			pass
+		self._tempfiles.discard(f)
 
 		try:
 			os.remove(f)
@@ -2677,7 +3287,13 @@ class gme:
 
 	@_dbg
 	def set_output2file(self,mailfile):
-		"outgoing email will be written to file 'mailfile'"
+		"""outgoing email will be written to file 'mailfile'.
+		'mailfile' can be a file name or a binary file object"""
+
+		if hasattr(mailfile,"write"):
+			self._OUTFILE=mailfile
+			self._OUTPUT=self.o_file
+			return
 
 		if not isinstance(mailfile,str):
 			return
@@ -2969,7 +3585,7 @@ class gme:
 	@_dbg
 	def get_statistics(self):
 		"returns how many mails were handeled"
-		return {"total":self._count_totalmails,
+		statistics={"total":self._count_totalmails,
 			"total encrypt":self._count_encryptedmails,
 			"deferred total":self._count_deferredmails,
 			"deferred still":len(self._deferred_emails),
@@ -2984,8 +3600,43 @@ class gme:
 			"virus infected mails":self._count_viruses,
 			"spam mails":self._count_spam,
 			"spam mails maybe":self._count_maybespam,
+			"temporary files leaked":self._count_tempfileleaks,
 			}
 
+		#multi-process daemon, the last reports of the workers
+		for w in self._workerstatistics.values():
+
+			for s in w:
+				statistics[s]=statistics.get(s,0)+w[s]
+
+		return statistics
+
+	############
+	#get_metrics
+	############
+
+	@_dbg
+	def get_metrics(self):
+		"""returns the latency histograms of the pipeline stages, the
+		queue gauges and the number of started subprocesses"""
+		return self._metrics.get_metrics()
+
+	##############
+	#write_metrics
+	##############
+
+	@_dbg
+	def write_metrics(self,filename=None):
+		"writes the metrics in the Prometheus text format to 'filename'"
+
+		if filename==None:
+			filename=self._METRICSFILE
+
+		if not filename:
+			return False
+
+		return self._metrics.write_prometheus(filename)
+
 	###########
 	#get_uptime
 	###########
@@ -3379,7 +4030,8 @@ class gme:
 							payload,
 							gpguser,
 							from_addr,
-							counter=0 ):
+							counter=0,
+							additionalkeys=None):
 		htmlheader=""
 		htmlbody=""
 		htmlfooter=""
@@ -3406,6 +4058,7 @@ class gme:
 		gpg._set_counter(counter)
 		gpg.set_recipient(gpguser)
 		gpg.set_fromuser(from_addr)
+		gpg.set_additionalkeys(additionalkeys)
 		raw_payload = payload.get_payload(decode=not is_text)
 		contenttype=payload.get_content_type()
 		self.debug("nach payload.get_content_typ")
@@ -3467,7 +4120,7 @@ class gme:
 
 			self._del_tempfile(fp.name)
 
-			if len(self._OUTFILE) >0:
+			if self._OUTFILE:
 				return None
 
 			return payload
@@ -3724,6 +4377,20 @@ class gme:
 
 		return newmsg
 
+	#############
+	#_encryptpool
+	#############
+
+	def _encryptpool(self):
+		"returns the thread pool for the PGP/INLINE part encryption"
+
+		if self._encrypt_executor==None:
+			self._encrypt_executor=concurrent.futures.ThreadPoolExecutor(
+									max_workers=self._GPGINLINEWORKERS,
+									thread_name_prefix="gmeencrypt")
+
+		return self._encrypt_executor
+
 	#######################
 	#encrypt_pgpinline_mail
 	#######################
@@ -3735,12 +4402,18 @@ class gme:
 							from_addr,
 							to_addr,
 							use_container=False,
-							include_contentpdf=False):
+							include_contentpdf=False,
+							policy=None):
 		"""
 		returns the string 'message' as an PGP/INLINE encrypted mail as
 		an email.Message object
 		returns None if encryption was not possible
+		'policy' is the _DECISION of the recipient, if it is already known
 		"""
+		additionalkeys=None
+
+		if policy!=None:
+			additionalkeys=policy.gpgkeys
 
 		if use_container==True:
 			message=self.zip_attachments_one_container(
@@ -3795,7 +4468,8 @@ class gme:
 						from_addr,
 						to_addr,
 						use_container=False,
-						include_contentpdf=False)
+						include_contentpdf=False,
+						policy=policy)
 
 			if use_container==False and include_contentpdf==True:
 				pdfmsg=self._create_contentpdf(message,
@@ -3816,6 +4490,8 @@ class gme:
 						self.debug("message != list =>walk")
 						msg=message.walk()
 
+		parts=[]
+
 		for payload in msg:
 			content=payload.get_content_maintype()
 
@@ -3835,37 +4511,58 @@ class gme:
 				self.debug("list continue")
 				continue
 			else:
-				self.debug("in schleife for _encrypt payload %s" %type(payload))
-				res=self._encrypt_payload( 	payload,
+				#the counter is fixed before the encryption starts, so the
+				#file names don't depend on the order of the workers
+				parts.append((payload,counter))
+
+				if (content in ("application","image","audio","video" )):
+					counter+=1
+
+		if self._GPGINLINEWORKERS>1 and len(parts)>1:
+			pool=self._encryptpool()
+			futures=[pool.submit(	self._encrypt_payload,
+									payload,
+									gpguser,
+									from_addr=from_addr,
+									counter=c,
+									additionalkeys=additionalkeys)
+						for payload,c in parts]
+			results=[f.result() for f in futures]
+		else:
+			results=[]
+
+			for payload,c in parts:
+				res=self._encrypt_payload(	payload,
 											gpguser,
 											from_addr=from_addr,
-											counter=counter )
+											counter=c,
+											additionalkeys=additionalkeys)
+				results.append(res)
 
 				if not res:
-					self.debug("payload could not be encrypted")
-					return None
-
-				if (res and payload.get_content_type()=="text/calendar"
-				and payload.get_param(  'attachment',
-										None,
-										'Content-Disposition' ) is  None):
-					CAL=MIMEText(   res.get_payload(decode=True),
-									_subtype="calendar",
-									_charset="UTF-8")
-					CAL.add_header('Content-Disposition',
-									'attachment',
-									filename=cal_fname)
-					CAL.set_param( 'name', cal_fname)
-					payload.set_payload("")
-					payload.set_type("text/plain")
-					attach_list.append(CAL)
+					break
 
-				if (content in ("application","image","audio","video" )):
-					counter+=1
+		for part,res in zip(parts,results):
+			payload=part[0]
 
-				self.debug("for loop next")
+			if not res:
+				self.debug("payload could not be encrypted")
+				return None
 
-			self.debug("for loop end")
+			if (payload.get_content_type()=="text/calendar"
+			and payload.get_param(  'attachment',
+									None,
+									'Content-Disposition' ) is  None):
+				CAL=MIMEText(   res.get_payload(decode=True),
+								_subtype="calendar",
+								_charset="UTF-8")
+				CAL.add_header('Content-Disposition',
+								'attachment',
+								filename=cal_fname)
+				CAL.set_param( 'name', cal_fname)
+				payload.set_payload("")
+				payload.set_type("text/plain")
+				attach_list.append(CAL)
 
 
 		for a in attach_list:
@@ -3882,12 +4579,19 @@ class gme:
 							message,
 							gpguser,
 							from_addr,
-							to_addr):
+							to_addr,
+							policy=None):
 		"""
 		returns the string 'message' as an PGP/MIME encrypted mail as
 		an email.Message object
 		returns None if encryption was not possible
+		'policy' is the _DECISION of the recipient, if it is already known
 		"""
+		if policy!=None:
+			encryptsubject=policy.encryptsubject
+		else:
+			encryptsubject=self.pgpmime_do_encryptsubject(to_addr)
+
 		if isinstance(message,str):
 			raw_message=email.message_from_string(message)
 		else:
@@ -3985,7 +4689,7 @@ class gme:
 			self.log("To could not be found")
 			self.log_traceback()
 
-		if self.pgpmime_do_encryptsubject(to_addr):
+		if encryptsubject:
 			del newmsg["Subject"]
 			newmsg["Subject"]=localedb(self,"encryptedsubject")
 
@@ -4001,6 +4705,10 @@ class gme:
 		gpg =self.gpg_factory()
 		gpg.set_recipient(gpguser)
 		gpg.set_fromuser(from_addr)
+
+		if policy!=None:
+			gpg.set_additionalkeys(policy.gpgkeys)
+
 		fp=self._new_tempfile()
 		self.debug("encrypt_mime new tempfile %s"%fp.name)
 
@@ -4107,7 +4815,7 @@ class gme:
 
 			body=msgheader+"\r\n"+body
 
-			if self.pgpmime_do_encryptsubject(to_addr):
+			if encryptsubject:
 				m=self._make_multipart_mixed_message(body)
 				m.set_param("protected-headers","v1")
 				p=m.get_payload()
@@ -4121,7 +4829,7 @@ class gme:
 		else:
 			self.debug("Payload==Msg")
 
-			if self.pgpmime_do_encryptsubject(to_addr):
+			if encryptsubject:
 				bodymsg.attach(protectedheader)
 
 			for p in rawpayload:
@@ -4159,17 +4867,20 @@ class gme:
 	#encrypt_pgp_mail
 	#################
 
+	@_measure("gpg")
 	@_dbg
 	def encrypt_pgp_mail(   self,
 							message,
 							use_pgpmime,
 							gpguser,
 							from_addr,
-							to_addr):
+							to_addr,
+							policy=None):
 		"""
 		returns the string 'message' as an PGP encrypted mail (either PGP/INLINE
 		or PGP/MIME depending on the configuration) as an email.Message object
 		returns None if encryption was not possible
+		'policy' is the _DECISION of the recipient, if it is already known
 		"""
 		if isinstance(message,str):
 			message=email.message_from_string(message)
@@ -4184,7 +4895,8 @@ class gme:
 			mail = self.encrypt_pgpmime_mail(message,
 											gpguser,
 											from_addr,
-											to_addr )
+											to_addr,
+											policy=policy)
 		else:
 			#PGP Inline
 			mail = self.encrypt_pgpinline_mail(message,
@@ -4192,7 +4904,8 @@ class gme:
 									from_addr,
 									to_addr,
 									use_container=self._GPGINLINE_ZIPCONTAINER,
-									include_contentpdf=self._GPGINLINE_CONTENTPDF)
+									include_contentpdf=self._GPGINLINE_CONTENTPDF,
+									policy=policy)
 
 		if mail==None:
 			return None
@@ -4210,6 +4923,7 @@ class gme:
 	# encrypt_smime_mail
 	###################
 
+	@_measure("smime")
 	@_dbg
 	def encrypt_smime_mail( self,
 							mailtext,
@@ -4579,19 +5293,22 @@ class gme:
 	# encrypt_pdf_mail
 	##################
 
+	@_measure("pdf")
 	@_dbg
 	def encrypt_pdf_mail(   self,
 							message,
 							pdfuser,
 							from_addr,
 							to_addr,
-							send_password=True
+							send_password=True,
+							policy=None
 							):
 		"""
 		returns the string 'message' as an PDF encrypted mail as an 
 		email.Message object, attachments will be moved to a zip file as 
 		attachment
 		returns None if encryption was not possible
+		'policy' is the _DECISION of the recipient, if it is already known
 		"""
 		if isinstance(message,str):
 			message=email.message_from_string(message)
@@ -4660,25 +5377,32 @@ class gme:
 
 		oldmsg=message
 		attachments=0
-		tempdir = tempfile.mkdtemp()
+		tempdir = self._mkdtemp()
 
 		if self._USE7ZARCHIVE:
 			Zip=self.a7z_factory()
 		else:
 			Zip=self.zip_factory()
 
-		try:
-			Zip.set_zipcipher(self._backend.encryptionmap(pdfuser)[1])
-		except:
+		if policy!=None:
+
+			if policy.cipher:
+				Zip.set_zipcipher(policy.cipher)
+
+		else:
 
 			try:
-				domain=maildomain(pdfuser)
+				Zip.set_zipcipher(self._backend.encryptionmap(pdfuser)[1])
+			except:
+
+				try:
+					domain=maildomain(pdfuser)
 
-				if len(domain)>0:
-					Zip.set_zipcipher(self._backend.encryptionmap("*@%s"
+					if len(domain)>0:
+						Zip.set_zipcipher(self._backend.encryptionmap("*@%s"
 																%domain)[1])
-			except:
-				pass
+				except:
+					pass
 
 		for m in oldmsg.walk():
 
@@ -4953,7 +5677,7 @@ class gme:
 
 		self.debug("send_unencrypted may: %s"%message)
 		return self._send_rawmsg(  queue_id,
-							mailtext.as_string(),
+							message_as_bytes(mailtext),
 							message,
 							from_addr,
 							to_addr)
@@ -5294,6 +6018,65 @@ class gme:
 		else:
 			return None
 
+	########################
+	#_pdfpassword_candidates
+	########################
+
+	def _pdfpassword_candidates(self,from_addr,to_addr):
+		"""yields (source,password) of the passwords, with which a PDF or
+		ZIP file between 'from_addr' and 'to_addr' could be encrypted.
+		The source, that worked last time for both addresses, comes first.
+		The passwords are only looked up when they are needed"""
+		sources=["master",
+				"sender",
+				"recipient",
+				"recipient additional",
+				"sender additional"]
+		last=self._pdfpasswordsources.get((from_addr,to_addr))
+
+		if last in sources:
+			sources.remove(last)
+			sources.insert(0,last)
+
+		for source in sources:
+			pw=None
+
+			try:
+
+				if source=="master":
+
+					if hasattr(self._backend,"_textbackend"):
+						textbackend=self._backend._textbackend
+						pw=textbackend.pdf_additionalencryptionkey(None)
+
+				elif source=="sender":
+					pw=self._backend.get_pdfpassword(from_addr)
+				elif source=="recipient":
+					pw=self._backend.get_pdfpassword(to_addr)
+				elif source=="recipient additional":
+					pw=self._backend.pdf_additionalencryptionkey(to_addr)
+				elif source=="sender additional":
+					pw=self._backend.pdf_additionalencryptionkey(from_addr)
+
+			except:
+				self.log_traceback()
+
+			if pw!=None:
+				yield source,pw
+
+	############################
+	#_remember_pdfpasswordsource
+	############################
+
+	@_dbg
+	def _remember_pdfpasswordsource(self,from_addr,to_addr,source):
+		"the password 'source' did decrypt a file from 'from_addr' to 'to_addr'"
+
+		if len(self._pdfpasswordsources)>=10000:
+			self._pdfpasswordsources.clear()
+
+		self._pdfpasswordsources[(from_addr,to_addr)]=source
+
 	#################
 	#decrypt_pdf_mail
 	#################
@@ -5322,12 +6105,13 @@ class gme:
 				fp.write(raw_payload)
 				fp.close()
 				r,fname=pdf.decrypt_file(fp.name,from_addr,to_addr)
+				self._del_tempfile(fp.name)
 
 				if r==True:
 					pdffile=open(fname,"rb")
 					pl=pdffile.read()
 					pdffile.close()
-					self._del_tempfile(fp.name)
+					self._del_tempfile(fname)
 					payload.set_payload(str(base64.encodebytes(pl),"ascii"))
 
 					if "Content-Transfer-Encoding" in payload:
@@ -5449,7 +6233,12 @@ class gme:
 					self._virus_checker=_virus_check(parent=self)
 
 				if (self._VIRUSCHECK==True and self._virus_checker!=None):
-					has_virus,virusinfo=self._virus_checker.has_virus(mailtext)
+
+					with self._metrics.timer("virus"):
+						has_virus,virusinfo=self._virus_checker.has_virus(
+																	mailtext)
+
+					self._virus_checker.flush_cache()
 
 				if has_virus:
 						self._handle_virusmail(	virusinfo,
@@ -5472,6 +6261,115 @@ class gme:
 		self._count_alreadyencryptedmails+=1
 		self._send_rawmsg(queue_id,mailtext,m,from_addr,to_addr)
 
+	###########
+	#_checkpool
+	###########
+
+	def _checkpool(self):
+		"returns the thread pool for the checks before the encryption"
+
+		if self._check_executor==None:
+			self._check_executor=concurrent.futures.ThreadPoolExecutor(
+									max_workers=self._PARALLELCHECKS,
+									thread_name_prefix="gmecheck")
+
+		return self._check_executor
+
+	##############
+	#_extract_keys
+	##############
+
+	@_dbg
+	def _extract_keys(self,raw_message):
+		"extracts public keys attached to the mail, if configured"
+
+		if self._SMIMEAUTOMATICEXTRACTKEYS:
+			self.debug("_SMIMEAUTOMATICEXTRACTKEYS")
+			s=self.smime_factory()
+			s.extract_publickey_from_mail(  raw_message,
+											self._SMIMEKEYEXTRACTDIR)
+
+		if self._GPGAUTOMATICEXTRACTKEYS:
+			self.debug("_GPGAUTOMATICEXTRACTKEYS")
+			s=self.gpg_factory()
+			s.extract_publickey_from_mail(  raw_message,
+											self._GPGKEYEXTRACTDIR)
+
+	############
+	#_spam_check
+	############
+
+	@_measure("spam")
+	@_dbg
+	def _spam_check(self,mailtext):
+		return self._spam_checker.is_spam(mailtext)
+
+	############
+	#_virus_scan
+	############
+
+	@_measure("virus")
+	@_dbg
+	def _virus_scan(self,mailtext):
+		return self._virus_checker.has_virus(mailtext)
+
+	################
+	#_resolve_policy
+	################
+
+	@_measure("policy")
+	@_dbg
+	def _resolve_policy(self,to_addr,from_addr):
+		"""returns the _DECISION if and with which key 'to_addr' can be GPG
+		or S/MIME encrypted and the preferred encryption method"""
+		return self._get_policyengine().resolve([to_addr],
+												from_addr)[to_addr]
+
+	##################
+	#_resolve_policies
+	##################
+
+	@_measure("policy")
+	@_dbg
+	def _resolve_policies(self,recipients,from_addr):
+		"""returns a dictionary with the _DECISION of all recipients. The
+		recipients are resolved in one call, one after the other, because
+		the storage backends are not thread safe"""
+
+		if isinstance(from_addr,str):
+			from_addr=from_addr.lower()
+
+		try:
+			return self._get_policyengine().resolve(recipients,from_addr)
+		except:
+			self.log_traceback()
+
+		return {}
+
+	##################
+	#_get_policyengine
+	##################
+
+	@_dbg
+	def _get_policyengine(self):
+		"returns the policy engine, compiled from the current settings"
+
+		if (self._policyengine==None
+			or self._policyengine.config!=_POLICYENGINE.get_config(self)):
+			self._policyengine=_POLICYENGINE(parent=self)
+
+		return self._policyengine
+
+	###############
+	#explain_policy
+	###############
+
+	@_dbg
+	def explain_policy(self,recipient,from_addr=None):
+		"""returns text lines, that explain if and how mails from
+		'from_addr' to 'recipient' are encrypted"""
+		return self._get_policyengine().explain(recipient,from_addr)
+
 	#####################
 	#_encrypt_single_mail
 	#####################
@@ -5486,7 +6384,8 @@ class gme:
 								has_virus=False,
 								virusinfo=None,
 								in_bounce_process=False,
-								decrypt=False):
+								decrypt=False,
+								policy=None):
 		_pgpmime=False
 		_prefer_gpg=True
 		_prefer_pdf=False
@@ -5498,6 +6397,8 @@ class gme:
 
 		if isinstance(mailtext,str):
 			mailtext=email.message_from_string(mailtext)		
+		elif isinstance(mailtext,bytes):
+			mailtext=email.message_from_bytes(mailtext)
 
 		if self.is_encrypted(mailtext):
 			self._send_already_encrypted_mail(	queue_id,
@@ -5529,11 +6430,10 @@ class gme:
 
 		_encrypt_subject=self.check_encryptsubject(mailtext)
 
-		try:
-			to_pdf=self._backend.usermap(to_addr)
-		except:
-			self.debug("preferpdf _addressmap to_addr not found")
-			to_pdf=to_addr
+		if policy==None:
+			policy=self._resolve_policy(to_addr,from_addr)
+
+		to_pdf=policy.gpgkey
 
 		if _encrypt_subject:
 			self.debug("remove #encrypt from subject")
@@ -5541,9 +6441,11 @@ class gme:
 			del mailtext["Subject"]
 			mailtext["Subject"]=subject
 
-		g_r,to_gpg=self.check_gpgrecipient(to_addr,from_addr=from_addr)
-		s_r,to_smime=self.check_smimerecipient(to_addr)
-		method=self.get_preferredencryptionmethod(to_addr)
+		g_r=policy.gpg
+		to_gpg=policy.gpgkey
+		s_r=policy.smime
+		to_smime=policy.smimekey
+		method=policy.method
 		self.debug("GPG encrypt possible %i / %s"%(g_r,to_gpg))
 		self.debug("SMIME encrypt possible %i / %s"%(s_r,to_smime))
 		self.debug("Prefer PDF %i / %s"%(_prefer_pdf,to_pdf))
@@ -5604,7 +6506,8 @@ class gme:
 												_pgpmime,
 												to_gpg,
 												from_addr,
-												to_addr)
+												to_addr,
+												policy=policy)
 			elif s_r:
 				mresult=self.encrypt_smime_mail(mailtext,
 												to_smime,
@@ -5623,7 +6526,8 @@ class gme:
 												_pgpmime,
 												to_gpg,
 												from_addr,
-												to_addr)
+												to_addr,
+												policy=policy)
 
 		if 	(self._use_pdf
 			and (not mresult and (_encrypt_subject or _prefer_pdf))):
@@ -5632,7 +6536,8 @@ class gme:
 				mresult=self.encrypt_pdf_mail(  mailtext,
 												to_pdf,
 												from_addr,
-												to_addr)
+												to_addr,
+												policy=policy)
 
 		if mresult:
 			self.debug("send encrypted mail")
@@ -5650,11 +6555,107 @@ class gme:
 								in_bounce_process=in_bounce_process)
 		return mresult
 
+	#########
+	#_deliver
+	#########
+
+	@_dbg
+	def _deliver(	self,
+					raw_message,
+					from_addr,
+					recipients,
+					spamlevel,
+					has_virus,
+					virusinfo,
+					policies,
+					in_bounce_process=False,
+					decrypt=True):
+		"""encrypts and sends the checked mail 'raw_message' to all
+		'recipients'. 'policies' are the results of _resolve_policies"""
+		spoolfiles=[None]*len(recipients)
+
+		if self._RUNMODE==self.m_daemon and len(recipients)>0:
+			#the mail is written once, the other recipients get a link
+			#to the file. They are created before the first mail is
+			#sent, because that removes its file
+			spoolfiles[0]=self._store_temporaryfile(raw_message,
+													spooldir=True)
+
+			if spoolfiles[0]!=None:
+
+				for i in range(1,len(recipients)):
+					spoolfiles[i]=self._link_temporaryfile(spoolfiles[0])
+
+		for i,to_addr in enumerate(recipients):
+			self.debug("encrypt_mail for user '%s'"%to_addr)
+
+			if self._RUNMODE==self.m_daemon:
+				self._email_queue[self._queue_id]=[ spoolfiles[i],
+													from_addr,
+													to_addr,
+													time.time()]
+			else:
+				self._queue_id=-1
+
+			mailid=self._queue_id
+
+			if self._RUNMODE==self.m_daemon:
+				self._queue_id+=1
+
+			self._encrypt_single_mail(   mailid,
+										raw_message,
+										from_addr,
+										to_addr,
+										spamlevel,
+										has_virus,
+										virusinfo,
+										in_bounce_process=in_bounce_process,
+										decrypt=decrypt,
+										policy=policies.get(to_addr))
+
+	##################
+	#_deliver_sentcopy
+	##################
+
+	@_dbg
+	def _deliver_sentcopy(	self,
+							raw_message,
+							from_addr,
+							spamlevel,
+							has_virus,
+							virusinfo):
+		"""sends the mail to the sender with 'sent_address' as From, if
+		configured. The parsed mail and the results of the spam and virus
+		check are used again, only the encryption is done for the copy"""
+
+		if not self._USE_SENTADDRESS or from_addr==None:
+			return
+
+		newfrom="%s <%s>"%(	self._SENTADDRESS,
+							email.utils.parseaddr(from_addr)[1])
+
+		if (spamlevel!=spamscanners.S_NOSPAM or
+			newfrom in from_addr or
+			maildomain(from_addr) not in self._HOMEDOMAINS):
+			return
+
+		del raw_message['From']
+		raw_message['From']=newfrom
+		self._deliver(	raw_message,
+						newfrom,
+						[from_addr],
+						spamlevel,
+						has_virus,
+						virusinfo,
+						self._resolve_policies([from_addr],newfrom),
+						decrypt=False)
+
 	############
 	# send_mails
 	############
 
 	@_dbg
+	@_use_workspace
 	def send_mails(  self,
 						mailtext,
 						recipients,
@@ -5662,7 +6663,7 @@ class gme:
 						decrypt=True):
 		"""
 		Main function of this library:
-			mailtext is the mail as a string
+			mailtext is the mail as bytes, string or email.message
 			recipient is a list of receivers
 		The emails will be encrypted if possible and sent as defined
 		in /etc/gpgmailencrypt.conf
@@ -5681,47 +6682,88 @@ class gme:
 		has_virus=False
 		virusinfo=None
 
-		if isinstance(mailtext,str):
-			raw_message = email.message_from_bytes( mailtext.encode("utf8") )
-		else:
-			raw_message=mailtext
+		with self._metrics.timer("parse"):
 
-		raw_message=self.try_repair_email(raw_message)
-			
+			if isinstance(mailtext,_MAILSTORE):
+				raw_message=mailtext.message()
+			elif isinstance(mailtext,bytes):
+				raw_message=email.message_from_bytes(mailtext)
+			elif isinstance(mailtext,str):
+				raw_message = email.message_from_bytes( mailtext.encode("utf8") )
+			else:
+				raw_message=mailtext
+
+			raw_message=self.try_repair_email(raw_message)
 
 		from_addr = raw_message['From']
 
-		if self._SPAMCHECK and self._spam_checker==None:
+		self._load_spamchecker()
+
+		if 	(self._VIRUSCHECK==True and self._virus_checker==None):
+
 			try:
-				self._spam_checker=spamscanners.get_spamscanner(self._SPAMSCANNER,
-													parent=self,
-													leveldict=self._spam_leveldict)
+				self._virus_checker=_virus_check(parent=self)
+
+				if self._virus_checker.count_scanners()==0:
+					self._virus_checker=None
 
-				if self._spam_checker!=None:
-					self.log("SPAMCHECKER '%s' activated"%self._SPAMSCANNER)
-				else:
-					self.log("NOSPAMCHECKER")
 			except:
-				self.error("Error loading spam checker")
+				self.error("Error loading virus checker")
 				self.log_traceback()
-		
+
+		self._metrics.add_inflight(1)
+
 		try:
+			#spam check, virus check, key extraction and the policy
+			#lookup are independent of each other and run in parallel
+			pool=self._checkpool()
+
+			#the scanners get the mail as it was received
+			virustext=None
+
+			if isinstance(mailtext,_MAILSTORE):
+				#big mails as mmap, the virus check parses the file itself
+				checktext=mailtext.getbuffer()
+				virustext=mailtext
+			elif isinstance(mailtext,(bytes,str)):
+				checktext=mailtext
+			else:
+				checktext=message_as_bytes(raw_message)
 
-			if self._SMIMEAUTOMATICEXTRACTKEYS:
-				self.debug("_SMIMEAUTOMATICEXTRACTKEYS")
-				s=self.smime_factory()
-				s.extract_publickey_from_mail(  raw_message,
-												self._SMIMEKEYEXTRACTDIR)
+			if virustext==None:
+				virustext=checktext
 
-			if self._GPGAUTOMATICEXTRACTKEYS:
-				self.debug("_GPGAUTOMATICEXTRACTKEYS")
-				s=self.gpg_factory()
-				s.extract_publickey_from_mail(  raw_message,
-												self._GPGKEYEXTRACTDIR)
+			f_keys=pool.submit(self._extract_keys,raw_message)
+			f_policy=pool.submit(self._resolve_policies,
+								recipients,
+								from_addr)
+			f_spam=None
+			f_virus=None
 
 			if self._SPAMCHECK and self._spam_checker!=None:
 				self.debug("Spamcheck is_spam")
-				spamlevel,score=self._spam_checker.is_spam(mailtext)
+				f_spam=pool.submit(self._spam_check,checktext)
+
+			if (self._VIRUSCHECK==True and self._virus_checker!=None):
+				f_virus=pool.submit(self._virus_scan,virustext)
+
+			f_keys.result()
+			policies=f_policy.result()
+
+			if f_virus!=None:
+
+				try:
+					has_virus,virusinfo=f_virus.result()
+				except:
+					self.error("Error loading virus checker")
+					self.log_traceback()
+
+				#the storage backend is not thread safe, so the new
+				#verdicts are stored after the parallel checks
+				self._virus_checker.flush_cache()
+
+			if f_spam!=None:
+				spamlevel,score=f_spam.result()
 				scoretext=str(score)
 				is_spam=(spamlevel==spamscanners.S_SPAM)
 
@@ -5782,67 +6824,27 @@ class gme:
 				raw_message["Subject"]=subject
 
 
-			try:
-				if 	(self._VIRUSCHECK==True and self._virus_checker==None):
-					self._virus_checker=_virus_check(parent=self)
-
-					if self._virus_checker.count_scanners()==0:
-						self._virus_checker=None
-
-				if (self._VIRUSCHECK==True and self._virus_checker!=None):
-					has_virus,virusinfo=self._virus_checker.has_virus(mailtext)
-			except:
-				self.error("Error loading virus checker")
-				self.log_traceback()
-
-
-			for to_addr in recipients:
-				self.debug("encrypt_mail for user '%s'"%to_addr)
-
-				if self._RUNMODE==self.m_daemon:
-					fname=self._store_temporaryfile(raw_message.as_string(),
-													spooldir=True)
-
-				if self._RUNMODE==self.m_daemon:
-					self._email_queue[self._queue_id]=[ fname,
-														from_addr,
-														to_addr,
-														time.time()]
-				else:
-					self._queue_id=-1
-
-				mailid=self._queue_id
-
-				if self._RUNMODE==self.m_daemon:
-					self._queue_id+=1
-
-				self._encrypt_single_mail(   mailid,
-											raw_message,
-											from_addr,
-											to_addr,
-											spamlevel,
-											has_virus,
-											virusinfo,
-											in_bounce_process=in_bounce_process,
-											decrypt=decrypt)
-
-			newfrom="%s <%s>"%(	self._SENTADDRESS,
-					 			email.utils.parseaddr(from_addr)[1])
-
-			if (self._USE_SENTADDRESS and
-				spamlevel==spamscanners.S_NOSPAM and
-				newfrom not in from_addr and
-				maildomain(from_addr) in self._HOMEDOMAINS):
-					 del raw_message['From']
-					 raw_message['From']=newfrom
-					 self.send_mails(	raw_message.as_string(),
-					 					from_addr,
-					 					decrypt=False)
+			self._deliver(	raw_message,
+							from_addr,
+							recipients,
+							spamlevel,
+							has_virus,
+							virusinfo,
+							policies,
+							in_bounce_process=in_bounce_process,
+							decrypt=decrypt)
+			self._deliver_sentcopy(	raw_message,
+									from_addr,
+									spamlevel,
+									has_virus,
+									virusinfo)
 
 		except:
 			self._count_deferredmails+=1
 			self.log_traceback()
 
+		self._metrics.add_inflight(-1)
+
 	#######################################
 	#END definition of encryption functions
 	#######################################
@@ -5867,7 +6869,7 @@ class gme:
 					m=self.try_repair_email(m)
 					if m==None:
 						exit(2)
-					raw=m.as_string()
+					raw=message_as_bytes(m)
 					
 				except:
 					self.log("Could not open Inputfile '%s'"%self._INFILE,"e")
@@ -5875,10 +6877,7 @@ class gme:
 					exit(2)
 
 			else:
-				sys.stdin = TextIOWrapper(sys.stdin.buffer,
-										  encoding='UTF-8',
-										  errors=unicodeerror)
-				raw = sys.stdin.read()
+				raw = sys.stdin.buffer.read()
 
 			#do the magic
 			self.send_mails(raw,recipient)
@@ -5908,54 +6907,91 @@ class gme:
 		self.log("Got SIGTERM signal,shutting down server.")
 		raise SystemExit
 
-	###########
-	#daemonmode
-	###########
+	#####################
+	#_deferredlisthandler
+	#####################
 
 	@_dbg
-	def daemonmode(self):
-		"starts the smtpd daemon"
+	def _deferredlisthandler(self):
+		"hourly maintenance of the daemon"
+		self.check_deferred_list()
+		self.store_deferred_list()
 
-		#####################
-		#_deferredlisthandler
-		#####################
+		if self._count_alarms>1:
+			self._count_alarms-=1
+		else:
 
-		def _deferredlisthandler():
-			self.check_deferred_list()
-			self.store_deferred_list()
+			try:
+				self._count_alarms=24/self._STATISTICS_PER_DAY
+			except:
+				self._count_alarms=0
 
-			if self._count_alarms>1:
-				self._count_alarms-=1
-			else:
+			if self._count_alarms>0:
+				self._log_statistics() #log statistics every 24 hours
 
-				try:
-					self._count_alarms=24/self._STATISTICS_PER_DAY
-				except:
-					self._count_alarms=0
+		self.del_old_pdfpasswords(self._PDFPASSWORDLIFETIME)
+		self.del_old_virusmails()
 
-				if self._count_alarms>0:
-					self._log_statistics() #log statistics every 24 hours
+	##################
+	#_reset_after_fork
+	##################
 
-			self.del_old_pdfpasswords(self._PDFPASSWORDLIFETIME)
-			self.del_old_virusmails()
+	@_dbg
+	def _reset_after_fork(self):
+		"""called in a worker process of the multi-process daemon.
+		Drops the state, that belongs to the supervisor process"""
+		#thread pools and helper processes of the parent do not exist
+		#in this process, they are created again when needed
+		self._check_executor=None
+		self._zip_executor=None
+		self._encrypt_executor=None
+		self._renderpool=None
+		self._authenticator=None
+		self._spam_checker=None
+		self._virus_checker=None
+		self._tempfiles=set()
+		self._workspace=None
+		self._deferred_emails=[]
+		self._email_queue={}
+		self._virus_queue=[]
+		self._workerstatistics={}
+		self.reset_statistics()
+		self._metrics.reset()
+		self._backend.reconnect_after_fork()
 
-		#####################
+	###########
+	#daemonmode
+	###########
 
+	@_dbg
+	def daemonmode(self):
+		"starts the smtpd daemon"
 		self._RUNMODE=self.m_daemon
 		self._daemonstarttime=datetime.datetime.now()
-		alarm=_mytimer()
-		alarm.start(0,3600,alarmfunction=_deferredlisthandler)
 
 		try:
 			self._count_alarms=24//self._STATISTICS_PER_DAY
 		except:
 			self._count_alarms=0
 
+		if self._SMTPD_WORKERS>1:
+			_PREFORKSUPERVISOR(parent=self,workers=self._SMTPD_WORKERS).run()
+			return
+
+		alarm=_mytimer()
+		alarm.start(0,3600,alarmfunction=self._deferredlisthandler)
+		metricsalarm=_mytimer()
+
+		if self._METRICSFILE:
+			metricsalarm.start(	0,
+								self._METRICSINTERVAL,
+								alarmfunction=self.write_metrics)
+
 		signal.signal(signal.SIGTERM, self._sigtermhandler)
 		signal.signal(signal.SIGHUP, self._sighuphandler)
 		self.load_deferred_list()
 		self.load_virus_list()
-		_deferredlisthandler()
+		self._deferredlisthandler()
 		self.log("gpgmailencrypt %s starts as daemon on %s:%s"%(
 					VERSION,
 					self._SMTPD_HOST,
@@ -5975,12 +7011,20 @@ class gme:
 			self.log("Couldn't start mail server")
 			self.log_traceback()
 			alarm.stop()
+
+			if metricsalarm.is_running():
+				metricsalarm.stop()
+
 			exit(5)
 
 		try:
 			server.start()
 		except SystemExit:
 			alarm.stop()
+
+			if metricsalarm.is_running():
+				metricsalarm.stop()
+
 			exit(0)
 		except (KeyboardInterrupt,EOFError):
 			self.log("Keyboard Exit")
@@ -5990,6 +7034,9 @@ class gme:
 
 		alarm.stop()
 
+		if metricsalarm.is_running():
+			metricsalarm.stop()
+
 	@_dbg
 	def pgpmime_do_encryptsubject(self,user):
 		"returns True if the header fields like 'Subject' will be"
@@ -6049,6 +7096,10 @@ class gme:
 						user,
 						password):
 		"adds a user, if the user already exists it changes the password"
+
+		if self._authenticator!=None:
+			self._authenticator.invalidate(user)
+
 		return self._backend.adm_set_user(user,password)
 
 	#############
@@ -6058,6 +7109,10 @@ class gme:
 	@_dbg
 	def adm_del_user(self,user):
 		"deletes a user"
+
+		if self._authenticator!=None:
+			self._authenticator.invalidate(user)
+
 		return self._backend.adm_del_user(user)
 
 	###############
@@ -7,15 +7,23 @@ from io import StringIO
 from os.path import expanduser
 import atexit
 import bz2
+import concurrent.futures
+import ctypes
+import ctypes.util
+import email
 import getopt
 import gzip
 import inspect
+import multiprocessing
+import multiprocessing.util
 import os
 import random
 import re
 import shutil
 import signal
 import socket
+import stat
+import struct
 import subprocess
 import sys
 import syslog
@@ -107,11 +115,16 @@ def print_usage():
 	print("encryptmaildir [options] directory1 [directory2 ...]")
 	print("\nOptions:\n")
 	print("-c f --config f:  adds the configfile 'f'")
+	print("-b --batch:       encrypt in process with one gpgmailencrypt")
+	print("                  instance per worker process")
 	print("-d --debug:       print debugging information into logfile")
 	print("-h --help :       print this help")
+	print("-i --inotify:     after the first run wait for new mails and")
+	print("                  encrypt them immediately (Linux only)")
 	print("-k f --keyhome f: sets gpg key directory to 'f'")
 	print("-u --user:        user email address")
 	print("-v --dovecot:     uses Dovecot maildirlock")
+	print("-w n --workers n: number of worker processes in batch mode")
 	print("-x --example:     print example config file")
 	print("-y --syslog:      log to syslog, otherwise to logfile")
 	print("\n")
@@ -122,6 +135,8 @@ def print_usage():
 def print_exampleconfig():
 	print("\n[default]")
 	print("gpgmailencrypt = /usr/local/bin/gpgmailencrypt.py")
+	print("batch = no")
+	print("workers = 4")
 	print()
 	print("[mail]")
 	print("dovecot = no")
@@ -200,14 +215,20 @@ class maildirname:
 			self._rightpart=''
 			self._flags=[]
 			self._dovecotflags=dict()
+			self._hasinfo=True
 
 		def __splitname(self,n):
 
 			try:
 				self._leftpart,self._middlepart,rp=n.split(".",2)
 				rp=rp.split(":2,")
+				#mails in 'new' have no info part
+				self._hasinfo=len(rp)>1
 				self._flags=[]
-				self._flags.extend(rp[1])
+
+				if self._hasinfo:
+					self._flags.extend(rp[1])
+
 				self._flags.sort()
 				rp=rp[0].split(",")
 				self._rightpart=rp[0]
@@ -244,8 +265,10 @@ class maildirname:
 			if len(dvflags)>0:
 				n=n+","+dvflags
 
-			flag="".join(self._flags)
-			n=n+":2,"+flag
+			if self._hasinfo:
+				flag="".join(self._flags)
+				n=n+":2,"+flag
+
 			return n
 
 		def set_leftpart(self,p)	:
@@ -663,7 +686,7 @@ def do_finally():
 #read_configfile
 ################
 def read_configfile():
-	global cfg, DEBUG,DOVECOT,GPGMAILENCRYPT,MAILDIRLOCK
+	global cfg, DEBUG,DOVECOT,GPGMAILENCRYPT,MAILDIRLOCK,BATCH,WORKERS
 	cfg=dict()
 	_cfg = RawConfigParser()
 
@@ -684,6 +707,16 @@ def read_configfile():
 		if 'gpgmailencrypt' in cfg['default']:
 			GPGMAILENCRYPT=cfg['default']['gpgmailencrypt']
 
+		if 'batch' in cfg['default'] and cfg['default']['batch']=="yes":
+			BATCH=True
+
+		if 'workers' in cfg['default']:
+
+			try:
+				WORKERS=max(1,int(cfg['default']['workers']))
+			except:
+				log("Invalid value for 'workers'","w",ln=lineno())
+
 	if 'mail' in cfg:
 
 		if 'dovecot' in cfg['mail'] and cfg['mail']['dovecot']=="yes":
@@ -698,17 +731,20 @@ def read_configfile():
 def parse_commandline():
 	global to_addrs
 	global CONFIGFILE,DEBUG,DOVECOT,DIRECTORIES,KEYHOME
-	global USER,LOGFILE,LOGGING,SYSLOG
+	global USER,LOGFILE,LOGGING,SYSLOG,BATCH,WORKERS,WATCH
 
 	try:
 		cl=sys.argv[1:]
-		_opts,_remainder=getopt.gnu_getopt(cl,'c:dhk:n:u:vxy',['config=',
+		_opts,_remainder=getopt.gnu_getopt(cl,'bc:dhik:n:u:vw:xy',['batch',
+																'config=',
 																'debug',
 																'dovecot',
 																'example',
 																'help',
+																'inotify',
 																'keyhome=' ,
 																'user=',
+																'workers=',
 																'syslog'])
 	except getopt.GetoptError as e:
 		log("unknown commandline parameter '%s'"%str(e),"e",lineno())
@@ -744,6 +780,19 @@ def parse_commandline():
 		if _opt  =='-v' or _opt == '--dovecot':
 	   		DOVECOT=True
 
+		if _opt  =='-b' or _opt == '--batch':
+	   		BATCH=True
+
+		if _opt  =='-i' or _opt == '--inotify':
+	   		WATCH=True
+
+		if _opt  =='-w' or _opt == '--workers':
+
+	   		try:
+	   			WORKERS=max(1,int(_arg))
+	   		except:
+	   			log("Invalid number of workers '%s'"%_arg,"w",lineno())
+
 		if _opt  =='-x' or  _opt == '--example':
 	   		print_exampleconfig()
 	   		exit(0)
@@ -758,10 +807,379 @@ def parse_commandline():
 		print_usage()
 		exit(2)
 
+#################
+#maildir_basename
+#################
+def maildir_basename(n):
+	"returns the unique part of a maildir file name, without size and flags"
+	return n.split(":2,")[0].split(",")[0]
+
+###########
+#read_index
+###########
+def read_index(dirname):
+	"""reads the change index of a maildir directory.
+	returns a dictionary '(inode,basename)':'(size,mtime,state)'"""
+	index=dict()
+
+	try:
+
+		with open(os.path.join(dirname,INDEXFILE)) as f:
+
+			for line in f:
+
+				try:
+					inode,base,size,mtime,state=line.split()
+					index[(int(inode),base)]=(int(size),float(mtime),state)
+				except ValueError:
+					continue
+
+	except FileNotFoundError:
+		pass
+	except:
+		log("Could not read index file in '%s'"%dirname,"w",lineno())
+
+	return index
+
+############
+#write_index
+############
+def write_index(dirname,index):
+	"writes the change index atomically"
+	fname=os.path.join(dirname,INDEXFILE)
+
+	try:
+
+		with open(fname+".tmp","w") as f:
+
+			for (inode,base),(size,mtime,state) in index.items():
+				f.write("%i %s %i %r %s\n"%(inode,base,size,mtime,state))
+
+		os.replace(fname+".tmp",fname)
+	except:
+		log("Could not write index file '%s'"%fname,"w",lineno())
+
+##############
+#class inotify
+##############
+class inotify:
+	"minimal inotify binding, watches maildir directories for new mails"
+	IN_CLOSE_WRITE=0x00000008
+	IN_MOVED_TO=0x00000080
+	_EVENT=struct.Struct("iIII")
+
+	def __init__(self):
+		self._libc=ctypes.CDLL(ctypes.util.find_library("c"),use_errno=True)
+		self.fd=self._libc.inotify_init1(os.O_CLOEXEC)
+
+		if self.fd<0:
+			raise OSError(ctypes.get_errno(),"inotify_init1 failed")
+
+		self.watches=dict()
+
+	def add_watch(self,dirname):
+		wd=self._libc.inotify_add_watch(self.fd,
+										os.fsencode(dirname),
+										self.IN_CLOSE_WRITE|self.IN_MOVED_TO)
+
+		if wd<0:
+			log("Couldn't watch directory '%s'"%dirname,"w",lineno())
+			return
+
+		self.watches[wd]=dirname
+
+	def read(self):
+		"waits for events, returns a dictionary 'directory':'set of names'"
+		data=os.read(self.fd,65536)
+		events=dict()
+		pos=0
+
+		while pos+self._EVENT.size<=len(data):
+			wd,mask,cookie,length=self._EVENT.unpack_from(data,pos)
+			pos+=self._EVENT.size
+			name=os.fsdecode(data[pos:pos+length].rstrip(b"\0"))
+			pos+=length
+
+			if wd in self.watches and len(name)>0:
+				events.setdefault(self.watches[wd],set()).add(name)
+
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+#############
+#walk_maildir
+#############
+def walk_maildir(directory):
+	"""yields all directories below 'directory' with a list of
+	'file name'/'inode' tuples of their files"""
+	stack=[directory]
+
+	while len(stack)>0:
+		d=stack.pop()
+		names=[]
+
+		try:
+
+			with os.scandir(d) as it:
+
+				for entry in it:
+
+					if entry.is_dir(follow_symlinks=False):
+						stack.append(entry.path)
+					else:
+						#the inode comes from readdir, no stat needed
+						names.append((entry.name,entry.inode()))
+
+		except OSError:
+			log("Couldn't read directory '%s'"%d,"w",lineno())
+			continue
+
+		yield d,names
+
+#################
+#init_batchworker
+#################
+def init_batchworker(keyhome):
+	"creates the gme instance of a batch worker process"
+	global _gme
+	import gpgmailencrypt
+	_gme=gpgmailencrypt.gme()
+	_gme._GPGKEYHOME=expanduser(keyhome)
+	_gme._ADDHEADER=True
+
+	if SYSLOG:
+		_gme.set_logging("syslog")
+
+	_gme.set_debug(DEBUG)
+	multiprocessing.util.Finalize(None,_gme.close,exitpriority=10)
+
+################
+#get_compression
+################
+def get_compression(fname):
+	"returns 'gz', 'bz2' or None, detected by the magic bytes of the file"
+
+	try:
+
+		with open(fname,"rb") as f:
+			magic=f.read(3)
+
+	except:
+		log("get_compression: Couldn't open file '%s'"%fname,"w",lineno())
+		return None
+
+	if magic[:2]==b"\x1f\x8b":
+		return "gz"
+	elif magic==b"BZh":
+		return "bz2"
+
+	return None
+
+##########
+#open_mail
+##########
+def open_mail(fname,compression,mode="rb"):
+	"opens a (compressed) mail file as binary stream"
+
+	if compression=="gz":
+		return gzip.open(fname,mode)
+	elif compression=="bz2":
+		return bz2.BZ2File(fname,mode)
+
+	return open(fname,mode)
+
+##################
+#class sizecounter
+##################
+class sizecounter:
+	"file wrapper, counts the (uncompressed) bytes and line feeds written"
+
+	def __init__(self,f):
+		self._f=f
+		self.size=0
+		self.linefeeds=0
+
+	def write(self,data):
+		self.size+=len(data)
+		self.linefeeds+=data.count(b"\n")
+		return self._f.write(data)
+
+############
+#encrypt_cmd
+############
+def encrypt_cmd(infile,out,compression,tmpdir):
+	"encrypts 'infile' with an external gme.py call, writes result to 'out'"
+	tmpfiles=[]
+
+	def _tmpfile():
+		t=tempfile.NamedTemporaryFile(	mode='wb',
+										delete=False,
+										dir=tmpdir,
+										prefix='.mail-')
+		tmpfiles.append(t.name)
+		return t
+
+	try:
+
+		if compression!=None:
+			#gme.py needs the uncompressed mail as file
+			plain=_tmpfile()
+
+			with open_mail(infile,compression) as i:
+				shutil.copyfileobj(i,plain)
+
+			plain.close()
+			infile=plain.name
+
+		result=_tmpfile()
+		result.close()
+		cmd=("%(CMD)s -l syslog  -a -k %(KEY)s -f '%(IN)s'"
+		" -m %(OUT)s %(USER)s" %{	"CMD":GPGMAILENCRYPT,
+									"KEY":KEYHOME,
+									"IN":infile,
+									"OUT":result.name,
+									"USER":USER})
+		_result = os.system(cmd)/256
+
+		if _result!=0:
+			debug("Encryption ended with error %i"%_result,lineno())
+			return False
+
+		with open(result.name,"rb") as r:
+			shutil.copyfileobj(r,out)
+
+		return True
+	finally:
+
+		for t in tmpfiles:
+
+			try:
+				os.unlink(t)
+			except:
+				pass
+
+##############
+#encrypt_batch
+##############
+def encrypt_batch(infile,out,compression):
+	"""encrypts 'infile' with the gme instance of this worker process,
+	writes the result to 'out'"""
+	from gmeutils.helpers import message_as_bytes
+
+	try:
+
+		with open_mail(infile,compression) as f:
+			m=email.message_from_binary_file(f)
+
+		m=_gme.try_repair_email(m)
+		_gme.set_output2file(out)
+		_gme._mailcount=0
+		#8bit bodies without charset are passed on unchanged
+		_gme.send_mails(message_as_bytes(m),[USER])
+	except:
+		log("Encryption of '%s' failed: '%s %s'"%(	infile,
+													sys.exc_info()[0],
+													sys.exc_info()[1]),
+													"e",lineno())
+		return False
+
+	return _gme._mailcount>0
+
+#############
+#encrypt_file
+#############
+def encrypt_file(dirname,n,times):
+	"""encrypts the mail file 'n' and replaces it atomically,
+	returns 'name','stat of the new file' or None,None if the mail couldn't
+	be encrypted"""
+	f="%s/%s"%(dirname,n)
+	debug( "checkfile:%s %s"%(time.ctime(times[1]),f))
+	#gzip/bz2 compressed mails are decompressed and compressed on the fly,
+	#the result is written only once
+	compression=get_compression(f)
+	outcompression=None
+
+	if ZIP_EMAILS:
+		outcompression=compression
+
+	#the result is written next to the mail (maildir 'tmp' if possible),
+	#so that it can be renamed over the original file
+	tmpdir=os.path.join(os.path.dirname(dirname),"tmp")
+
+	if not os.path.isdir(tmpdir):
+		tmpdir=dirname
+
+	out=tempfile.NamedTemporaryFile(mode='wb',
+									delete=False,
+									dir=tmpdir,
+									prefix='.mail-')
+	out.close()
+
+	try:
+
+		with open_mail(out.name,outcompression,"wb") as o:
+			counter=sizecounter(o)
+
+			if BATCH:
+				_result=encrypt_batch(f,counter,compression)
+			else:
+				_result=encrypt_cmd(f,counter,compression,tmpdir)
+
+	except:
+		log("Couldn't write '%s': '%s %s'"%(	out.name,
+												sys.exc_info()[0],
+												sys.exc_info()[1]),
+												"e",lineno())
+		_result=False
+
+	if not _result:
+		#the original mail is still untouched
+		os.unlink(out.name)
+		return None,None
+
+	fsize=str(counter.size)
+	wsize=str(counter.size+counter.linefeeds)
+
+	try:
+		os.chmod(out.name,os.stat(f).st_mode)
+		os.utime(out.name,times)
+	except:
+		log("Couldn't set file flags of file '%s'"%out.name,"w",lineno())
+
+	nf=f
+
+	try:
+		os.replace(out.name,f)
+
+		if DOVECOT:
+			mname=maildirname()
+			mname.set_name(n)
+			mname.set_dovecotflags(("S="+fsize,"W="+wsize))
+			nf="%s/%s"%(dirname,mname.name())
+			os.rename(f,nf)
+
+	except:
+		log("Couldn't replace mail '%s'"%f,"e",lineno())
+
+		try:
+			os.unlink(out.name)
+		except:
+			pass
+
+	try:
+		return os.path.basename(nf),os.stat(nf)
+	except:
+		return None,None
+
 #############
 #encrypt_dir
 #############
-def encrypt_dir(arg,dirname,names):
+def encrypt_dir(dirname,names,complete=True):
+	"""encrypts all new or changed mails of 'names' ('file name'/'inode'
+	tuples, inode may be None). If 'complete' is True, 'names' contains all
+	files of the directory and deleted mails are removed from the index"""
 	global mtime,newtime,checked_files
 	lockdir=dirname.replace("/cur","").replace("/new","")
 
@@ -778,6 +1196,8 @@ def encrypt_dir(arg,dirname,names):
 			return
 
 	mtimefile=expanduser(dirname+"/"+MTIMEFILE)
+	mtime=0
+	newtime=0
 
 	try:
 		m=open(mtimefile)
@@ -788,114 +1208,118 @@ def encrypt_dir(arg,dirname,names):
 	except:
 		log("Could not read Mtimefile '%s'"%mtimefile,"w",lineno())
 
-	for n in names:
+	index=read_index(dirname)
+	#the mail client moves mails from 'new' to 'cur', they keep their inode
+	#and their index entry of 'new'
+	newindex=None
+	seen=set()
+	jobs=[]
+
+	for n,inode in names:
 
 		if ((DOVECOT and "dovecot" in n) or (MTIMEFILE in n)
 				or("subscriptions" in n) or ("courierimap" in n)):
 			debug("Ignore '%s'"%n)
 			continue
 
+		base=maildir_basename(n)
+
+		#maildir files are never changed, just renamed, so an encrypted
+		#mail can be skipped without stat
+		if (inode!=None
+		and index.get((inode,base),(0,0,None))[2]==ENCRYPTED):
+			seen.add((inode,base))
+			continue
+
 		f="%s/%s"%(dirname,n)
-		filetime=os.stat(f).st_mtime
-		_gzipped=False
-		_bz2zipped=False
 		debug("check file '%s'"%f,lineno())
 
 		try:
 			_times=os.stat(f)
 		except:
 			log("Couldn't load file attributes of file '%s'"%f,"e",lineno())
+			continue
 
-		if os.path.isfile(f) and filetime >mtime:
-			debug( "checkfile:%s %s"%(time.ctime(os.stat(f).st_mtime),f))
-			checked_files+=1
+		if not stat.S_ISREG(_times.st_mode):
+			continue
 
-			if is_gzipped(f):
-				_gzipped=True
+		key=(_times.st_ino,base)
+		seen.add(key)
+		known=index.get(key)
 
-				if not gunzip_file(f):
-					log("Couldn't gunzip Mail, continue","e",lineno())
-					continue
+		if known==None and os.path.basename(dirname)=="cur":
 
-			elif is_bz2zipped(f):
-				_bz2zipped=True
+			if newindex==None:
+				newindex=read_index(os.path.join(os.path.dirname(dirname),
+												"new"))
 
-				if not bz2unzip_file(f):
-					log("Couldn't bz2unzip Mail, continue","e",lineno())
-					continue
+			known=newindex.get(key)
 
-			out=tempfile.NamedTemporaryFile(mode='wb',
-											delete=False,
-											prefix='mail-')
-			out.close()
-			cmd="%(CMD)s -l syslog  -a -k %(KEY)s -f '%(IN)s'"
-			" -m %(OUT)s %(USER)s" %{	"CMD":GPGMAILENCRYPT,
-										"KEY":KEYHOME,
-										"IN":f,
-										"OUT":out.name,
-										"USER":USER}
-			_result = os.system(cmd)/256
+			if known!=None:
+				index[key]=known
 
-			if _result == 0:
+		if known!=None:
 
-				try:
-					new=open(f,'w')
-				except:
-					log ("Error opening file '%s'"%f,"e",lineno())
-					continue
+			if (known[2]==ENCRYPTED
+			or (known[0]==_times.st_size and known[1]==_times.st_mtime)):
+				continue
 
-				try:
-					out=open(out.name)
-				except:
-					log ("Error opening file '%s'"%out.name,"e",lineno())
-					os.unlink(out.name)
-					continue
+		elif _times.st_mtime<=mtime:
+			#checked before the index existed
+			index[key]=(_times.st_size,_times.st_mtime,ENCRYPTED)
+			continue
 
-				new.write(out.read())
-				new.close()
-				nf=new.name
-				del new
-				fsize=str(os.stat(nf).st_size)
+		checked_files+=1
+		jobs.append((n,key,_times))
 
-				if ZIP_EMAILS:
+	if BATCH:
+		futures=[_pool.submit(	encrypt_file,
+								dirname,
+								n,
+								(st.st_atime,st.st_mtime))
+					for n,key,st in jobs]
+		results=[]
 
-					if _gzipped:
-						gzip_file(nf)
-					elif _bz2zipped:
-						bz2zip_file(nf)
+		for fu in futures:
 
-				if DOVECOT:
-					mname=maildirname()
-					mname.set_name(n)
-					#mname.set_rightpart(socket.gethostname())
-					mname.set_dovecotflags(("S="+fsize,"W="+fsize))
-					newf="%s/%s"%(dirname,mname.name())
-					os.rename(nf,newf)
-					nf=newf
+			try:
+				results.append(fu.result())
+			except:
+				log("Bug: Exception '%(m1)s %(m2)s' occured!"%{
+										"m1":sys.exc_info()[0],
+										"m2":sys.exc_info()[1]},"e",lineno())
+				results.append((None,None))
 
-				try:
-					os.utime(nf,(_times.st_atime,_times.st_mtime))
-				except:
-					log("Couldn't set file flags of file '%s'"%nf,"w",lineno())
+	else:
+		results=[encrypt_file(dirname,n,(st.st_atime,st.st_mtime))
+					for n,key,st in jobs]
 
-				filetime=os.stat(nf).st_mtime
-				debug("filetime: %i"%filetime,lineno())
+	for job,result in zip(jobs,results):
+		n,key,st=job
+		newname,newst=result
 
-				if filetime>newtime:
-					newtime=filetime
-					debug("new checktime: %i"%newtime)
+		if newst==None:
+			#will be checked again, when the file changes
+			index[key]=(st.st_size,st.st_mtime,FAILED)
+			filetime=st.st_mtime
+		else:
+			index.pop(key,None)
+			seen.discard(key)
+			key=(newst.st_ino,maildir_basename(newname))
+			index[key]=(newst.st_size,newst.st_mtime,ENCRYPTED)
+			seen.add(key)
+			filetime=newst.st_mtime
 
-			else:
-				debug("Encryption ended with error %i"%_result,lineno())
-				filetime=os.stat(f).st_mtime
-				debug("filetime: %i"%filetime)
+		if filetime>newtime:
+			newtime=filetime
+			debug("new checktime: %i"%newtime)
 
-				if filetime>newtime:
-					newtime=filetime
-					debug("new checktime: %i"%newtime)
+	if complete:
+		index={k:v for k,v in index.items() if k in seen}
 
-			os.unlink(out.name)
+	write_index(dirname,index)
 
+	#the marker is written once per directory
 	try:
 		m=open(mtimefile,'w')
 		m.write(str(newtime))
@@ -906,6 +1330,34 @@ def encrypt_dir(arg,dirname,names):
 	if DOVECOT:
 		free_lock(pid)
 
+###############
+#watch_maildirs
+###############
+def watch_maildirs(directories):
+	"encrypts new mails as soon as they are delivered"
+	watcher=inotify()
+
+	try:
+
+		for directory in directories:
+
+			for dirname,names in walk_maildir(directory):
+
+				if ("/cur" in dirname.lower()) or ("/new" in dirname.lower()):
+					watcher.add_watch(dirname)
+
+		log("Watching %i directories"%len(watcher.watches),ln=lineno())
+
+		while True:
+
+			for dirname,names in watcher.read().items():
+				encrypt_dir(dirname,
+							[(n,None) for n in names],
+							complete=False)
+
+	finally:
+		watcher.close()
+
 ##################
 #Main routine
 ##################
@@ -913,10 +1365,11 @@ def encrypt_dir(arg,dirname,names):
 logfile=None
 cfg = dict()
 _pids=[]
+_pool=None
+_gme=None
 mtime=0
 newtime=0
 checked_files=0
-atexit.register(do_finally)
 
 #GLOBAL CONFIG VARIABLES
 DEBUG=False
@@ -929,23 +1382,47 @@ SYSLOG=False
 KEYHOME="~/.gnupg"
 GPGMAILENCRYPT=shutil.which("gme.py")
 MTIMEFILE=".encryptmaildir"
+INDEXFILE=".encryptmaildir.idx"
+ENCRYPTED="encrypted"
+FAILED="failed"
+WATCH=False
 USER=''
 CONFIGFILE='/etc/encryptmaildir'
 DIRECTORIES=[]
-#get configuration
-read_configfile()
-parse_commandline()
-#encrypt directories
+BATCH=False
+WORKERS=os.cpu_count() or 1
 
-try:
+if __name__ == "__main__":
+	atexit.register(do_finally)
+	#get configuration
+	read_configfile()
+	parse_commandline()
+	#encrypt directories
 
-	for directory in DIRECTORIES:
-		debug("DIR: '%s'"%directory,lineno())
-		os.walk(directory,encrypt_dir,None)
+	try:
 
-except KeyboardInterrupt:
-	log("Keyboard: CTRL-C Exit ...",ln=lineno())
-except:
-  	log("Bug: Exception '%(m1)s %(m2)s' occured!"%{	"m1":sys.exc_info()[0],
-  													"m2":sys.exc_info()[1]})
+		if BATCH:
+			_pool=concurrent.futures.ProcessPoolExecutor(
+								max_workers=WORKERS,
+								mp_context=multiprocessing.get_context("fork"),
+								initializer=init_batchworker,
+								initargs=(KEYHOME,))
+
+		for directory in DIRECTORIES:
+			debug("DIR: '%s'"%directory,lineno())
+
+			for dirname,names in walk_maildir(directory):
+				encrypt_dir(dirname,names)
+
+		if WATCH:
+			watch_maildirs(DIRECTORIES)
+
+	except KeyboardInterrupt:
+		log("Keyboard: CTRL-C Exit ...",ln=lineno())
+	except:
+		log("Bug: Exception '%(m1)s %(m2)s' occured!"%{	"m1":sys.exc_info()[0],
+														"m2":sys.exc_info()[1]})
+	finally:
 
+		if _pool!=None:
+			_pool.shutdown(wait=True)
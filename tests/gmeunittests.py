@@ -7,15 +7,39 @@ import gmeutils.archivemanagers
 import gmeutils.virusscanners
 import gmeutils.spamscanners
 import gmeutils.gpgmailserver
+import gmeutils.renderpool
+import gmeutils.admission
+import gmeutils.prefork
+import gmeutils.authenticator
+import gmeutils.mailstore
+import gmeutils.gpgclass
+import gmeutils.keyindex
+import gmeutils.workspace
+import gmeutils.password
+import gmeutils.smimeclass
+import asyncore
+import concurrent.futures
 import email
 import filecmp
 import glob
+import gzip
+import importlib.util
+import io
 import os
 import os.path
 import shutil
+import smtplib
+import socketserver
+import threading
 import time
 from   gmeutils.dkim	import mydkim
 from multiprocessing import Process
+from unittest import mock
+
+try:
+	import PyPDF2
+except ImportError:
+	PyPDF2=None
 
 
 ############################################
@@ -690,7 +714,7 @@ class gmetests(unittest.TestCase):
 		print(res)
 		self.assertEqual(res[0],"1:test@from.com")
 		self.assertEqual(res[1],"2:dunno@dunno.pt")
-		self.assertIn("3:/tmp/mail-",res[2])
+		self.assertRegex(res[2],"^3:/tmp/gme-[^/]+/mail-")
 		self.assertEqual(res[3],"4:")
 		self.assertEqual(res[4],"5:")
 
@@ -705,7 +729,7 @@ class gmetests(unittest.TestCase):
 		print(res)
 		self.assertEqual(res[0],"1:test@from.com")
 		self.assertEqual(res[1],"2:dunno@dunno.pt")
-		self.assertIn("3:/tmp/mail-",res[2])
+		self.assertRegex(res[2],"^3:/tmp/gme-[^/]+/mail-")
 		self.assertEqual(res[3],"4:")
 		self.assertEqual(res[4],"5:")
 
@@ -906,6 +930,30 @@ class gmetests(unittest.TestCase):
 	def test_isnotcompressable(self):
 		self.assertFalse(self.gme.is_compressable("image/png","file.png"))
 
+	def test_isnotcompressable_octetstream(self):
+		self.assertFalse(self.gme.is_compressable("application/octet-stream",
+												"movie.mp4"))
+
+	def test_isnotcompressable_docx(self):
+		self.assertFalse(self.gme.is_compressable(
+			"application/vnd.openxmlformats-officedocument."
+			"wordprocessingml.document","file.docx"))
+
+	def test_iscompressable_probe(self):
+		self.gme._ZIPMINGAIN=0.05
+		self.assertTrue(self.gme.is_compressable("application/octet-stream",
+												"file.bin",
+												b"compressable "*10000))
+		self.assertFalse(self.gme.is_compressable("application/octet-stream",
+												"file.bin",
+												os.urandom(100000)))
+
+	def test_iscompressable_probedisabled(self):
+		self.gme._ZIPMINGAIN=0
+		self.assertTrue(self.gme.is_compressable("application/octet-stream",
+												"file.bin",
+												os.urandom(100000)))
+
 	def test_check_bounce_mail(self):
 		h="testaddress@gpgmailencry.pt"
 		u="unknown@gpgmailencry.pt"
@@ -990,6 +1038,60 @@ class gmetests(unittest.TestCase):
 
 		self.assertTrue(res!=None)
 		
+	def test_sendmail_fileobject(self):
+		import gzip,io
+		buf=io.BytesIO()
+
+		with gzip.GzipFile(fileobj=buf,mode="wb") as f:
+			self.gme.set_output2file(f)
+			self.gme.send_mails(email_unencrypted,
+								"Test <testaddress@gpgmailencry.pt")
+
+		res=gzip.decompress(buf.getvalue()).decode("UTF-8")
+		self.assertTrue("BEGIN PGP MESSAGE" in res)
+
+	def test_sendmail_8bit(self):
+		import io
+		buf=io.BytesIO()
+		self.gme.set_output2file(buf)
+		mail=(	b"From: sender@gpgmailencry.pt\nTo: nobody@example.com\n"
+				b"Subject: test\nContent-Type: text/plain; charset=iso-8859-1\n"
+				b"Content-Transfer-Encoding: 8bit\n\nK\xe4se\n")
+		self.gme.send_mails(mail,"nobody@example.com")
+		self.assertTrue(b"\n\nK\xe4se\n" in buf.getvalue())
+
+	def test_link_temporaryfile(self):
+		f1=self.gme._store_temporaryfile(b"Subject: test\n\ntest")
+		f2=self.gme._link_temporaryfile(f1)
+		self.assertNotEqual(f1,f2)
+
+		with open(f2,"rb") as f:
+			self.assertEqual(f.read(),b"Subject: test\n\ntest")
+
+		os.remove(f1)
+		os.remove(f2)
+
+	def test_smtp_mailoptions(self):
+		class fakesmtp:
+			def __init__(self,extensions):
+				self.extensions=extensions
+			def has_extn(self,name):
+				return name in self.extensions
+
+		s=fakesmtp(["8bitmime","smtputf8"])
+		self.assertEqual(self.gme._smtp_mailoptions(s,b"abc","a@b.c","d@e.f"),
+						[])
+		self.assertEqual(self.gme._smtp_mailoptions(s,
+													b"K\xe4se",
+													"a@b.c",
+													"J\xf6rg <j\xf6rg@e.f>"),
+						["BODY=8BITMIME","SMTPUTF8"])
+		self.assertEqual(self.gme._smtp_mailoptions(fakesmtp([]),
+													b"K\xe4se",
+													"a@b.c",
+													"j\xf6rg@e.f"),
+						[])
+
 	def test_sendmail_use_sent(self):
 		self.gme.set_output2file("result.eml")
 		self.gme._USE_SENTADDRESS=True
@@ -1024,6 +1126,31 @@ class gmetests(unittest.TestCase):
 
 		self.assertTrue(res!=None)
 		
+	def test_sendmail_use_sent_checksonce(self):
+		self.gme._USE_SENTADDRESS=True
+		calls=[]
+		sent=[]
+
+		def extract_keys(raw_message):
+			calls.append("keys")
+
+		def encrypt_single_mail(queue_id,mailtext,from_addr,to_addr,*args,
+								**kwargs):
+			sent.append((from_addr,to_addr,kwargs["decrypt"]))
+
+		self.gme._extract_keys=extract_keys
+		self.gme._encrypt_single_mail=encrypt_single_mail
+		mail=email.message_from_string(email_unencrypted)
+		del mail["From"]
+		mail["From"]="testaddress@gpgmailencry.pt"
+		self.gme.send_mails(mail,["a@b.c","d@e.f"])
+		self.assertEqual(calls,["keys"])
+		self.assertEqual(sent,[
+			("testaddress@gpgmailencry.pt","a@b.c",True),
+			("testaddress@gpgmailencry.pt","d@e.f",True),
+			("SENT <testaddress@gpgmailencry.pt>",
+			"testaddress@gpgmailencry.pt",False)])
+
 	@unittest.skipIf(is_networkfilesystem("./gpg"),
 									"gpg directory on network file system")
 	def test_sendmail_dont_decrypt(self):
@@ -1107,6 +1234,97 @@ class gmetests(unittest.TestCase):
 			raise
 
 	
+	def test_resolvepolicies(self):
+		p=self.gme._resolve_policies(["TESTaddress@gpgmailencry.pt",
+									"dunno@dunno.pt"],
+									"test@from.com")
+		d=p["TESTaddress@gpgmailencry.pt"]
+		self.assertEqual((d.gpg,d.gpgkey,d.smime,d.smimekey,d.method),
+						(True,"testaddress@gpgmailencry.pt",
+						True,"testaddress@gpgmailencry.pt",
+						"PGPMIME"))
+		self.assertFalse(p["dunno@dunno.pt"].gpg)
+		self.assertFalse(p["dunno@dunno.pt"].smime)
+
+	def test_resolvepolicies_consistent(self):
+		recipients=["nokey@gpgmailencry.pt",
+					"pdf@gpgmailencry.pt",
+					"smime@gpgmailencry.pt",
+					"second.user@gpgmailencry.pt",
+					"dunno@dunno.pt"]
+		p=self.gme._resolve_policies(recipients,"test@from.com")
+
+		for r in recipients:
+			self.assertEqual((p[r].gpg,p[r].gpgkey),
+							self.gme.check_gpgrecipient(r,"test@from.com"))
+			self.assertEqual(p[r].smime,
+							self.gme.check_smimerecipient(r)[0])
+			self.assertEqual(p[r].method,
+							self.gme.get_preferredencryptionmethod(r))
+
+		self.assertEqual(p["nokey@gpgmailencry.pt"].gpgkey,
+						"testaddress@gpgmailencry.pt")
+		self.assertEqual(p["pdf@gpgmailencry.pt"].method,"PDF")
+		self.assertEqual(p["pdf@gpgmailencry.pt"].cipher,"AES256")
+
+	def test_resolvepolicies_domains(self):
+		self.gme._DOMAINS="other.pt, gpgmailencry.pt"
+		p=self.gme._resolve_policies(["testaddress@gpgmailencry.pt"],None)
+		self.assertTrue(p["testaddress@gpgmailencry.pt"].gpg)
+		self.gme._DOMAINS="other.pt"
+		p=self.gme._resolve_policies(["testaddress@gpgmailencry.pt"],None)
+		self.assertFalse(p["testaddress@gpgmailencry.pt"].gpg)
+		self.assertFalse(p["testaddress@gpgmailencry.pt"].smime)
+
+	def test_explainpolicy(self):
+		lines=self.gme.explain_policy("nokey@gpgmailencry.pt")
+		self.assertIn("method         PGPMIME",lines)
+		self.assertIn("because        usermap nokey@gpgmailencry.pt=>"
+						"testaddress@gpgmailencry.pt",lines)
+		self.assertIn("because        encryptionmap "
+						"testaddress@gpgmailencry.pt=>PGPMIME",lines)
+
+	def test_resolvepolicy_failed(self):
+		engine=self.gme._get_policyengine()
+
+		with mock.patch.object(engine,"_decide",side_effect=Exception):
+			policy=self.gme._resolve_policy("testaddress@gpgmailencry.pt",
+											"test@from.com")
+
+		self.assertEqual(policy.recipient,"testaddress@gpgmailencry.pt")
+		self.assertFalse(policy.gpg)
+		self.assertFalse(policy.smime)
+
+	@unittest.skipIf(is_networkfilesystem("./gpg"),
+									"gpg directory on network file system")
+	def test_sendmail_policylookups(self):
+		#the encryption uses the decision, the backend is asked once
+		self.gme.set_output2file("result.eml")
+		backend=self.gme._backend
+
+		with mock.patch.object(	self.gme,
+								"pgpmime_do_encryptsubject",
+								wraps=self.gme.pgpmime_do_encryptsubject
+								) as subject,\
+			mock.patch.object(	backend,
+								"gpg_additionalencryptionkeys",
+								wraps=backend.gpg_additionalencryptionkeys
+								) as keys,\
+			mock.patch.object(	backend,
+								"smime_additionalencryptionkeys",
+								wraps=backend.smime_additionalencryptionkeys
+								) as smimekeys:
+			self.gme.send_mails(email_unencrypted,
+								["testaddress@gpgmailencry.pt",
+								"dunno@dunno.pt"])
+
+		self.assertEqual(subject.call_count,1)
+		self.assertEqual(keys.call_count,1)
+		self.assertEqual(smimekeys.call_count,0)
+
+		with open("result.eml") as f:
+			self.assertTrue(self.gme.is_encrypted(f.read()))
+
 	def test_send_unencrypted_mail(self):
 		self.gme.set_output2file("result.eml")
 		self.assertTrue(self.gme._send_unencrypted_mail(-1,
@@ -1288,6 +1506,56 @@ class textstoragebackendtests(unittest.TestCase):
 			if u["user"]in ["testadmin","testadmin2"]:
 				print("in admin")
 				self.assertEqual(u["admin"],True)
+
+	def _set_deprecated_hash(self):
+		self.pwhashes={self.user:gmeutils.password._deprecated_get_hash(
+															self.password)}
+		self.gme.adm_get_pwhash=self.pwhashes.get
+
+	def test_deprecatedhashformat(self):
+		self.assertTrue(gmeutils.authenticator.is_deprecated_hash(
+				gmeutils.password._deprecated_get_hash(self.password)))
+		self.assertFalse(gmeutils.authenticator.is_deprecated_hash(
+				"$6$rounds=1000000$abc$def"))
+
+	def test_authenticate_deprecated_hash(self):
+		self._set_deprecated_hash()
+		self.assertTrue(self.gmeserver.authenticate(self.user,self.password))
+		self.assertFalse(self.gmeserver.authenticate(self.user,"wrong"))
+
+	def test_authenticate_cache(self):
+		self._set_deprecated_hash()
+		self.assertTrue(self.gmeserver.authenticate(self.user,self.password))
+		del self.pwhashes[self.user]
+		self.assertTrue(self.gmeserver.authenticate(self.user,self.password))
+		self.assertFalse(self.gmeserver.authenticate(self.user,"wrong"))
+
+	def test_authenticate_cache_invalidate(self):
+		self._set_deprecated_hash()
+		self.assertTrue(self.gmeserver.authenticate(self.user,self.password))
+		self.gme.adm_del_user(self.user)
+		del self.pwhashes[self.user]
+		self.assertFalse(self.gme._get_authenticator().cached(self.user,
+															self.password))
+		self.assertFalse(self.gmeserver.authenticate(self.user,self.password))
+
+	def test_authenticate_async(self):
+		self._set_deprecated_hash()
+		result=[]
+		self.gmeserver.authenticate_async(self.user,
+										self.password,
+										result.append)
+		self.assertEqual(result,[])
+
+		for i in range(50):
+
+			if result:
+				break
+
+			asyncore.loop(timeout=0.1,count=1)
+
+		self.assertEqual(result,[True])
+
 ###PDF
 	def test_setpdfpassword(self):
 		#self.gme.set_configfile("./gmetest.conf")
@@ -1409,6 +1677,19 @@ class sqlstoragebackendtests(textstoragebackendtests):
 		r,t=self.gme._backend.create_all_tables()
 		print(r,t)
 		self.assertEqual([],t)
+
+	def test_viruscache(self):
+		self.gme._backend._USE_SQLVIRUSCACHE=True
+		self.assertTrue(self.gme._backend.create_table("viruscache"))
+		checker,scanner=fake_viruschecker(self.gme)
+		checker.has_virus(virusmail([	("a.bin",b"clean content"),
+										("evil.bin",b"FAKEVIRUS")]))
+		checker.flush_cache()
+		checker,scanner=fake_viruschecker(self.gme)
+		self.assertEqual(checker.cache.count(),1)
+		result,info=checker.has_virus(virusmail([("x.bin",b"FAKEVIRUS")]))
+		self.assertTrue(result)
+		self.assertEqual(scanner.scanned,[])
 				
 ########################
 
@@ -1443,6 +1724,30 @@ class gpgtests(unittest.TestCase):
 		controllist.append("second.user@gpgmailencry.pt")
 		self.assertEqual(pk.sort(),controllist.sort())
 
+	def test_extractpublickey(self):
+		from email.mime.multipart import MIMEMultipart
+		from email.mime.application import MIMEApplication
+		import subprocess
+		key=subprocess.check_output([self.gme._GPGCMD,
+										"--homedir","./gpg",
+										"--export","--armor",
+										"testaddress@gpgmailencry.pt"],
+									stderr=subprocess.DEVNULL)
+		mail=MIMEMultipart()
+		mail.attach(MIMEApplication(key,"pgp-keys"))
+		directory=tempfile.mkdtemp()
+		fingerprint="872000C80678773B2A279DF39346B1D6491BF599"
+		self.assertEqual(gmeutils.gpgclass._pgp_fingerprint(key),fingerprint)
+		self.assertEqual(self.gpg.extract_publickey_from_mail(mail,directory),
+						[os.path.join(directory,fingerprint+".asc")])
+		self.assertEqual(self.gpg.extract_publickey_from_mail(mail,directory),
+						[])
+		#a new index reads the known keys from the directory
+		self.gme._keyindex=gmeutils.keyindex._KEYINDEX(self.gme)
+		self.assertEqual(self.gpg.extract_publickey_from_mail(mail,directory),
+						[])
+		shutil.rmtree(directory)
+
 	def test_hasgpgkey(self):
 		success,user=self.gme.check_gpgrecipient("second.user@gpgmailencry.pt")
 		self.assertTrue(success)
@@ -1534,6 +1839,42 @@ class gpgtests(unittest.TestCase):
 											"testaddress@gpgmailencry.pt")
 		self.assertIsNotNone(result)
 
+	def _inlineattachmentnames(self,workers):
+		from email.mime.multipart import MIMEMultipart
+		from email.mime.application import MIMEApplication
+		from email.mime.text import MIMEText
+		self.gme._GPGINLINEWORKERS=workers
+		mail=MIMEMultipart()
+		mail.attach(MIMEText("body"))
+
+		for i in range(6):
+			a=MIMEApplication(os.urandom(1000*(6-i)),"octet-stream")
+			a.add_header("Content-Disposition","attachment")
+			mail.attach(a)
+
+		result=self.gme.encrypt_pgpinline_mail(	mail,
+											"testaddress@gpgmailencry.pt",
+											"testaddress@gpgmailencry.pt",
+											"testaddress@gpgmailencry.pt")
+		self.assertIsNotNone(result)
+		return [m.get_filename() for m in result.walk() if m.get_filename()]
+
+	def test_encryptgpginline_parallel(self):
+		names=self._inlineattachmentnames(4)
+		self.assertEqual(len(names),6)
+		self.assertEqual(names,self._inlineattachmentnames(1))
+
+	def test_encryptgpginline_parallel_failure(self):
+		self.gme._GPGINLINEWORKERS=4
+		f=open("./attachment.eml","r")
+		mail=f.read()
+		f.close()
+		result=self.gme.encrypt_pgpinline_mail(	email.message_from_string(mail),
+											"xtestaddress@gpgmailencry.pt",
+											"testaddress@gpgmailencry.pt",
+											"testaddress@gpgmailencry.pt")
+		self.assertIsNone(result)
+
 	def test_encryptgpginline_wrongencoding(self):
 		result=self.gme.encrypt_pgp_mail(  email_wrongencoding,
 											False,
@@ -1763,6 +2104,54 @@ class smimetests(unittest.TestCase):
 		fingerprint=gmeutils.helpers.get_certfingerprint(cert)
 		self.assertEqual(fingerprint,smimecertfingerprint)
 
+	def test_smime_extractpublickey(self):
+		from email.mime.multipart import MIMEMultipart
+		from email.mime.application import MIMEApplication
+		import subprocess
+		p7s=subprocess.check_output([self.gme._SMIMECMD,
+										"crl2pkcs7","-nocrl",
+										"-certfile","./smime/cert.crt",
+										"-outform","DER"])
+		mail=MIMEMultipart("signed")
+		mail.attach(email.message_from_string(email_unencrypted))
+		mail.attach(MIMEApplication(p7s,"pkcs7-signature"))
+		directory=tempfile.mkdtemp()
+		self.assertIsNone(self.smime.extract_publickey_from_mail(
+												email_unencrypted,directory))
+		targetname=self.smime.extract_publickey_from_mail(mail,directory)
+		self.assertEqual(targetname,os.path.join(directory,
+							"0B659830A6AF8CEC900B6836BC54DA220AA78650.pem"))
+
+		with open(targetname,"rb") as f1, open("./smime/cert.crt","rb") as f2:
+			self.assertEqual(gmeutils.smimeclass._pem2der(f1.read()),
+							gmeutils.smimeclass._pem2der(f2.read()))
+
+		self.assertIsNone(self.smime.extract_publickey_from_mail(mail,
+																directory))
+		self.assertEqual(os.listdir(directory),[os.path.basename(targetname)])
+		shutil.rmtree(directory)
+
+	def test_smime_extractpublickey_oldname(self):
+		from email.mime.multipart import MIMEMultipart
+		from email.mime.application import MIMEApplication
+		import subprocess
+		p7s=subprocess.check_output([self.gme._SMIMECMD,
+										"crl2pkcs7","-nocrl",
+										"-certfile","./smime/cert.crt",
+										"-outform","DER"])
+		mail=MIMEMultipart("signed")
+		mail.attach(email.message_from_string(email_unencrypted))
+		mail.attach(MIMEApplication(p7s,"pkcs7-signature"))
+		directory=tempfile.mkdtemp()
+		#named with the openssl fingerprint by older versions
+		oldname="0B:65:98:30:A6:AF:8C:EC:90:0B:68:36:BC:54:DA:22:0A:A7:86:50.pem"
+		shutil.copy("./smime/cert.crt",os.path.join(directory,oldname))
+		self.gme._keyindex=gmeutils.keyindex._KEYINDEX(self.gme)
+		self.assertIsNone(self.smime.extract_publickey_from_mail(mail,
+																directory))
+		self.assertEqual(os.listdir(directory),[oldname])
+		shutil.rmtree(directory)
+
 	def test_additionalsmimeencryptionkeys(self):
 		user=["centralsmime@gpgmailencry.pt","u2@somebody.pt"]
 		self.gme.set_configfile("./gmetest2.conf")
@@ -1833,6 +2222,8 @@ class pdftests(unittest.TestCase):
 		self.assertIn("4:/tmp/mail-",res[3])
 		self.assertEqual(res[4],"5:")
 
+	@unittest.skipIf(not has_app("pdftk"),
+		"pdftk not installed")
 	def test_decryptpdf(self):
 		pdf=self.gme.pdf_factory()
 		f=tempfile.NamedTemporaryFile(  mode='wb',
@@ -1846,6 +2237,176 @@ class pdftests(unittest.TestCase):
 		res=filecmp.cmp(f.name,"./archives/unencrypted.pdf",shallow=False)
 		self.assertTrue(res)
 
+	def test_finishpdf(self):
+		pdf=self.gme.pdf_factory()
+
+		with open("./archives/unencrypted.pdf","rb") as f:
+			data=pdf._finish_pdf(	f.read(),
+									{"Title":"pdftest"},
+									"secret",
+									"testaddress@gpgmailencry.pt")
+
+		reader=PyPDF2.PdfFileReader(io.BytesIO(data))
+		self.assertTrue(reader.isEncrypted)
+		self.assertTrue(reader.decrypt("secret")>0)
+		self.assertEqual(reader.getDocumentInfo()["/Title"],"pdftest")
+
+
+def has_reportlab():
+	try:
+		import reportlab
+	except:
+		return False
+
+	return True
+
+@unittest.skipIf(not has_reportlab() or PyPDF2==None,
+		"reportlab or pypdf2 not available")
+class textpdftests(unittest.TestCase):
+	def setUp(self):
+		self.gme=gpgmailencrypt.gme()
+		self.gme.set_configfile("./gmetest.conf")
+
+	def tearDown(self):
+		self.gme.close()
+
+	def _tempmail(self,mail):
+		fp=self.gme._new_tempfile()
+		fp.write(mail.encode("UTF-8"))
+		fp.close()
+		return fp.name
+
+	def _render(self,mail):
+		fname=self._tempmail(mail)
+		pdf=self.gme.pdf_factory()
+		pdf.set_filename(fname)
+		rendered=pdf._render_textmail()
+		self.gme._del_tempfile(fname)
+		return rendered
+
+	def test_nativetextpdf(self):
+		rendered=self._render(email_unencrypted)
+		self.assertIn("pdf",rendered)
+		reader=PyPDF2.PdfFileReader(io.BytesIO(rendered["pdf"]))
+		self.assertEqual(reader.getNumPages(),1)
+		self.assertEqual(rendered["metadata"]["Title"],"testmail")
+
+	def test_nativetextpdf_longmail(self):
+		mail=email_unencrypted+("word "*100+"\n")*100
+		rendered=self._render(mail)
+		reader=PyPDF2.PdfFileReader(io.BytesIO(rendered["pdf"]))
+		self.assertTrue(reader.getNumPages()>1)
+
+	def test_nativetextpdf_html(self):
+		mail=email_unencrypted.replace("text/plain","text/html")
+		self.assertEqual(self._render(mail),{})
+
+	def test_nativetextpdf_disabled(self):
+		self.gme._PDFNATIVETEXT=False
+		self.assertEqual(self._render(email_unencrypted),{})
+
+	def test_nativetextpdf_nowkhtmltopdf(self):
+		pdf=self.gme.pdf_factory()
+		pdf._pdfwkhtml2pdf=None
+		self.assertTrue(pdf.is_available())
+		result,data=pdf.create_pdffile(None,
+									"testaddress@gpgmailencry.pt",
+									self._tempmail(email_unencrypted))
+		self.assertTrue(result)
+		reader=PyPDF2.PdfFileReader(io.BytesIO(data))
+		self.assertEqual(reader.getNumPages(),1)
+		html=self._tempmail(email_unencrypted.replace("text/plain",
+														"text/html"))
+		self.assertEqual(pdf.create_pdffile(None,
+											"testaddress@gpgmailencry.pt",
+											html),
+						(False,None))
+		self.gme._PDFNATIVETEXT=False
+		self.assertFalse(pdf.is_available())
+
+	def test_decryptpdf(self):
+		pdf=self.gme.pdf_factory()
+		self.gme._backend.set_pdfpassword("b@test.de","recipientpw")
+		data=pdf._finish_pdf(self._render(email_unencrypted)["pdf"],
+							{},
+							"recipientpw",
+							"a@test.de")
+		fp=self.gme._new_tempfile()
+		fp.write(data)
+		fp.close()
+		self.assertTrue(pdf.is_encrypted(fp.name))
+		r,fname=pdf.decrypt_file(fp.name,"a@test.de","b@test.de")
+		self.assertTrue(r)
+		self.assertFalse(pdf.is_encrypted(fname))
+
+		with open(fname,"rb") as f:
+			reader=PyPDF2.PdfFileReader(io.BytesIO(f.read()))
+
+		self.assertEqual(reader.getNumPages(),1)
+		self.gme._del_tempfile(fname)
+		self.assertEqual([s for s,pw in self.gme._pdfpassword_candidates(
+												"a@test.de","b@test.de")][0],
+						"recipient")
+		#the owner password is the additional encryption key
+		self.gme._backend.set_pdfpassword("b@test.de","otherpw")
+		r,fname=pdf.decrypt_file(fp.name,"a@test.de","b@test.de")
+		self.assertTrue(r)
+		self.assertEqual(self.gme._pdfpasswordsources[("a@test.de",
+														"b@test.de")],
+						"recipient additional")
+		self.gme._del_tempfile(fname)
+		self.gme._backend._PDF_ENCRYPTIONKEY=None
+		self.assertEqual(pdf.decrypt_file(fp.name,"a@test.de","b@test.de"),
+						(False,None))
+		self.gme._del_tempfile(fp.name)
+
+class fakehtmlrenderer(gmeutils.renderpool._basehtmlrenderer):
+	maxjobs=2
+	started=0
+
+	def start(self):
+		fakehtmlrenderer.started+=1
+
+	def render(self,payload,timeout):
+		self.jobs+=1
+		return b"%PDF-"+payload,b"",0
+
+class renderpooltests(unittest.TestCase):
+	def setUp(self):
+		self.gme=gpgmailencrypt.gme()
+		self.gme.set_configfile("./gmetest.conf")
+		fakehtmlrenderer.started=0
+
+	def tearDown(self):
+		self.gme.close()
+
+	def test_renderpool(self):
+		pool=gmeutils.renderpool._RENDERPOOL(	parent=self.gme,
+												size=2,
+												renderer=fakehtmlrenderer)
+		self.assertEqual(fakehtmlrenderer.started,2)
+
+		for i in range(4):
+			self.assertEqual(pool.render(b"html"),(b"%PDF-html",b"",0))
+
+		#each renderer is replaced after 2 jobs
+		self.assertEqual(fakehtmlrenderer.started,4)
+		pool.close()
+		self.assertEqual(pool.render(b"html")[2],-1)
+
+	def test_renderpool_timeout(self):
+		pool=gmeutils.renderpool._RENDERPOOL(	parent=self.gme,
+												size=1,
+												timeout=1,
+												renderer=fakehtmlrenderer)
+		renderer=pool._idle.get()
+		self.assertEqual(pool.render(b"html")[2],-1)
+		pool._idle.put(renderer)
+		self.assertEqual(pool.render(b"html")[2],0)
+		pool.close()
+
+	def test_renderpool_daemononly(self):
+		self.assertIsNone(self.gme._get_renderpool())
 
 #############
 #ARCHIVETESTS
@@ -1985,6 +2546,119 @@ class archivetests(unittest.TestCase):
 
 		self.assertEqual(data,self.teststring)
 
+	def test_zipdata_native(self):
+		import io,zipfile
+		ZIP=self.gme.zip_factory()
+		_result,encdata=ZIP.create_zipdata(
+							[("testfile.txt",self.teststring.encode("UTF-8"))])
+		self.assertTrue(_result)
+
+		with zipfile.ZipFile(io.BytesIO(encdata)) as z:
+			data=z.read("testfile.txt").decode("UTF-8")
+
+		self.assertEqual(data,self.teststring)
+
+	@unittest.skipIf(not gmeutils.archivemanagers._pyzipper_available,
+		"pyzipper not installed")
+	def test_zipdata_aes_container(self):
+		import io,pyzipper
+		ZIP=self.gme.zip_factory()
+		ZIP.set_zipcipher("AES256")
+		_result,encdata=ZIP.create_zipdata(
+							[("testfile.txt",self.teststring.encode("UTF-8"))],
+							password=self.password,
+							containerfile=self.containerfile)
+		self.assertTrue(_result)
+
+		with pyzipper.AESZipFile(io.BytesIO(encdata)) as z:
+			self.assertEqual(z.namelist(),["container.zip"])
+			z.setpassword(self.password.encode("UTF-8"))
+			inner=z.read("container.zip")
+
+		with pyzipper.AESZipFile(io.BytesIO(inner)) as z:
+			data=z.read("testfile.txt").decode("UTF-8")
+
+		self.assertEqual(data,self.teststring)
+
+	@unittest.skipIf(not gmeutils.archivemanagers._py7zr_available,
+		"py7zr not installed")
+	def test_7zdata_native(self):
+		import io,py7zr
+		ZIP=self.gme.a7z_factory()
+		_result,encdata=ZIP.create_zipdata(
+							[("testfile.txt",self.teststring.encode("UTF-8"))],
+							password=self.password)
+		self.assertTrue(_result)
+
+		directory=tempfile.mkdtemp()
+
+		with py7zr.SevenZipFile(io.BytesIO(encdata),
+								password=self.password) as z:
+			z.extractall(path=directory)
+
+		with open(os.path.join(directory,"testfile.txt"),"rb") as f:
+			data=f.read().decode("UTF-8")
+
+		shutil.rmtree(directory)
+
+		self.assertEqual(data,self.teststring)
+
+	def test_zipattachment_native(self):
+		import io,zipfile
+		f=open("./attachment.eml","r")
+		mail=f.read()
+		f.close()
+		self.gme._USE7ZARCHIVE=False
+		res=self.gme.zip_attachments(mail)
+
+		for m in res.walk():
+
+			if m.get_filename()=="test.pdf.zip":
+				z=zipfile.ZipFile(io.BytesIO(m.get_payload(decode=True)))
+				self.assertEqual(z.namelist(),["test.pdf"])
+				return
+
+		self.fail("no zip attachment found")
+
+	def _multiattachmentmail(self,count):
+		from email.mime.multipart import MIMEMultipart
+		from email.mime.application import MIMEApplication
+		from email.mime.text import MIMEText
+		mail=MIMEMultipart()
+		mail["From"]="testaddress@gpgmailencry.pt"
+		mail["To"]="testaddress@gpgmailencry.pt"
+		mail.attach(MIMEText("body"))
+
+		for i in range(count):
+			a=MIMEApplication((("file %i "%i)*5000).encode("UTF-8"),
+								"msword")
+			a.add_header("Content-Disposition","attachment",
+							filename="file%i.doc"%i)
+			mail.attach(a)
+
+		return mail
+
+	def test_zipattachments_parallel(self):
+		import io,zipfile
+		self.gme._USE7ZARCHIVE=False
+		self.gme._ZIPWORKERS=4
+		res=self.gme.zip_attachments(self._multiattachmentmail(8))
+		names=[m.get_filename() for m in res.walk() if m.get_filename()]
+		self.assertEqual(names,["file%i.doc.zip"%i for i in range(8)])
+
+		for i,m in enumerate([m for m in res.walk() if m.get_filename()]):
+			z=zipfile.ZipFile(io.BytesIO(m.get_payload(decode=True)))
+			self.assertEqual(z.read("file%i.doc"%i),
+							(("file %i "%i)*5000).encode("UTF-8"))
+
+	def test_zipattachments_cpubudget(self):
+		self.gme._USE7ZARCHIVE=False
+		self.gme._ZIPWORKERS=1
+		self.gme._ZIPCPUBUDGET=0.000001
+		res=self.gme.zip_attachments(self._multiattachmentmail(3))
+		names=[m.get_filename() for m in res.walk() if m.get_filename()]
+		self.assertEqual(names,["file0.doc.zip","file1.doc","file2.doc"])
+
 	@unittest.skipIf(not has_app("7za"),
 		"archive programm 7z not installed")
 	def test_7zuncompress(self):
@@ -2114,9 +2788,149 @@ def check_virus(scanner,virusdir):
 
 		return (result[0] and scanner!=None)
 
+class fakevirusscanner(gmeutils.virusscanners._basevirusscanner):
+	"flags every file that contains the word 'FAKEVIRUS'"
+
+	def __init__(self,parent):
+		gmeutils.virusscanners._basevirusscanner.__init__(self,parent)
+		self.scanned=[]
+		self.version="1"
+
+	def has_virus(self,directory):
+		result=False
+		information=[]
+
+		for root, directories, files in os.walk(directory):
+
+			for f in files:
+				self.scanned.append(f)
+
+				with open(os.path.join(root,f),"rb") as fp:
+
+					if b"FAKEVIRUS" in fp.read():
+						information.append(["FAKE",f,"Fake.Virus"])
+						result=True
+
+		return result,information
+
+	def signature_version(self):
+		return self.version
+
+def virusmail(attachments):
+	import email.mime.multipart
+	import email.mime.application
+	import email.mime.text
+	msg=email.mime.multipart.MIMEMultipart()
+	msg["From"]="from@gpgmailencry.pt"
+	msg["To"]="to@gpgmailencry.pt"
+	msg.attach(email.mime.text.MIMEText("body"))
+
+	for name,content in attachments:
+		a=email.mime.application.MIMEApplication(content)
+		a.add_header("Content-Disposition","attachment",filename=name)
+		msg.attach(a)
+
+	return msg.as_string()
+
+def fake_viruschecker(gme):
+	import gmeutils.viruscheck
+	checker=gmeutils.viruscheck._virus_check(parent=gme)
+	scanner=fakevirusscanner(checker)
+	checker.virusscanner={"FAKE":scanner}
+	return checker,scanner
+
 ############################################
 class virustests(unittest.TestCase):
 
+	def setUp(self):
+		self.gme=gpgmailencrypt.gme()
+		self.gme.set_configfile("./gmetest.conf")
+
+	def tearDown(self):
+		self.gme.close()
+
+	def test_viruscache_skipknowncontent(self):
+		checker,scanner=fake_viruschecker(self.gme)
+		mail=virusmail([("a.bin",b"clean content"),("b.bin",b"other")])
+		self.assertEqual(checker.has_virus(mail),(False,[]))
+		self.assertEqual(sorted(scanner.scanned),["a.bin","b.bin"])
+		scanner.scanned=[]
+		mail=virusmail([("renamed.bin",b"clean content"),("c.bin",b"new")])
+		self.assertEqual(checker.has_virus(mail),(False,[]))
+		self.assertEqual(scanner.scanned,["c.bin"])
+
+	def test_viruscache_keepsinfected(self):
+		checker,scanner=fake_viruschecker(self.gme)
+		mail=virusmail([("evil.bin",b"FAKEVIRUS")])
+		self.assertTrue(checker.has_virus(mail)[0])
+		scanner.scanned=[]
+		scanner.version="2"
+		checker._signaturetime=0
+		mail=virusmail([("again.bin",b"FAKEVIRUS")])
+		result,info=checker.has_virus(mail)
+		self.assertTrue(result)
+		self.assertEqual(info,[["FAKE","again.bin","Fake.Virus"]])
+		self.assertEqual(scanner.scanned,[])
+
+	def test_viruscache_signatureupdate(self):
+		checker,scanner=fake_viruschecker(self.gme)
+		mail=virusmail([("a.bin",b"clean content")])
+		checker.has_virus(mail)
+		scanner.scanned=[]
+		scanner.version="2"
+		checker._signaturetime=0
+		checker.has_virus(mail)
+		self.assertEqual(scanner.scanned,["a.bin"])
+
+	def test_viruscache_unknownsignature(self):
+		checker,scanner=fake_viruschecker(self.gme)
+		scanner.version=None
+		mail=virusmail([("a.bin",b"clean content")])
+		checker.has_virus(mail)
+		checker.has_virus(mail)
+		self.assertEqual(scanner.scanned,["a.bin","a.bin"])
+		mail=virusmail([("evil.bin",b"FAKEVIRUS")])
+		self.assertTrue(checker.has_virus(mail)[0])
+		scanner.scanned=[]
+		self.assertTrue(checker.has_virus(mail)[0])
+		self.assertEqual(scanner.scanned,[])
+
+	def test_signaturedirs(self):
+		import gmeutils.viruscheck
+		checker=gmeutils.viruscheck._virus_check(parent=self.gme)
+		scanner=gmeutils.virusscanners._basevirusscanner(checker)
+		self.assertEqual(scanner.signature_version(),None)
+
+		with tempfile.TemporaryDirectory() as d:
+			scanner.signaturedirs=[os.path.join(d,"missing"),d]
+			db=os.path.join(d,"main.cvd")
+
+			with open(db,"w") as f:
+				f.write("signatures")
+
+			os.utime(db,(1000,1000))
+			os.utime(d,(1000,1000))
+			old=scanner.signature_version()
+			self.assertEqual(old,"%s:1000"%d)
+			os.utime(db,(2000,2000))
+			self.assertNotEqual(scanner.signature_version(),old)
+
+	def test_viruscache_ttl(self):
+		self.gme._VIRUSCACHETTL=0
+		checker,scanner=fake_viruschecker(self.gme)
+		mail=virusmail([("a.bin",b"clean content")])
+		checker.has_virus(mail)
+		checker.has_virus(mail)
+		self.assertEqual(scanner.scanned,["a.bin","a.bin"])
+
+	def test_viruscache_disabled(self):
+		self.gme._VIRUSCACHE=False
+		checker,scanner=fake_viruschecker(self.gme)
+		mail=virusmail([("a.bin",b"clean content")])
+		checker.has_virus(mail)
+		checker.has_virus(mail)
+		self.assertEqual(scanner.scanned,["a.bin","a.bin"])
+
 	@unittest.skipIf((not has_scanner("clamav")),
 		"virusscanner clamav not found")
 	def test_clamav(self):
@@ -2214,9 +3028,115 @@ class dkimtests(unittest.TestCase):
 		msg=dk.sign_mail(email_unencrypted.replace("\n","\r\n"))
 		self.assertTrue("DKIM-Signature" in msg)
 
+############
+#METRICSTEST
+############
+class metricstests(unittest.TestCase):
+
+	def setUp(self):
+		self.gme=gpgmailencrypt.gme()
+		self.gme.set_configfile("./gmetest.conf")
+
+	def tearDown(self):
+		self.gme.close()
+
+		try:
+			os.remove("./result.eml")
+		except:
+			pass
+
+	def test_metrics_stages(self):
+		self.gme.set_output2file("result.eml")
+		self.gme.send_mails(email_unencrypted,"testaddress@gpgmailencry.pt")
+		m=self.gme.get_metrics()
+		self.assertEqual(m["stages"]["parse"]["count"],1)
+		self.assertEqual(m["stages"]["policy"]["count"],1)
+		self.assertEqual(m["stages"]["gpg"]["count"],1)
+		self.assertEqual(m["stages"]["send"]["count"],1)
+		self.assertEqual(m["inflight"],0)
+		self.assertTrue(m["spawns"].get("gpg",0)>0)
+
+	def test_metrics_reset(self):
+		self.gme._metrics.observe("zip",0.2)
+		self.gme.reset_statistics()
+		self.assertEqual(self.gme.get_metrics()["stages"]["zip"]["count"],0)
+
+	def test_metrics_prometheus(self):
+		self.gme._metrics.observe("gpg",0.02)
+		self.gme._metrics.observe("gpg",3.0)
+		f=tempfile.NamedTemporaryFile(delete=False)
+		f.close()
+		self.assertTrue(self.gme.write_metrics(f.name))
+
+		with open(f.name) as fp:
+			txt=fp.read()
+
+		os.remove(f.name)
+		self.assertIn("gpgmailencrypt_stage_duration_seconds_bucket"
+						"{stage=\"gpg\",le=\"0.025\"} 1",txt)
+		self.assertIn("gpgmailencrypt_stage_duration_seconds_bucket"
+						"{stage=\"gpg\",le=\"+Inf\"} 2",txt)
+		self.assertIn("gpgmailencrypt_stage_duration_seconds_count"
+						"{stage=\"gpg\"} 2",txt)
+
 ################
 #SPAMSCANNERTEST
 ################
+class fakespamdhandler(socketserver.StreamRequestHandler):
+	"answers SPAMD/1.x requests, keeps the connection open"
+
+	def handle(self):
+		self.server.connections+=1
+
+		while True:
+			line=self.rfile.readline()
+
+			if not line:
+				break
+
+			verb=line.split()[0].decode("ascii")
+			length=0
+
+			while True:
+				h=self.rfile.readline()
+
+				if h in (b"\r\n",b""):
+					break
+
+				if h.lower().startswith(b"content-length:"):
+					length=int(h.split(b":")[1])
+
+			mail=self.rfile.read(length)
+			self.server.received.append(mail)
+
+			if b"GTUBE" in mail:
+				spam,score,body="True",1000.0,b"GTUBE,MISSING_DATE"
+			else:
+				spam,score,body="False",0.5,b"NO_RELAYS"
+
+			if verb!="SYMBOLS":
+				body=b""
+
+			self.wfile.write((	"SPAMD/1.1 0 EX_OK\r\n"
+								"Content-length: %i\r\n"
+								"Spam: %s ; %.1f / 5.0\r\n\r\n"%(
+											len(body),
+											spam,
+											score)).encode("ascii")+body)
+			self.wfile.flush()
+
+class fakespamd(socketserver.ThreadingTCPServer):
+	daemon_threads=True
+	allow_reuse_address=True
+
+	def __init__(self):
+		socketserver.ThreadingTCPServer.__init__(self,
+												("127.0.0.1",0),
+												fakespamdhandler)
+		self.connections=0
+		self.received=[]
+		threading.Thread(target=self.serve_forever,daemon=True).start()
+
 class spamscannertests(unittest.TestCase):
 
 	def setUp(self):
@@ -2257,6 +3177,166 @@ class spamscannertests(unittest.TestCase):
 		print("spamlevel",spamlevel,"score",score,self.spam_leveldict["SPAMASSASSIN"])
 		self.assertEqual(spamlevel,gmeutils.spamscanners.S_NOSPAM)
 
+	def _spamd(self,verb="CHECK",maxsize=500000):
+		self.spamd=fakespamd()
+		self.spam_leveldict["SPAMASSASSIN"]=[6.2,
+											3.0,
+											"127.0.0.1",
+											self.spamd.server_address[1],
+											maxsize,
+											5.0,
+											verb,
+											True,
+											False]
+		return gmeutils.spamscanners.get_spamscanner("SPAMASSASSIN",
+												parent=self.gme,
+												leveldict=self.spam_leveldict)
+
+	def _stopspamd(self,sc):
+		sc.close()
+		self.spamd.shutdown()
+		self.spamd.server_close()
+
+	def test_spamd_spam(self):
+		sc=self._spamd()
+		spamlevel,score=sc.is_spam(spamgtube)
+		self._stopspamd(sc)
+		self.assertEqual(spamlevel,gmeutils.spamscanners.S_SPAM)
+		self.assertEqual(score,1000.0)
+
+	def test_spamd_nospam(self):
+		sc=self._spamd()
+		spamlevel,score=sc.is_spam(email_unencrypted)
+		self._stopspamd(sc)
+		self.assertEqual(spamlevel,gmeutils.spamscanners.S_NOSPAM)
+		self.assertEqual(score,0.5)
+
+	def test_spamd_symbols(self):
+		sc=self._spamd(verb="SYMBOLS")
+		sc.is_spam(spamgtube)
+		self._stopspamd(sc)
+		self.assertEqual(sc.symbols,["GTUBE","MISSING_DATE"])
+
+	def test_spamd_persistentconnection(self):
+		sc=self._spamd()
+		sc.is_spam(email_unencrypted)
+		sc.is_spam(spamgtube)
+		self._stopspamd(sc)
+		self.assertEqual(len(self.spamd.received),2)
+		self.assertEqual(self.spamd.connections,1)
+
+	def test_spamd_maxsize(self):
+		sc=self._spamd(maxsize=100)
+		spamlevel,score=sc.is_spam(spamgtube)
+		self._stopspamd(sc)
+		self.assertEqual(spamlevel,gmeutils.spamscanners.S_NOSPAM)
+		self.assertEqual(self.spamd.connections,0)
+
+	def test_spamd_notrunning(self):
+		self.spam_leveldict["SPAMASSASSIN"]=[6.2,3.0,"127.0.0.1",1,500000]
+		sc=gmeutils.spamscanners.get_spamscanner("SPAMASSASSIN",
+												parent=self.gme,
+												leveldict=self.spam_leveldict)
+		self.assertEqual(sc.is_spam(spamgtube),
+						(gmeutils.spamscanners.S_NOSPAM,0.0))
+
+	def test_sendmail_spamd_headers(self):
+		sc=self._spamd()
+		self.gme._SPAMCHECK=True
+		self.gme._spam_checker=sc
+		self.gme._SPAMADDHEADER=True
+		self.gme.set_output2file("result.eml")
+		self.gme.send_mails(email_unencrypted,"testaddress@gpgmailencry.pt")
+		self._stopspamd(sc)
+
+		with open("result.eml") as f:
+			res=email.message_from_file(f)
+
+		os.remove("result.eml")
+		self.assertEqual(res["X-Spam-Score"],"0.5")
+		self.assertEqual(res["X-Spam-Flag"],"False")
+		self.assertTrue(self.gme.is_encrypted(res))
+
+	@unittest.skipIf(not has_app("bogofilter"),
+		"bogofilter not installed")
+	def test_bogofilter_batch(self):
+		sc=gmeutils.spamscanners.get_spamscanner("BOGOFILTER",
+												parent=self.gme,
+												leveldict=self.spam_leveldict)
+		result=sc.is_spam_batch([spamgtube,email_unencrypted])
+		self.assertEqual(len(result),2)
+		self.assertEqual(result[0][0],gmeutils.spamscanners.S_SPAM)
+		self.assertEqual(result[1][0],gmeutils.spamscanners.S_NOSPAM)
+
+	def test_bogofilter_batch_parse(self):
+		#fake bogofilter, classifies the mails with 'spam' in them as spam
+		directory=tempfile.mkdtemp()
+		cmd=os.path.join(directory,"bogofilter")
+
+		with open(cmd,"w") as f:
+			f.write("#!/bin/sh\n"
+					"while read name; do\n"
+					"  if grep -q spam \"$name\"; then\n"
+					"    echo \"$name S 0.990000\"\n"
+					"  else\n"
+					"    echo \"$name H 0.010000\"\n"
+					"  fi\n"
+					"done\n")
+
+		os.chmod(cmd,0o755)
+		sc=gmeutils.spamscanners._BOGOFILTER(self.gme,self.spam_leveldict)
+		sc.cmd=cmd
+		result=sc.is_spam_batch(["buy spam now",email_unencrypted])
+		shutil.rmtree(directory)
+		self.assertEqual([r[0] for r in result],
+						[gmeutils.spamscanners.S_SPAM,
+						gmeutils.spamscanners.S_NOSPAM])
+
+	def test_check_mailqueue_spam(self):
+		directory=tempfile.mkdtemp()
+		calls=[]
+		batches=[]
+
+		class fakespamchecker(gmeutils.spamscanners._basespamchecker):
+
+			def is_spam(self,mail):
+				return (gmeutils.spamscanners.S_SPAM if b"spam" in mail
+						else gmeutils.spamscanners.S_NOSPAM,0.0)
+
+			def is_spam_batch(self,mails):
+				batches.append(len(mails))
+				return gmeutils.spamscanners._basespamchecker.is_spam_batch(
+																self,
+																mails)
+
+		def encrypt_single_mail(queue_id,mailtext,from_addr,to_addr,
+								is_spam=gmeutils.spamscanners.S_NOSPAM,
+								*args,**kwargs):
+			calls.append((to_addr,is_spam))
+
+		for i,text in enumerate((b"spam",b"ham")):
+			fname=os.path.join(directory,"mail%i"%i)
+
+			with open(fname,"wb") as f:
+				f.write(text)
+
+			self.gme._email_queue[i]=[	fname,
+										"test@from.com",
+										"to%i@gpgmailencry.pt"%i,
+										time.time()]
+
+		self.gme._SPAMCHECK=True
+		self.gme._spam_checker=fakespamchecker(self.gme,{})
+		self.gme._encrypt_single_mail=encrypt_single_mail
+		self.gme.check_mailqueue()
+		shutil.rmtree(directory)
+		self.assertEqual(batches,[2])
+		self.assertEqual(sorted(calls),
+						[("to0@gpgmailencry.pt",gmeutils.spamscanners.S_SPAM),
+						("to1@gpgmailencry.pt",
+						gmeutils.spamscanners.S_NOSPAM)])
+		self.assertEqual(self.gme._email_queue,{})
+
 	@unittest.skipIf(not has_app("bogofilter"),
 		"bogofilter not installed")
 	def test_bogofilter_spam(self):
@@ -2302,7 +3382,529 @@ class servertests(unittest.TestCase):
 		time.sleep(3)
 		self.assertTrue(p.is_alive())
 		p.terminate()
+
+	def test_admission_sessions(self):
+		self.gme._SMTPD_MAXSESSIONS=1
+		a=gmeutils.admission._ADMISSION(self.gme)
+		self.assertEqual(a.open_session("127.0.0.1"),None)
+		self.assertTrue(a.open_session("127.0.0.1").startswith("421"))
+		a.close_session()
+		self.assertEqual(a.open_session("127.0.0.1"),None)
+		self.assertEqual(a.rejected["sessions"],1)
+
+	def test_admission_ratelimits(self):
+		self.gme._SMTPD_IPRATELIMIT=2
+		self.gme._SMTPD_SENDERRATELIMIT=1
+		a=gmeutils.admission._ADMISSION(self.gme)
+		self.assertEqual(a.open_session("10.0.0.1"),None)
+		self.assertEqual(a.open_session("10.0.0.1"),None)
+		self.assertTrue(a.open_session("10.0.0.1").startswith("421"))
+		self.assertEqual(a.open_session("10.0.0.2"),None)
+		self.assertEqual(a.check_mail("a@gpgmailencry.pt"),None)
+		self.assertTrue(a.check_mail("A@gpgmailencry.pt").startswith("451"))
+		self.assertEqual(a.check_mail("b@gpgmailencry.pt"),None)
+
+	def test_admission_load(self):
+		self.gme._SMTPD_MAXINFLIGHT=1
+		self.gme._SMTPD_MAXQUEUEDBYTES=10
+		a=gmeutils.admission._ADMISSION(self.gme)
+		self.assertEqual(a.start_message(),None)
+		self.assertTrue(a.start_message().startswith("451"))
+		self.assertFalse(a.add_bytes(11))
+		a.end_message(11)
+		self.assertEqual((a.inflight,a.queuedbytes),(0,0))
+		self.assertEqual(a.check_mail("a@gpgmailencry.pt"),None)
+
+	def test_server_admission(self):
+		self.gme._SMTPD_MAXSESSIONS=1
+		self.gme._SMTPD_MAXQUEUEDBYTES=1000
+		server=gmeutils.gpgmailserver._gpgmailencryptserver(self.gme,
+															("localhost",0))
+		port=server.socket.getsockname()[1]
+		replies={}
+
+		def client():
+			s1=smtplib.SMTP("localhost",port,timeout=10)
+			s1.ehlo()
+			s1.mail("sender@gpgmailencry.pt")
+			s1.rcpt("testaddress@gpgmailencry.pt")
+			s1.putcmd("data")
+			s1.getreply()
+			s1.send(b"x"*5000+b"\r\n.\r\n")
+			replies["data"]=s1.getreply()[0]
+
+			try:
+				smtplib.SMTP("localhost",port,timeout=10)
+			except smtplib.SMTPConnectError as e:
+				replies["connect"]=e.smtp_code
+
+			s1.quit()
+
+		t=threading.Thread(target=client)
+		t.start()
+
+		while t.is_alive():
+			asyncore.loop(timeout=0.05,count=1)
+
+		server.close()
+		self.assertEqual(replies,{"data":552,"connect":421})
+		self.assertEqual(server.admission.inflight,0)
+		self.assertEqual(server.admission.queuedbytes,0)
+
+	def test_server_queuedbytes(self):
+		self.gme._SMTPD_MAXQUEUEDBYTES=1000
+		server=gmeutils.gpgmailserver._gpgmailencryptserver(self.gme,
+															("localhost",0))
+		port=server.socket.getsockname()[1]
+		self.gme.send_mails=lambda data,recipients:None
+		replies={}
+
+		def startdata():
+			s=smtplib.SMTP("localhost",port,timeout=10)
+			s.ehlo()
+			replies["size"]=s.esmtp_features.get("size")
+			s.mail("sender@gpgmailencry.pt")
+			s.rcpt("testaddress@gpgmailencry.pt")
+			s.putcmd("data")
+			s.getreply()
+			s.send(b"x"*600)
+			return s
+
+		def client():
+			s1=startdata()
+
+			while server.admission.queuedbytes<600:
+				time.sleep(0.01)
+
+			#the other message in flight causes the overload
+			s2=startdata()
+			s2.send(b"\r\n.\r\n")
+			replies["overload"]=s2.getreply()[0]
+			s1.send(b"\r\n.\r\n")
+			replies["first"]=s1.getreply()[0]
+			s1.quit()
+			s2.quit()
+
+		t=threading.Thread(target=client)
+		t.start()
+
+		while t.is_alive():
+			asyncore.loop(timeout=0.05,count=1)
+
+		server.close()
+		self.assertEqual(replies,{"size":"1000","overload":451,"first":250})
+		self.assertEqual(server.admission.queuedbytes,0)
+
+	def test_server_8bitmime(self):
+		server=gmeutils.gpgmailserver._gpgmailencryptserver(self.gme,
+															("localhost",0))
+		port=server.socket.getsockname()[1]
+		received=[]
+		self.gme.send_mails=lambda data,recipients:received.append(
+												bytes(data.getbuffer()))
+		extensions={}
+		mail=(	b"From: sender@gpgmailencry.pt\r\nSubject: test\r\n"
+				b"Content-Type: text/plain; charset=iso-8859-1\r\n"
+				b"Content-Transfer-Encoding: 8bit\r\n\r\nK\xe4se\r\n")
+
+		def client():
+			s=smtplib.SMTP("localhost",port,timeout=10)
+			s.ehlo()
+			extensions["8bitmime"]=s.has_extn("8bitmime")
+			extensions["smtputf8"]=s.has_extn("smtputf8")
+			s.sendmail(	"sender@gpgmailencry.pt",
+						"testaddress@gpgmailencry.pt",
+						mail,
+						mail_options=["BODY=8BITMIME"])
+			s.quit()
+
+		t=threading.Thread(target=client)
+		t.start()
+
+		while t.is_alive():
+			asyncore.loop(timeout=0.05,count=1)
+
+		server.close()
+		self.assertEqual(extensions,{"8bitmime":True,"smtputf8":True})
+		#smtpd removes the line break before the final dot
+		self.assertEqual(received,[mail.replace(b"\r\n",b"\n")[:-1]])
+
+	def test_mailstore(self):
+		data=b"..first\r\nline\r\n..second\r\n\r\n.\r\nlast"
+		expected=b".first\nline\n.second\n\n\nlast"
+
+		for size in [1,2,3,5,len(data)]:
+			store=gmeutils.mailstore._MAILSTORE(self.gme)
+
+			for i in range(0,len(data),size):
+				store.write(data[i:i+size])
+
+			store.finish()
+			self.assertFalse(store.spilled())
+			self.assertEqual(store.getbuffer(),expected)
+			store.close()
+
+	def test_mailstore_spill(self):
+		store=gmeutils.mailstore._MAILSTORE(self.gme,spillsize=100)
+		store.write(b"Subject: test\r\n\r\n")
+		self.assertFalse(store.spilled())
+
+		for i in range(20):
+			store.write(b"line %i\r\n"%i)
+
+		store.write(b"..")
+		store.finish()
+		self.assertTrue(store.spilled())
+		fname=store._file.name
+		self.assertEqual(store.getbuffer()[-9:],b"line 19\n.")
+		self.assertEqual(store.message()["Subject"],"test")
+		store.close()
+		self.assertFalse(os.path.exists(fname))
+
+	def test_workspace(self):
+		self.assertTrue(self.gme._open_workspace())
+		self.assertFalse(self.gme._open_workspace())
+		path=self.gme._workspace.path
+		f1=self.gme._new_tempfile()
+		f1.close()
+		f2=self.gme._new_tempfile()
+		f2.close()
+		d=self.gme._mkdtemp()
+		self.assertEqual(os.path.dirname(f1.name),path)
+		self.assertEqual(os.path.dirname(d),path)
+		self.gme._del_tempfile(f1.name)
+		leaks=self.gme.get_statistics()["temporary files leaked"]
+		self.gme._close_workspace()
+		self.assertFalse(os.path.exists(path))
+		self.assertIsNone(self.gme._workspace)
+		self.assertEqual(self.gme.get_statistics()["temporary files leaked"],
+						leaks+1)
+
+	def test_use_workspace(self):
+		paths=[]
+
+		class fake:
+			_open_workspace=self.gme._open_workspace
+			_close_workspace=self.gme._close_workspace
+
+			@gmeutils.workspace._use_workspace
+			def inner(this):
+				paths.append(self.gme._workspace.path)
+
+			@gmeutils.workspace._use_workspace
+			def outer(this):
+				paths.append(self.gme._workspace.path)
+				this.inner()
+
+		fake().outer()
+		self.assertEqual(paths[0],paths[1])
+		self.assertIsNone(self.gme._workspace)
+		self.assertFalse(os.path.exists(paths[0]))
+
+	def test_server_spill(self):
+		self.gme._SMTPD_SPILLSIZE=1000
+		server=gmeutils.gpgmailserver._gpgmailencryptserver(self.gme,
+															("localhost",0))
+		port=server.socket.getsockname()[1]
+		received=[]
+
+		def send_mails(data,recipients):
+			received.append((data.spilled(),data.message().get_payload()))
+
+		self.gme.send_mails=send_mails
+
+		def client():
+			s=smtplib.SMTP("localhost",port,timeout=10)
+			s.sendmail(	"sender@gpgmailencry.pt",
+						"testaddress@gpgmailencry.pt",
+						b"Subject: big\r\n\r\n"+b".x\r\n"*1000)
+			s.quit()
+
+		t=threading.Thread(target=client)
+		t.start()
+
+		while t.is_alive():
+			asyncore.loop(timeout=0.05,count=1)
+
+		server.close()
+		self.assertEqual(received,[(True,".x\n"*999+".x")])
+
+	def test_server_spill_queuedbytes(self):
+		self.gme._SMTPD_SPILLSIZE=1000
+		self.gme._SMTPD_MAXQUEUEDBYTES=100000
+		server=gmeutils.gpgmailserver._gpgmailencryptserver(self.gme,
+															("localhost",0))
+		port=server.socket.getsockname()[1]
+		received=[]
+		self.gme.send_mails=lambda data,recipients:received.append(
+														data.spilled())
+
+		def client():
+			s=smtplib.SMTP("localhost",port,timeout=10)
+			s.sendmail(	"sender@gpgmailencry.pt",
+						"testaddress@gpgmailencry.pt",
+						b"Subject: big\r\n\r\n"+(b"x"*78+b"\r\n")*5000)
+			s.quit()
+
+		t=threading.Thread(target=client)
+		t.start()
+
+		while t.is_alive():
+			asyncore.loop(timeout=0.05,count=1)
+
+		server.close()
+		self.assertEqual(received,[True])
+		self.assertEqual(server.admission.rejected["queuedbytes"],0)
+		self.assertEqual(server.admission.queuedbytes,0)
+
+	def test_prefork_statistics(self):
+		class fakecontrol:
+			def send(self,**msg):
+				self.msg=msg
+
+		sup=gmeutils.prefork._PREFORKSUPERVISOR(self.gme,workers=2)
+		sup.workers={	0:{"pid":101,"control":fakecontrol()},
+						1:{"pid":102,"control":fakecontrol()}}
+		sup._handle_message(0,{	"cmd":"statistics",
+								"statistics":{"total already encrypted":2}})
+		sup._handle_message(1,{	"cmd":"statistics",
+								"statistics":{"total already encrypted":3}})
+		self.assertEqual(
+			self.gme.get_statistics()["total already encrypted"],5)
+		sup._handle_message(1,{"cmd":"admin","command":"STATISTICS"})
+		lines=sup.workers[1]["control"].msg["lines"]
+		self.assertTrue("250-total already encrypted      5" in lines)
+		self.assertTrue(sup._admin("LIMITS",None)[0].startswith("502"))
+
+	def test_prefork_deferredlist(self):
+		self.gme._DEFERLIST=os.path.join(tempfile.gettempdir(),
+										"gmetestdeferlist.txt")
+		self.gme._deferred_emails=[["/tmp/x","a@b","c@d",1.5]]
+		self.gme.store_deferred_list()
+		self.assertEqual(self.gme._deferred_emails[0][3],1.5)
+		self.gme._controlchannel=object()
+		self.gme._deferred_emails=[]
+		self.gme.store_deferred_list()
+		self.gme._controlchannel=None
+
+		with open(self.gme._DEFERLIST) as f:
+			self.assertEqual(f.read().strip(),"/tmp/x|a@b|c@d|1.5")
+
+		os.remove(self.gme._DEFERLIST)
 	
 
+def load_encryptmaildir():
+	spec=importlib.util.spec_from_file_location("encryptmaildir",
+											"../scripts/encryptmaildir.py")
+	em=importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(em)
+	return em
+
+email_8bit=(b"From: test@from.com\nTo: testaddress@gpgmailencry.pt\n"
+			b"Subject: testmail\nContent-Transfer-Encoding: 8bit\n\n"
+			b"hello \xe4\xf6\n")
+
+class encryptmaildirtests(unittest.TestCase):
+
+	def setUp(self):
+		self.gme=gpgmailencrypt.gme()
+		self.gme.set_configfile("./gmetest.conf")
+		self.em=load_encryptmaildir()
+		self.em.LOGGING=False
+		self.em.BATCH=True
+		self.em.USER="testaddress@gpgmailencry.pt"
+		self.em._gme=self.gme
+		self.em._pool=concurrent.futures.ThreadPoolExecutor(max_workers=1)
+		self.maildir=tempfile.mkdtemp()
+
+		for d in ("cur","new","tmp"):
+			os.mkdir(os.path.join(self.maildir,d))
+
+	def tearDown(self):
+		self.em._pool.shutdown(wait=True)
+		self.gme.close()
+		shutil.rmtree(self.maildir)
+
+	def _write(self,name,data,compress=False):
+		fname=os.path.join(self.maildir,name)
+
+		if compress:
+
+			with gzip.open(fname,"wb") as f:
+				f.write(data)
+
+		else:
+
+			with open(fname,"wb") as f:
+				f.write(data)
+
+		return fname
+
+	def _read(self,name):
+
+		with open(os.path.join(self.maildir,name),"rb") as f:
+			data=f.read()
+
+		if data[:2]==b"\x1f\x8b":
+			data=gzip.decompress(data)
+
+		return data
+
+	def _encrypt(self,directory="cur",complete=True):
+		dirname=os.path.join(self.maildir,directory)
+		names=[(e.name,e.inode()) for e in os.scandir(dirname)]
+		self.em.encrypt_dir(dirname,names,complete)
+
+	def _files(self,directory="cur"):
+		return sorted(n for n in os.listdir(os.path.join(self.maildir,
+															directory))
+						if not n.startswith("."))
+
+	def test_encryptmaildir_batch(self):
+		self._write("cur/1.1.host:2,S",email_unencrypted.encode("UTF-8"))
+		self._write("cur/2.2.host:2,",email_8bit.replace(b"8bit\n",
+							b"8bit\nContent-Type: text/plain; charset=utf-8\n")
+							.replace(b"\xe4\xf6",b"\xc3\xa4\xc3\xb6"),
+							compress=True)
+		self._encrypt()
+		self.assertEqual(self._files(),["1.1.host:2,S","2.2.host:2,"])
+		self.assertEqual(self._files("tmp"),[])
+
+		with open(os.path.join(self.maildir,"cur/2.2.host:2,"),"rb") as f:
+			self.assertEqual(f.read(2),b"\x1f\x8b")
+
+		for n in self._files():
+			mail=self._read("cur/"+n)
+			self.assertTrue(self.gme.is_encrypted(mail.decode("UTF-8")))
+
+		result=self.gme.decrypt_pgpmime_mail(
+								self._read("cur/2.2.host:2,").decode("UTF-8"),
+								"testaddress@gpgmailencry.pt",
+								"testaddress@gpgmailencry.pt")
+		payload=email.message_from_string(result).get_payload(decode=True)
+		self.assertEqual(payload.decode("UTF-8"),"hello äö\n")
+
+	def test_encryptmaildir_8bit(self):
+		#no key, the mail is written back with the gpgmailencrypt header
+		self.em.USER="dunno@dunno.pt"
+		self._write("cur/1.1.host:2,S",email_8bit)
+		self._encrypt()
+		mail=self._read("cur/1.1.host:2,S")
+		self.assertTrue(b"X-GPGMailencrypt" in mail)
+		self.assertTrue(mail.endswith(b"hello \xe4\xf6\n"))
+
+	def test_encryptmaildir_dovecot(self):
+		self.em.DOVECOT=True
+		self.em.get_lock=lambda directory:1
+		self.em.free_lock=lambda pid:None
+		self._write("cur/1.1.host:2,S",email_unencrypted.encode("UTF-8"))
+		self._write("new/2.2.host",email_unencrypted.encode("UTF-8"),
+					compress=True)
+		self._encrypt()
+		self._encrypt("new")
+
+		for n in self._files()+self._files("new"):
+			directory="cur" if n.startswith("1.") else "new"
+			size=len(self._read(directory+"/"+n))
+			self.assertTrue(",S=%i,"%size in n)
+			self.assertTrue(",W=" in n)
+
+		self.assertTrue(self._files()[0].endswith(":2,S"))
+		self.assertFalse(":2," in self._files("new")[0])
+
+	def test_encryptmaildir_failed(self):
+		#the original mail stays untouched, no temporary file is left
+		self.em.encrypt_batch=lambda infile,out,compression:False
+		self._write("cur/1.1.host:2,S",email_unencrypted.encode("UTF-8"))
+		self._encrypt()
+		self.assertEqual(self._read("cur/1.1.host:2,S"),
+						email_unencrypted.encode("UTF-8"))
+		self.assertEqual(self._files("tmp"),[])
+
+	def _index(self,directory="cur"):
+		return self.em.read_index(os.path.join(self.maildir,directory))
+
+	def _count_encryptions(self,result=None):
+		calls=[]
+		encrypt_batch=self.em.encrypt_batch
+
+		def _encrypt_batch(infile,out,compression):
+			calls.append(infile)
+
+			if result!=None:
+				return result
+
+			return encrypt_batch(infile,out,compression)
+
+		self.em.encrypt_batch=_encrypt_batch
+		return calls
+
+	def test_encryptmaildir_index_nostat(self):
+		fname=self._write("cur/1.1.host:2,S",email_unencrypted.encode("UTF-8"))
+		self._encrypt()
+		inode=os.stat(fname).st_ino
+		self.assertEqual(list(self._index().keys()),[(inode,"1.1.host")])
+		self.assertEqual(list(self._index().values())[0][2],
+						self.em.ENCRYPTED)
+
+		with mock.patch.object(self.em.os,"stat",wraps=os.stat) as st:
+			self._encrypt()
+
+		self.assertFalse(any(fname in str(c) for c in st.call_args_list))
+		self.assertEqual(list(self._index().keys()),[(inode,"1.1.host")])
+
+	def test_encryptmaildir_index_failed(self):
+		calls=self._count_encryptions(False)
+		fname=self._write("cur/1.1.host:2,S",email_unencrypted.encode("UTF-8"))
+		self._encrypt()
+		self.assertEqual(len(calls),1)
+		self.assertEqual(list(self._index().values())[0][2],self.em.FAILED)
+		self._encrypt()
+		self.assertEqual(len(calls),1)
+
+		#the mail was changed, it is checked again
+		with open(fname,"ab") as f:
+			f.write(b"changed\n")
+
+		self._encrypt()
+		self.assertEqual(len(calls),2)
+
+	def test_encryptmaildir_index_deleted(self):
+		self._write("cur/1.1.host:2,S",email_unencrypted.encode("UTF-8"))
+		self._write("cur/2.2.host:2,S",email_unencrypted.encode("UTF-8"))
+		self._encrypt()
+		self.assertEqual(len(self._index()),2)
+		os.remove(os.path.join(self.maildir,"cur/1.1.host:2,S"))
+		self._encrypt(complete=False)
+		self.assertEqual(len(self._index()),2)
+		self._encrypt()
+		self.assertEqual([k[1] for k in self._index().keys()],["2.2.host"])
+
+	def test_encryptmaildir_index_movetocur(self):
+		self._write("new/1.1.host",email_unencrypted.encode("UTF-8"))
+		self._encrypt("new")
+		calls=self._count_encryptions()
+		os.rename(os.path.join(self.maildir,"new/1.1.host"),
+				os.path.join(self.maildir,"cur/1.1.host:2,S"))
+		self._encrypt()
+		self.assertEqual(calls,[])
+		self.assertEqual([(k[1],v[2]) for k,v in self._index().items()],
+						[("1.1.host",self.em.ENCRYPTED)])
+
+	def test_encryptmaildir_index_mtime(self):
+		#mails, that were checked before the index existed, are not
+		#encrypted again
+		calls=self._count_encryptions()
+		fname=self._write("cur/1.1.host:2,S",email_unencrypted.encode("UTF-8"))
+
+		with open(os.path.join(self.maildir,"cur",self.em.MTIMEFILE),"w") as f:
+			f.write(str(os.stat(fname).st_mtime+1))
+
+		self._encrypt()
+		self.assertEqual(calls,[])
+		self.assertEqual(list(self._index().values())[0][2],
+						self.em.ENCRYPTED)
+
+
 if __name__ == '__main__':
 	unittest.main()